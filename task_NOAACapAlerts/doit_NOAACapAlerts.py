@@ -11,48 +11,129 @@ Once the insert statement is completed a database connection is established, all
 and the new records are inserted.
 Redesigned from the original CGIS version when MEMA server environments were being migrated to new versions.
 Author: CJuice, 20190415
-Revisions:
+Revisions: 20261016, Requests to the county feeds are made concurrently over a single pooled keep-alive session
+    instead of one after another. Each response is processed as soon as it arrives. The number of simultaneous
+    requests is set by the MAX_CONCURRENT_REQUESTS option; a value of 1 reproduces the original serial behavior.
+20261016, Replaced the regular expression tag searches that were repeated for every field of every entry with a
+    single pass over each entry's children that indexes them by tag name without the namespace.
+20261016, Added a local feed cache keyed by fips. Requests send the ETag and Last-Modified values from the previous
+    response so NOAA can answer 304 Not Modified, in which case the cached alerts are reused instead of parsed. When
+    no county's alerts changed the DELETE and INSERT are skipped. Cache hits and bytes saved are printed at the end.
+20261016, An alert covering many counties appears in each of their feeds. Entries are now keyed by their id and an
+    alert is parsed, with its dates and polygon converted, only the first time it is seen. Later counties get a copy
+    of that object with their own fips and feed updated date.
+20261016, Added a streaming parse option. When STREAMING_XML_PARSE is True the response is parsed from the byte
+    stream as it downloads and each entry is processed, then discarded, as soon as its closing tag is read so memory
+    does not grow with feed size. Feed parse time, and peak memory when REPORT_PARSE_MEMORY is True, are printed.
+20261016, Added a statewide ingestion mode. When INGESTION_MODE is "statewide" all active Maryland alerts are
+    requested from the NWS alerts api in one GeoJSON response instead of one request per county. Each alert is
+    assigned to the counties of interest using its SAME and UGC geocodes and the same table rows are produced.
+20261016, Replaced the delete of every record followed by the insert of every alert with a differential load. The
+    rows committed on the previous run, held in the feed cache, are compared with this run's rows by link and fips.
+    Only new rows are inserted, changed rows updated, and rows no longer present deleted, all in one transaction.
+    Without a complete snapshot, or when DIFFERENTIAL_LOAD is False, the original delete and insert is used.
+20261016, Polygon text is now converted to WKT by splitting all coordinates at once and switching the latitude and
+    longitude columns by slicing, rather than splitting each pair twice. Conversions are memoized by polygon text in
+    a bounded LRU cache since detailed warning polygons repeat across counties.
+20261016, Alerts with Extreme or Severe severity, or Immediate urgency, are written and committed on their own
+    connection as soon as their county is parsed rather than waiting for every county. The remaining rows are
+    reconciled at the end of the run as before. Time to database for these alerts is printed separately.
+20261016, County feeds are now read and parsed in the request workers, streamed or not, and the parsed alerts
+    are returned to the main thread. Streamed bodies were previously read by the main thread one after another.
+20261016, In statewide mode the alert description used for the Summary is cut to the width of the Summary column.
+20261016, The differential load falls back to a full delete and insert when a row key repeats, since rows keyed by
+    link and fips cannot then be compared one to one. A full reload is also made every FULL_RELOAD_INTERVAL_HOURS.
+20261016, High priority rows committed early are saved to the feed cache as soon as they commit, so a run that ends
+    before its final commit no longer leaves the next run with a snapshot missing those rows.
+20261016, Entries with neither an id nor a link are keyed by a hash of their title and updated text instead of an
+    empty string so they are no longer mistaken for one another when reusing parsed alerts.
+20261016, In statewide mode a response that is neither 200 nor a 304 answered from the cache now ends the run
+    without touching the table or the cache. Error responses have no features and cleared every county's alerts.
 """
 
 
 def main():
 
     # IMPORTS
-    from datetime import datetime
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from datetime import datetime, timedelta
     from dateutil import parser as date_parser
+    from functools import lru_cache
     import configparser
-    from dataclasses import dataclass
+    import copy
+    from dataclasses import asdict, dataclass, replace
+    import hashlib
+    import json
     import numpy as np
     import os
     import pyodbc
-    import re
     import requests
+    from requests.adapters import HTTPAdapter
+    import time
+    import tracemalloc
     import xml.etree.ElementTree as ET
 
     # VARIABLES
+    DIFFERENTIAL_LOAD = True  # OPTION
+    EARLY_COMMIT_HIGH_PRIORITY = True  # OPTION
+    FULL_RELOAD_INTERVAL_HOURS = 24  # OPTION
+    INGESTION_MODE = "county"  # OPTION, "county" requests each county feed, "statewide" requests all MD alerts at once
+    MAX_CONCURRENT_REQUESTS = 8  # OPTION
+    REPORT_PARSE_MEMORY = False  # OPTION
+    STREAMING_XML_PARSE = False  # OPTION
+    USE_FEED_CACHE = True  # OPTION
+
     _root_file_path = os.path.dirname(__file__)
     alert_objects = []
+    changed_fips_list = []
     config_file = r"doit_config_NOAACapAlerts.cfg"
     config_file_path = os.path.join(_root_file_path, config_file)
     database_connection_string = "DSN={database_name};UID={database_user};PWD={database_password}"
+    date_time_format = '%Y-%m-%d %H:%M:%S'
+    early_committed_keys = set()
+    entry_extraction_count = 0
+    entry_extraction_seconds = 0.0
+    entry_reuse_count = 0
+    feed_cache_bytes_saved = 0
+    feed_cache_file = r"doit_cache_NOAACapAlerts.json"
+    feed_cache_file_path = os.path.join(_root_file_path, feed_cache_file)
+    feed_cache_hit_count = 0
+    feed_parse_seconds = 0.0
+    feed_request_count = 0
+    full_reload_cache_key = "last_full_reload"
+    high_priority_commit_delays = []
+    high_priority_severities = ("Extreme", "Severe")
+    high_priority_urgencies = ("Immediate",)
     mdc_code_template = "MDC{fips_last_three}"
     noaa_fips_values = [24001, 24003, 24005, 24510, 24009, 24011, 24013, 24015, 24017, 24019, 24021, 24023, 24025,
                         24027, 24029, 24031, 24033, 24035, 24037, 24039, 24041, 24043, 24045, 24047]
+    no_active_alerts_title = "There are no active watches, warnings or advisories"
+    noaa_statewide_request_headers = {"Accept": "application/geo+json", "User-Agent": "MEMA RealTime NOAACapAlerts"}
+    noaa_statewide_url = r"""https://api.weather.gov/alerts/active?area=MD"""
     noaa_url_template = r"""http://alerts.weather.gov/cap/wwaatmget.php?x={code}&y=0"""
+    parsed_alerts_dict = {}
+    polygon_wkt_cache_size = 512
     realtime_noaacapalerts_headers = ('AlertText', 'URL', 'PublishDate', 'LastUpdated', 'Summary',
                                       'EffectiveDate', 'ExpirationDate', 'Status', 'Type', 'Urgency', 'Severity',
                                       'Certainty', 'County', 'fips', 'Event', 'geometry', 'DataGenerated')
     realtime_noaacapalerts_tbl = "[{database_name}].[dbo].[RealTime_NOAACapALerts]"
+    request_timeout_seconds = 30
+    sql_delete_row_template = """DELETE FROM {table} WHERE URL = '{link}' AND fips = '{fips}';"""
     sql_delete_template = """DELETE FROM {table};"""
     sql_insert_template = """INSERT INTO {table} ({headers_joined}) VALUES """
     sql_insertion_step_increment = 1000
+    sql_update_row_template = """UPDATE {table} SET {set_values} WHERE URL = '{link}' AND fips = '{fips}';"""
     sql_values_statement = """({values})"""
     sql_values_statements_list = []
+    statewide_cache_key = "statewide"
+    stream_chunk_size = 64 * 1024
+    summary_max_length = 250  # Must not exceed the width of the Summary column in the alerts table
     sql_values_string_template = """'{title}', '{link}', '{published}', '{updated}', '{summary}', '{cap_effective}', '{cap_expires}', '{cap_status}', '{cap_msg_type}', '{cap_urgency}', '{cap_severity}', '{cap_certainty}', '{cap_area_desc}', '{fips}', '{cap_event}', {cap_geometry}, '{data_gen}'"""  # Removed ID field
     task_name = "NOAACapAlerts"
 
     # ASSERTS
     assert os.path.exists(config_file_path)
+    assert len(realtime_noaacapalerts_headers) == len(sql_values_string_template.split(", "))
     print("Assertion tests completed.")
 
     # CLASSES
@@ -77,6 +158,16 @@ def main():
         title: str = np.NaN
         updated: str = '1970-01-01 00:00:00'
 
+    @dataclass
+    class CountyFeedResult:
+        """Data class for holding a county feed response and the alerts parsed from it in a worker thread"""
+        alerts: list = None
+        extraction_count: int = 0
+        extraction_seconds: float = 0.0
+        parse_seconds: float = 0.0
+        response: requests.Response = None
+        reuse_count: int = 0
+
     # FUNCTIONS
     def assemble_fips_to_mdccode_dict(url_template: str, mdc_code_template: str, fips_values: list) -> dict:
         """
@@ -100,6 +191,187 @@ def main():
             output_dict[value] = full_url
         return output_dict
 
+    def build_local_name_index(element: ET.Element) -> dict:
+        """
+        Walk the immediate children of an element once and index them by local tag name.
+        Tags arrive with a namespace prepended, like '{urn:oasis:names:tc:emergency:cap:1.1}event'. The namespace is
+        dropped so the child can be found by 'event' alone. Children sharing a name are kept in document order.
+        :param element: xml ET.Element whose children are to be indexed
+        :return: dictionary of local tag name keys and lists of child ET.Element values
+        """
+        index = {}
+        for child in element:
+            local_name = child.tag.rpartition("}")[2]
+            index.setdefault(local_name, []).append(child)
+        return index
+
+    def commit_high_priority_alerts(connection: pyodbc.Connection, alert_objs: list) -> None:
+        """
+        Write and commit the high priority alerts among those provided without waiting for the rest of the run.
+        An alert already committed this run, or unchanged from the previous run's snapshot, is skipped. Each row is
+        deleted by its key before being inserted so a retry cannot duplicate it. On a database error the rows are
+        rolled back and left for the reconciliation at the end of the run. Committed rows are saved to the cached
+        snapshot straight away so the next run knows of them even if this run ends before its final commit.
+        :param connection: pyodbc connection used only for high priority writes
+        :param alert_objs: list of CAPEntry dataclass objects just parsed
+        :return: None
+        """
+        cursor = connection.cursor()
+        committed_alert_objs = []
+        for alert_obj in alert_objs:
+            key = create_row_key(alert_obj=alert_obj)
+            if not determine_alert_is_high_priority(alert_obj=alert_obj) or key in early_committed_keys:
+                continue
+            values_string = create_sql_values_string(alert_obj=alert_obj)
+            if previous_rows_dict is not None and key in previous_rows_dict:
+                if create_sql_values_string(alert_obj=previous_rows_dict[key]) == values_string:
+                    continue
+            try:
+                cursor.execute(sql_delete_row_template.format(table=database_table_name, link=key[0], fips=key[1]))
+                cursor.execute(sql_insert_string + values_string)
+            except pyodbc.Error as e:
+                print(f"Error writing high priority alert {key}. Left for end of run. {e}")
+                connection.rollback()
+                return
+            committed_alert_objs.append(alert_obj)
+        if committed_alert_objs:
+            connection.commit()
+            committed_keys = [create_row_key(alert_obj=alert_obj) for alert_obj in committed_alert_objs]
+            early_committed_keys.update(committed_keys)
+            save_early_committed_rows(alert_objs=committed_alert_objs)
+            high_priority_commit_delays.extend([time_elapsed(start=start)] * len(committed_keys))
+            print(f"High priority alerts committed {committed_keys}. Time elapsed {time_elapsed(start=start)}")
+
+    @lru_cache(maxsize=polygon_wkt_cache_size)
+    def convert_polygon_text_to_wkt(poly_values: str) -> str:
+        """
+        Convert CAP polygon text to the geometry sql for entry into the database and return.
+        Text comes in like '37.23,-89.59 37.25,-89.41 37.13,-89.29 37.23,-89.59' as latitude,longitude pairs.
+        All values are split at once, the longitude and latitude columns are taken by slicing, and the switched pairs
+        are joined in one pass. The original text of each number is kept so output matches exactly. NumPy string
+        arrays were tried for this and were slower than slicing the list.
+        Results are memoized by the polygon text; the lru_cache is bounded so memory cannot grow without limit.
+        :param poly_values: polygon text from the CAP polygon element
+        :return: string for entry in database
+        """
+        coord_values = poly_values.replace(",", " ").split(" ")
+        coord_pairs_switched = map(" ".join, zip(coord_values[1::2], coord_values[0::2]))
+        return """geometry::STGeomFromText('POLYGON(({coords_joined}))', 4326)""".format(
+            coords_joined=",".join(coord_pairs_switched))
+
+    def create_cap_entry_from_feature(feature: dict, fips: str, date_updated: str) -> CAPEntry:
+        """
+        Create a CAPEntry from a GeoJSON alert feature returned by the NWS alerts api and return it.
+        The api properties are mapped to the values the county Atom feeds provided. The headline stands in for the
+        Atom title and the time the alert was sent serves as both the published and updated dates. The description
+        stands in for the Atom summary. It is often far longer than the Atom summary, so it is shortened to
+        summary_max_length characters, the width of the Summary column, and ends with '...' like the Atom summaries.
+        :param feature: GeoJSON feature from the api response
+        :param fips: fips code of the county the entry is for
+        :param date_updated: processed date the api response was updated
+        :return: CAPEntry dataclass object
+        """
+        properties = feature.get("properties", {})
+        sent_processed = process_date_string(date_string=properties.get("sent", ""))
+        return CAPEntry(cap_area_desc=replace_problematic_chars_w_underscore(string=properties.get("areaDesc") or ""),
+                        cap_certainty=properties.get("certainty", np.NaN),
+                        cap_effective=process_date_string(date_string=properties.get("effective", "")),
+                        cap_event=properties.get("event", np.NaN),
+                        cap_expires=process_date_string(date_string=properties.get("expires", "")),
+                        cap_msg_type=properties.get("messageType", np.NaN),
+                        cap_polygon=process_geojson_polygon(geometry=feature.get("geometry")),
+                        cap_severity=properties.get("severity", np.NaN),
+                        cap_status=properties.get("status", np.NaN),
+                        cap_urgency=properties.get("urgency", np.NaN),
+                        data_gen=date_updated,
+                        fips=fips,
+                        link=properties.get("@id", feature.get("id", np.NaN)),
+                        published=sent_processed,
+                        summary=truncate_summary(
+                            string=replace_problematic_chars_w_underscore(string=properties.get("description") or "")),
+                        title=replace_problematic_chars_w_underscore(
+                            string=properties.get("headline") or properties.get("event") or ""),
+                        updated=sent_processed)
+
+    def create_cap_entry_from_index(entry_index: dict, fips: str, date_updated: str) -> CAPEntry:
+        """
+        Create a CAPEntry from the local name index of an entry element and return it.
+        The index is built in a single pass over the entry's children so each field is a dictionary lookup instead
+        of a regular expression search of every child tag. When the entry is the placeholder NOAA uses for a county
+        with no alerts, only the title is of interest.
+        :param entry_index: dictionary of local tag names and child elements for an entry element
+        :param fips: fips code of the county feed the entry came from
+        :param date_updated: processed date the county feed was updated
+        :return: CAPEntry dataclass object
+        """
+        def get_text(tag_name: str) -> str:
+            return get_first_indexed_element(index=entry_index, tag_name=tag_name).text
+
+        title_text_processed = replace_problematic_chars_w_underscore(string=get_text("title"))
+        if title_text_processed == no_active_alerts_title:
+            return CAPEntry(data_gen=date_updated, fips=fips, title=title_text_processed)
+
+        link_element = get_first_indexed_element(index=entry_index, tag_name="link")
+        return CAPEntry(cap_area_desc=replace_problematic_chars_w_underscore(string=get_text("areaDesc")),
+                        cap_certainty=get_text("certainty"),
+                        cap_effective=process_date_string(date_string=get_text("effective")),
+                        cap_event=get_text("event"),
+                        cap_expires=process_date_string(date_string=get_text("expires")),
+                        cap_msg_type=get_text("msgType"),
+                        cap_polygon=process_polygon_elem_result(
+                            poly_elem=get_first_indexed_element(index=entry_index, tag_name="polygon")),
+                        cap_severity=get_text("severity"),
+                        cap_status=get_text("status"),
+                        cap_urgency=get_text("urgency"),
+                        data_gen=date_updated,
+                        fips=fips,
+                        link=link_element.attrib.get("href", np.NaN),
+                        published=process_date_string(date_string=get_text("published")),
+                        summary=replace_problematic_chars_w_underscore(string=get_text("summary")),
+                        title=title_text_processed,
+                        updated=process_date_string(date_string=get_text("updated")))
+
+    def create_conditional_request_headers(cached_feed: dict) -> dict:
+        """
+        Create the request headers that let NOAA respond 304 Not Modified when a feed is unchanged since it was cached.
+        :param cached_feed: cache record for a county feed, or None when the feed has not been cached
+        :return: dictionary of request headers, empty when there are no validators to send
+        """
+        headers = {}
+        if cached_feed is None:
+            return headers
+        if cached_feed.get("etag"):
+            headers["If-None-Match"] = cached_feed["etag"]
+        if cached_feed.get("last_modified"):
+            headers["If-Modified-Since"] = cached_feed["last_modified"]
+        return headers
+
+    def create_county_alerts_from_geojson(response_json: dict, fips_values: list) -> dict:
+        """
+        Create CAPEntry objects for each county of interest from a statewide GeoJSON alerts response.
+        Each feature is converted once and then copied for every county it applies to. Counties with no alerts get
+        the same placeholder entry the county Atom feeds provide.
+        :param response_json: json from the NWS alerts api response
+        :param fips_values: list of string fips values of interest for the process
+        :return: dictionary of fips keys and lists of CAPEntry values
+        """
+        date_updated = process_date_string(date_string=response_json.get("updated", ""))
+        county_alerts_dict = {fips: [] for fips in fips_values}
+        for feature in response_json.get("features", []):
+            feature_fips_values = determine_feature_fips_values(properties=feature.get("properties", {}),
+                                                                fips_values=fips_values)
+            if not feature_fips_values:
+                continue
+            cap_entry = create_cap_entry_from_feature(feature=feature,
+                                                      fips=feature_fips_values[0],
+                                                      date_updated=date_updated)
+            for fips in feature_fips_values:
+                county_alerts_dict[fips].append(replace(cap_entry, fips=fips))
+        for fips, county_alert_objects in county_alerts_dict.items():
+            if not county_alert_objects:
+                county_alert_objects.append(CAPEntry(data_gen=date_updated, fips=fips, title=no_active_alerts_title))
+        return county_alerts_dict
+
     def create_database_connection_string(db_name: str, db_user: str, db_password: str) -> str:
         """
         Create the connection string for accessing database and return.
@@ -116,6 +388,116 @@ def main():
         """
         return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
+    def create_pooled_session(pool_size: int) -> requests.Session:
+        """
+        Create a requests Session with a connection pool large enough to hold a keep-alive connection per worker.
+        All county feeds come from the same NOAA host so reusing connections avoids a new handshake per request.
+        :param pool_size: number of connections the pool may keep open
+        :return: requests Session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def create_row_key(alert_obj: CAPEntry) -> tuple:
+        """
+        Create the key that identifies an alert's row in the database table. The link identifies the alert and the
+        fips identifies the county row. The no alerts placeholder has no link so it is keyed by 'nan', as written.
+        :param alert_obj: CAPEntry dataclass object
+        :return: tuple of string link and string fips
+        """
+        return str(alert_obj.link), str(alert_obj.fips)
+
+    def create_rows_dict(alert_objs: list) -> tuple:
+        """
+        Create the dictionary of rows keyed by row key from alerts and report any key that repeats.
+        A repeated key would be silently merged into one dictionary entry so the caller must not compare rows by key.
+        :param alert_objs: list of CAPEntry dataclass objects
+        :return: tuple of dictionary of row key tuples and CAPEntry values, and list of repeated row keys
+        """
+        rows_dict = {}
+        duplicate_row_keys = []
+        for alert_obj in alert_objs:
+            key = create_row_key(alert_obj=alert_obj)
+            if key in rows_dict:
+                duplicate_row_keys.append(key)
+            rows_dict[key] = alert_obj
+        return rows_dict, duplicate_row_keys
+
+    def create_rows_snapshot_from_cache(cache: dict, fips_values: list):
+        """
+        Create the snapshot of rows committed on the previous run from the cached alerts of every county.
+        If any county is missing from the cache the table contents cannot be known, so no snapshot is returned. The
+        same is true when a row key repeats, since the table holds a row for each and the snapshot could hold one.
+        :param cache: dictionary of fips keys and cache record values
+        :param fips_values: list of string fips values of interest for the process
+        :return: dictionary of row key tuples and CAPEntry values, or None
+        """
+        alert_objs = []
+        for fips in fips_values:
+            if fips not in cache:
+                return None
+            alert_objs.extend([CAPEntry(**values) for values in cache[fips]["alerts"]])
+        rows_snapshot, duplicate_row_keys = create_rows_dict(alert_objs=alert_objs)
+        if duplicate_row_keys:
+            print(f"Row keys repeated in the cached snapshot {duplicate_row_keys}. Snapshot not used")
+            return None
+        return rows_snapshot
+
+    def create_sql_format_values(alert_obj: CAPEntry) -> dict:
+        """
+        Create the dictionary of values used to fill the sql values string template for an alert.
+        :param alert_obj: CAPEntry dataclass object
+        :return: dictionary of template keys and alert values
+        """
+        return dict(title=alert_obj.title,
+                    link=alert_obj.link,
+                    published=alert_obj.published,
+                    updated=alert_obj.updated,
+                    summary=alert_obj.summary,
+                    cap_effective=alert_obj.cap_effective,
+                    cap_expires=alert_obj.cap_expires,
+                    cap_status=alert_obj.cap_status,
+                    cap_msg_type=alert_obj.cap_msg_type,
+                    cap_urgency=alert_obj.cap_urgency,
+                    cap_severity=alert_obj.cap_severity,
+                    cap_certainty=alert_obj.cap_certainty,
+                    cap_area_desc=alert_obj.cap_area_desc,
+                    fips=alert_obj.fips,
+                    cap_event=alert_obj.cap_event,
+                    cap_geometry=alert_obj.cap_polygon,
+                    data_gen=alert_obj.data_gen)
+
+    def create_sql_values_string(alert_obj: CAPEntry) -> str:
+        """
+        Create the values string statement for an alert for use with the SQL INSERT statement.
+        :param alert_obj: CAPEntry dataclass object
+        :return: string of values wrapped in parentheses
+        """
+        values = sql_values_string_template.format(**create_sql_format_values(alert_obj=alert_obj))
+        return sql_values_statement.format(values=values)
+
+    def determine_alert_is_high_priority(alert_obj: CAPEntry) -> bool:
+        """
+        Determine if an alert is severe or urgent enough to be written to the database before the rest of the run.
+        :param alert_obj: CAPEntry dataclass object
+        :return: True when the severity or urgency is of high priority
+        """
+        return alert_obj.cap_severity in high_priority_severities or alert_obj.cap_urgency in high_priority_urgencies
+
+    def determine_alerts_changed(cached_feed: dict, county_alert_values: list) -> bool:
+        """
+        Determine if a county's alerts differ from those cached on the previous run.
+        A feed can come back in full yet hold the same alerts as last time. Only a difference counts as a change.
+        Values are compared as json text because nan values never compare equal to one another.
+        :param cached_feed: cache record for a county, or None when the county has not been cached
+        :param county_alert_values: list of CAPEntry values as dictionaries
+        :return: True when the alerts changed
+        """
+        return cached_feed is None or json.dumps(cached_feed["alerts"]) != json.dumps(county_alert_values)
+
     def determine_database_config_value_based_on_script_name() -> str:
         """
         Inspect the python script file name to see if it includes _PROD and return appropriate value.
@@ -131,57 +513,160 @@ def main():
         else:
             return "DATABASE_DEV"
 
-    def extract_all_immediate_child_features_from_element(element: ET.Element, tag_name: str) -> list:
+    def determine_entry_key(entry_index: dict) -> str:
+        """
+        Determine the value that identifies an alert across county feeds. The entry id is used, or the link
+        when there is no id. An entry with neither is keyed by a hash of its title and updated text so that two such
+        entries are not taken to be the same alert.
+        :param entry_index: dictionary of local tag names and child elements for an entry element
+        :return: string key for the alert
         """
-        Extract all immediate children of the element provided to the method.
+        id_element = get_first_indexed_element(index=entry_index, tag_name="id")
+        if id_element is not None and id_element.text:
+            return id_element.text
+        link_element = get_first_indexed_element(index=entry_index, tag_name="link")
+        if link_element is not None and link_element.attrib.get("href"):
+            return link_element.attrib["href"]
+        fallback_values = [get_first_indexed_element(index=entry_index, tag_name=tag_name)
+                           for tag_name in ("title", "updated")]
+        fallback_text = "|".join([element.text or "" for element in fallback_values if element is not None])
+        return f"md5:{hashlib.md5(fallback_text.encode('utf-8')).hexdigest()}"
 
-        :param element: ET.Element of interest to be interrogated
-        :param tag_name: tag of interest on which to search
-        :return: list of all discovered ET.Element items
+    def determine_feature_fips_values(properties: dict, fips_values: list) -> list:
         """
-        try:
-            result = element.findall(tag_name)
-        except AttributeError as ae:
-            print(f"AttributeError: Unable to extract '{tag_name}' from {element.text}: {ae}")
-            exit()
-        else:
-            return result
+        Determine the counties of interest that a GeoJSON alert feature applies to from its geocodes.
+        SAME codes are the fips code with a leading zero, like '024001'. UGC county codes are the MDC codes used in the
+        county feed urls, like 'MDC001'. UGC zone codes, like 'MDZ001', do not map to a county and are ignored.
+        :param properties: properties of the GeoJSON feature
+        :param fips_values: list of string fips values of interest for the process
+        :return: list of string fips values the alert applies to
+        """
+        geocode = properties.get("geocode") or {}
+        feature_fips = {same_code[-5:] for same_code in geocode.get("SAME", [])}
+        feature_fips.update(f"24{ugc_code[3:]}" for ugc_code in geocode.get("UGC", []) if ugc_code.startswith("MDC"))
+        return [fips for fips in fips_values if fips in feature_fips]
+
+    def determine_full_reload_is_due(cache: dict, now: datetime) -> bool:
+        """
+        Determine if the table must be fully deleted and reloaded rather than changed row by row.
+        A periodic full reload corrects any difference between the table and the cached snapshot, such as rows
+        changed outside this process.
+        :param cache: feed cache from the previous run
+        :param now: datetime of this run
+        :return: True when a full reload is needed
+        """
+        if not cache.get(full_reload_cache_key):
+            return True
+        last_full_reload = datetime.strptime(cache[full_reload_cache_key], date_time_format)
+        return now - last_full_reload >= timedelta(hours=FULL_RELOAD_INTERVAL_HOURS)
 
-    def extract_first_immediate_child_feature_from_element(element: ET.Element, tag_name: str) -> ET.Element:
-        """Extract first immediate child feature from provided xml ET.Element based on provided tag name
+    def determine_row_changes(previous_rows: dict, current_rows: dict) -> tuple:
+        """
+        Compare this run's rows with the previous run's rows and determine which to insert, update, and delete.
+        Rows with the same key are compared by their sql values string, which is exactly what would be written.
+        :param previous_rows: dictionary of row key tuples and CAPEntry values committed on the previous run
+        :param current_rows: dictionary of row key tuples and CAPEntry values from this run
+        :return: tuple of lists of row keys to insert, update, and delete
+        """
+        insert_keys = []
+        update_keys = []
+        for key, alert_obj in current_rows.items():
+            if key not in previous_rows:
+                insert_keys.append(key)
+                continue
+            previous_values_string = create_sql_values_string(alert_obj=previous_rows[key])
+            if create_sql_values_string(alert_obj=alert_obj) != previous_values_string:
+                update_keys.append(key)
+        delete_keys = [key for key in previous_rows if key not in current_rows]
+        return insert_keys, update_keys, delete_keys
 
-        :param element: xml ET.Element to interrogate
-        :param tag_name: name of desired tag
-        :return: ET.Element of interest
+    def get_first_indexed_element(index: dict, tag_name: str):
         """
+        Get the first child element indexed under the local tag name.
+        :param index: dictionary of local tag names and child elements
+        :param tag_name: local tag name being sought
+        :return: ET.Element or None when the tag was not present
+        """
+        elements = index.get(tag_name)
+        return elements[0] if elements else None
 
+    def iterate_entry_indexes(response_xml_str: str):
+        """
+        Generator for yielding the local name index of each entry in a feed that is parsed in full to a tree.
+        :param response_xml_str: string xml from response
+        :return: yield a tuple of the entry's local name index and the processed date the feed was updated
+        """
+        xml_response_root = parse_xml_response_to_element(response_xml_str=response_xml_str)
+        root_index = build_local_name_index(element=xml_response_root)
+        doc_updated_element = get_first_indexed_element(index=root_index, tag_name="updated")
+
+        # ignored time zone and dst etc conversions at time of redesign. Possible TODO
+        date_updated = process_date_string(date_string=doc_updated_element.text)
+        for data in root_index.get("entry", []):
+            yield build_local_name_index(element=data), date_updated
+
+    def iterate_streamed_entry_indexes(response: requests.Response):
+        """
+        Generator for yielding the local name index of each entry in a feed as the response bytes are read.
+        An entry is yielded when its end tag is parsed. Once the caller is done with it the entry is cleared and
+        removed from the root so finished entries do not accumulate. The feed level updated value precedes the
+        entries in NOAA feeds; if it were absent the default date would be used.
+        :param response: requests Response made with stream=True
+        :return: yield a tuple of the entry's local name index and the processed date the feed was updated
+        """
+        date_updated = '1970-01-01 00:00:00'
+        depth = 0
+        pull_parser = ET.XMLPullParser(events=("start", "end"))
+        root = None
         try:
-            result = element.find(tag_name)
-        except AttributeError as ae:
-            print(f"AttributeError: Unable to extract '{tag_name}' from {element.text}: {ae}")
+            for chunk in response.iter_content(chunk_size=stream_chunk_size):
+                pull_parser.feed(chunk)
+                for event, element in pull_parser.read_events():
+                    if event == "start":
+                        if root is None:
+                            root = element
+                        depth += 1
+                        continue
+                    depth -= 1
+                    if depth != 1:
+                        continue
+                    local_name = element.tag.rpartition("}")[2]
+                    if local_name == "updated":
+                        date_updated = process_date_string(date_string=element.text)
+                    elif local_name == "entry":
+                        yield build_local_name_index(element=element), date_updated
+                        element.clear()
+                        root.remove(element)
+            pull_parser.close()
+        except ET.ParseError as pe:
+            print(f"Unable to process streamed xml response using ET.XMLPullParser: {pe}")
             exit()
-        else:
-            return result
 
-    def handle_tag_name_excess(xml_extraction_func, element: ET.Element, tag_name: str):
+    def load_feed_cache(cache_file: str) -> dict:
+        """
+        Load the feed cache from the previous run. A missing or unreadable cache is treated as empty.
+        :param cache_file: path to the json cache file
+        :return: dictionary of fips keys and cache record values
         """
-        Use regular expressions to search tag names, containing prepended junk, for desired value at end of tag string.
-        A decorator was not used because I had control over the original function and wasn't working with a
-        pre-existing function whose behavior I could not alter. I thought the decorator would be less obvious.
+        if not os.path.exists(cache_file):
+            return {}
+        try:
+            with open(cache_file, 'r') as handler:
+                return json.load(handler)
+        except (OSError, ValueError) as e:
+            print(f"Unable to load feed cache {cache_file}. Proceeding without cache. {e}")
+            return {}
 
-        :param xml_extraction_func: doit xml extraction function needed for current tag name search
-        :param element: xml element
-        :param tag_name: string tag name being sought
-        :return: None or value that extraction func returns
+    def make_feed_request(session: requests.Session, url: str, headers: dict, stream: bool) -> requests.Response:
         """
-        re_pattern = f"{tag_name}$"  # Junk always begins string and tag is at the end. Money sign indicates search end.
-        for item in element:
-            result = re.search(pattern=re_pattern, string=item.tag)
-            if result:
-                return xml_extraction_func(element=element, tag_name=item.tag)
-            else:
-                continue
-        return None
+        Make a request to a NOAA CAP feed url using the shared session.
+        :param session: pooled requests Session
+        :param url: NOAA CAP feed url for a county
+        :param headers: request headers, used for conditional requests
+        :param stream: when True only the headers are read and the body is left to be streamed by the caller
+        :return: requests Response
+        """
+        return session.get(url=url, headers=headers, stream=stream, timeout=request_timeout_seconds)
 
     def parse_xml_response_to_element(response_xml_str: str) -> ET.Element:
         """
@@ -207,6 +692,21 @@ def main():
         except Exception as e:
             return '1970-01-01 00:00:00'
 
+    def process_geojson_polygon(geometry: dict) -> str:
+        """
+        Process a GeoJSON polygon geometry for entry into SQL database as WKT and return, or return "'Null'".
+        GeoJSON positions are already longitude, latitude so, unlike the Atom polygon text, no switch is needed.
+        Only the exterior ring of a Polygon is used, matching the single ring CAP polygons in the county feeds.
+        :param geometry: GeoJSON geometry object, or None when the alert has no geometry
+        :return: string for entry in database
+        """
+        if not geometry or geometry.get("type") != "Polygon" or not geometry.get("coordinates"):
+            return "'Null'"
+        coords_for_database_use = ",".join([f"{longitude} {latitude}"
+                                            for longitude, latitude, *_ in geometry["coordinates"][0]])
+        return """geometry::STGeomFromText('POLYGON(({coords_joined}))', 4326)""".format(
+            coords_joined=coords_for_database_use)
+
     def process_polygon_elem_result(poly_elem: ET.Element) -> str:
         """
         Process geometry value for entry into SQL database as WKT and return, or return "'Null'"
@@ -224,14 +724,27 @@ def main():
         if poly_elem.text is None:
             return "'Null'"  # Appears that database requires Null and not nan or other entry when no geometry
         else:
-            poly_values = poly_elem.text
-            coord_pairs_list = poly_values.split(" ")
-            coord_pairs_list_switched = [f"""{value.split(',')[1]} {value.split(',')[0]}""" for value in
-                                         coord_pairs_list]
-            coords_for_database_use = ",".join(coord_pairs_list_switched)
-            result = """geometry::STGeomFromText('POLYGON(({coords_joined}))', 4326)""".format(
-                coords_joined=coords_for_database_use)
-            return result
+            return convert_polygon_text_to_wkt(poly_values=poly_elem.text)
+
+    def process_statewide_response(response: requests.Response, fips_values: list) -> dict:
+        """
+        Process a statewide alerts api response to CAPEntry objects for each county of interest and return them.
+        Any status other than 200 ends the process. Error responses are problem+json with no features, and parsing
+        one would give every county the no active alerts placeholder, clearing the table and the cache.
+        :param response: response from the NWS alerts api
+        :param fips_values: list of string fips values of interest for the process
+        :return: dictionary of fips keys and lists of CAPEntry values
+        """
+        if response.status_code != 200:
+            print(f"Request for {response.url} returned status {response.status_code}: {response.text[:500]}"
+                  f"\nExiting process...")
+            exit()
+        try:
+            response_json = response.json()
+        except ValueError as ve:
+            print(f"Response to json raised error: {ve}\nResponse: {response}\nExiting process...")
+            exit()
+        return create_county_alerts_from_geojson(response_json=response_json, fips_values=fips_values)
 
     def replace_problematic_chars_w_underscore(string: str) -> str:
         """
@@ -246,6 +759,91 @@ def main():
             string = string.replace(char, "_")
         return string
 
+    def request_county_alerts(session: requests.Session, fips: str, url: str, cached_feed: dict) -> CountyFeedResult:
+        """
+        Request a county feed and parse its entries to CAPEntry objects. Runs in a worker thread.
+        The body is read and parsed here, streamed or in full, so feeds are parsed concurrently and the connection is
+        released to the pool before the worker returns. When the feed is unchanged since it was cached no alerts are
+        returned and the cached alerts are reused by the caller.
+        Alerts covering several counties are only parsed for the first county feed they appear in.
+        :param session: pooled requests Session
+        :param fips: fips code of the county the feed is for
+        :param url: NOAA CAP feed url for the county
+        :param cached_feed: cache record for the county feed, or None when the feed has not been cached
+        :return: CountyFeedResult dataclass object
+        """
+        response = make_feed_request(session=session,
+                                     url=url,
+                                     headers=create_conditional_request_headers(cached_feed=cached_feed),
+                                     stream=STREAMING_XML_PARSE)
+        result = CountyFeedResult(response=response)
+        if response.status_code == 304 and cached_feed is not None:
+            response.close()
+            return result
+
+        result.alerts = []
+        feed_parse_start = time.perf_counter()
+        if STREAMING_XML_PARSE:
+            entry_index_generator = iterate_streamed_entry_indexes(response=response)
+        else:
+            entry_index_generator = iterate_entry_indexes(response_xml_str=response.text)
+
+        # Extract values of interest from each entry element. Each entry's children are walked once and indexed.
+        for entry_index, date_updated in entry_index_generator:
+            entry_extraction_start = time.perf_counter()
+            entry_key = determine_entry_key(entry_index=entry_index)
+            if entry_key in parsed_alerts_dict:
+                cap_entry = replace(parsed_alerts_dict[entry_key], data_gen=date_updated, fips=fips)
+                result.reuse_count += 1
+            else:
+                cap_entry = create_cap_entry_from_index(entry_index=entry_index, fips=fips, date_updated=date_updated)
+                parsed_alerts_dict[entry_key] = cap_entry
+            result.extraction_seconds += time.perf_counter() - entry_extraction_start
+            result.extraction_count += 1
+            result.alerts.append(cap_entry)
+            if cap_entry.title == no_active_alerts_title:
+                break
+        response.close()
+        result.parse_seconds = time.perf_counter() - feed_parse_start
+        return result
+
+    def save_early_committed_rows(alert_objs: list) -> None:
+        """
+        Record rows committed early in the cache of committed rows and save it right away.
+        The feed cache for this run is only saved after the final commit. Should the run end before then, the next
+        run's snapshot must still include the early rows or it would insert them again and never delete them. Each
+        row replaces the cached row with its key. The validators of the county, and of the statewide request, are
+        cleared so those feeds are requested in full and compared with the cache next run.
+        :param alert_objs: list of CAPEntry dataclass objects just committed
+        :return: None
+        """
+        committed_feed_cache.pop(statewide_cache_key, None)
+        for alert_obj in alert_objs:
+            key = create_row_key(alert_obj=alert_obj)
+            county_cache = committed_feed_cache.setdefault(alert_obj.fips, {"bytes": 0, "alerts": []})
+            county_cache.update(etag=None, last_modified=None)
+            county_cache["alerts"] = [values for values in county_cache["alerts"]
+                                      if create_row_key(alert_obj=CAPEntry(**values)) != key]
+            county_cache["alerts"].append(asdict(alert_obj))
+        if USE_FEED_CACHE:
+            save_feed_cache(cache_file=feed_cache_file_path, cache=committed_feed_cache)
+
+    def save_feed_cache(cache_file: str, cache: dict) -> None:
+        """
+        Write the feed cache for use by the next run. Written to a temporary file first so a failed write
+        does not leave a partial cache behind.
+        :param cache_file: path to the json cache file
+        :param cache: dictionary of fips keys and cache record values
+        :return: None
+        """
+        temporary_file = f"{cache_file}.tmp"
+        try:
+            with open(temporary_file, 'w') as handler:
+                json.dump(cache, handler)
+            os.replace(temporary_file, cache_file)
+        except OSError as e:
+            print(f"Unable to save feed cache {cache_file}. {e}")
+
     def setup_config(cfg_file: str) -> configparser.ConfigParser:
         """
         Instantiate the parser for accessing a config file.
@@ -272,6 +870,17 @@ def main():
             output = sql_insert_string + ",".join(values_in_range)
             yield output
 
+    def truncate_summary(string: str) -> str:
+        """
+        Shorten summary text so it fits in the Summary column of the alerts table and return it.
+        Text longer than summary_max_length is cut, with '...' marking that it continues.
+        :param string: summary text
+        :return: text of at most summary_max_length characters
+        """
+        if len(string) <= summary_max_length:
+            return string
+        return f"{string[:summary_max_length - 3].rstrip()}..."
+
     def time_elapsed(start=datetime.now()):
         """
         Calculate the difference between datetime.now() value and a start datetime value
@@ -298,152 +907,22 @@ def main():
                                                               mdc_code_template=mdc_code_template,
                                                               fips_values=noaa_fips_values)
 
-    # need to make requests to noaa urls to get xml for interrogation and data extraction
-    for fips, noaa_cap_alert_url in noaa_cap_alerts_urls_dict.items():
-        response = requests.get(url=noaa_cap_alert_url)
-        xml_response_root = parse_xml_response_to_element(response_xml_str=response.text)
-        entry_element = handle_tag_name_excess(xml_extraction_func=extract_all_immediate_child_features_from_element,
-                                               element=xml_response_root,
-                                               tag_name="entry")
-        doc_updated_element = handle_tag_name_excess(
-            xml_extraction_func=extract_first_immediate_child_feature_from_element,
-            element=xml_response_root,
-            tag_name="updated")
-
-        # ignored time zone and dst etc conversions at time of redesign. Possible TODO
-        date_updated = process_date_string(date_string=doc_updated_element.text)
-
-        # Extract values of interest from the entry element that was extracted in a previous step
-        for data in entry_element:
-            title_text = handle_tag_name_excess(xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                                                element=data,
-                                                tag_name="title").text
-            title_text_processed = replace_problematic_chars_w_underscore(string=title_text)
+    # need the cached validators and alerts from the previous run so unchanged feeds are not downloaded and parsed
+    feed_cache = load_feed_cache(cache_file=feed_cache_file_path) if USE_FEED_CACHE else {}
 
-            print(f"{fips}: {title_text_processed}")
-            if title_text_processed == "There are no active watches, warnings or advisories":
-                alert_objects.append(CAPEntry(data_gen=date_updated, fips=fips, title=title_text_processed))
-                break
-            else:
-                cap_area_desc = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="areaDesc").text
-                cap_area_desc_processed = replace_problematic_chars_w_underscore(string=cap_area_desc)
-
-                cap_certainty = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="certainty").text
-
-                cap_effective = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="effective").text
-                cap_effective_processed = process_date_string(date_string=cap_effective)
-
-                cap_event = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="event").text
-
-                cap_expires = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="expires").text
-                cap_expires_processed = process_date_string(date_string=cap_expires)
-
-                cap_msg_type = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="msgType").text
-
-                cap_polygon_elem = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="polygon")
-                cap_polygon = process_polygon_elem_result(poly_elem=cap_polygon_elem)
-
-                cap_severity = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="severity").text
-
-                cap_status = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="status").text
-
-                cap_urgency = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="urgency").text
-
-                link = handle_tag_name_excess(xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                                              element=data,
-                                              tag_name="link").attrib.get("href", np.NaN)
-
-                published = handle_tag_name_excess(
-                    xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                    element=data,
-                    tag_name="published").text
-                published_processed = process_date_string(date_string=published)
-
-                summary = handle_tag_name_excess(xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                                                 element=data,
-                                                 tag_name="summary").text
-                summary_processed = replace_problematic_chars_w_underscore(string=summary)
-
-                updated = handle_tag_name_excess(xml_extraction_func=extract_first_immediate_child_feature_from_element,
-                                                 element=data,
-                                                 tag_name="updated").text
-                updated_processed = process_date_string(date_string=updated)
-
-                # Create CAPEntry dataclass objects and store for use in SQL VALUES building for INSERT statement
-                alert_objects.append(CAPEntry(cap_area_desc=cap_area_desc_processed,
-                                              cap_certainty=cap_certainty,
-                                              cap_effective=cap_effective_processed,
-                                              cap_event=cap_event,
-                                              cap_expires=cap_expires_processed,
-                                              cap_msg_type=cap_msg_type,
-                                              cap_polygon=cap_polygon,
-                                              cap_severity=cap_severity,
-                                              cap_status=cap_status,
-                                              cap_urgency=cap_urgency,
-                                              data_gen=date_updated,
-                                              fips=fips,
-                                              link=link,
-                                              published=published_processed,
-                                              summary=summary_processed,
-                                              title=title_text_processed,
-                                              updated=updated_processed)
-                                     )
-    print(f"Requests, data capture, and processing completed. Time elapsed {time_elapsed(start=start)}")
+    # need a copy of the cache, as committed, that high priority rows written early are added to as they commit
+    committed_feed_cache = copy.deepcopy(feed_cache)
 
-    # Need to build the values string statements for use later on with SQL INSERT statement.
-    for alert_obj in alert_objects:
-        values = sql_values_string_template.format(title=alert_obj.title,
-                                                   link=alert_obj.link,
-                                                   published=alert_obj.published,
-                                                   updated=alert_obj.updated,
-                                                   summary=alert_obj.summary,
-                                                   cap_effective=alert_obj.cap_effective,
-                                                   cap_expires=alert_obj.cap_expires,
-                                                   cap_status=alert_obj.cap_status,
-                                                   cap_msg_type=alert_obj.cap_msg_type,
-                                                   cap_urgency=alert_obj.cap_urgency,
-                                                   cap_severity=alert_obj.cap_severity,
-                                                   cap_certainty=alert_obj.cap_certainty,
-                                                   cap_area_desc=alert_obj.cap_area_desc,
-                                                   fips=alert_obj.fips,
-                                                   cap_event=alert_obj.cap_event,
-                                                   cap_geometry=alert_obj.cap_polygon,
-                                                   data_gen=alert_obj.data_gen)
-        values_string = sql_values_statement.format(values=values)
-        sql_values_statements_list.append(values_string)
+    # need the rows committed on the previous run, before the cache is refreshed, to compare this run's rows against.
+    #   When a full reload is due there is no comparison and the table is deleted and reloaded.
+    full_reload_is_due = determine_full_reload_is_due(cache=feed_cache, now=start)
+    previous_rows_dict = None
+    if DIFFERENTIAL_LOAD and not full_reload_is_due:
+        previous_rows_dict = create_rows_snapshot_from_cache(cache=feed_cache,
+                                                             fips_values=list(noaa_cap_alerts_urls_dict))
 
-    # Database Transactions
-    print(f"\nDatabase operations initiated. Time elapsed {time_elapsed(start=start)}")
+    # need database identity and the insert statement before the requests so high priority alerts can be written
+    #   as soon as they are parsed
     database_name = config_parser[database_cfg_section_name]["NAME"]
     database_password = config_parser[database_cfg_section_name]["PASSWORD"]
     database_user = config_parser[database_cfg_section_name]["USER"]
@@ -454,10 +933,167 @@ def main():
 
     # need the sql table headers as comma separated string values for use in the INSERT statement
     headers_joined = ",".join([f"{val}" for val in realtime_noaacapalerts_headers])
-    sql_delete_string = sql_delete_template.format(table=database_table_name)
     sql_insert_string = sql_insert_template.format(
         table=database_table_name,
         headers_joined=headers_joined)
+    early_commit_connection = pyodbc.connect(full_connection_string) if EARLY_COMMIT_HIGH_PRIORITY else None
+
+    if REPORT_PARSE_MEMORY:
+        tracemalloc.start()
+
+    session = create_pooled_session(pool_size=MAX_CONCURRENT_REQUESTS)
+    if INGESTION_MODE == "statewide":
+
+        # need one request for every active Maryland alert. Alerts are assigned to counties using their geocodes.
+        statewide_cached_feed = feed_cache.get(statewide_cache_key)
+        statewide_request_headers = {**noaa_statewide_request_headers,
+                                     **create_conditional_request_headers(cached_feed=statewide_cached_feed)}
+        try:
+            response = make_feed_request(session=session,
+                                         url=noaa_statewide_url,
+                                         headers=statewide_request_headers,
+                                         stream=False)
+        except Exception as e:
+            print(f"Exception during request for {noaa_statewide_url}. {e}")
+            exit()
+        feed_request_count += 1
+
+        # A 304 response means no alert changed statewide so every county's cached alerts are reused.
+        if response.status_code == 304 and statewide_cached_feed is not None:
+            print(f"Statewide alerts not modified. Reusing cached entries")
+            for fips in noaa_cap_alerts_urls_dict:
+                alert_objects.extend([CAPEntry(**values) for values in feed_cache.get(fips, {}).get("alerts", [])])
+            feed_cache_bytes_saved += statewide_cached_feed.get("bytes", 0)
+            feed_cache_hit_count += 1
+        else:
+            feed_parse_start = time.perf_counter()
+            county_alerts_dict = process_statewide_response(response=response,
+                                                            fips_values=list(noaa_cap_alerts_urls_dict))
+            feed_parse_seconds += time.perf_counter() - feed_parse_start
+            for fips, county_alert_objects in county_alerts_dict.items():
+                for cap_entry in county_alert_objects:
+                    print(f"{fips}: {cap_entry.title}")
+                alert_objects.extend(county_alert_objects)
+                entry_extraction_count += len(county_alert_objects)
+
+                # Only counties whose alerts differ from the cached alerts count as changed
+                county_alert_values = [asdict(alert_obj) for alert_obj in county_alert_objects]
+                if determine_alerts_changed(cached_feed=feed_cache.get(fips), county_alert_values=county_alert_values):
+                    changed_fips_list.append(fips)
+                feed_cache[fips] = {"etag": None, "last_modified": None, "bytes": 0, "alerts": county_alert_values}
+                if early_commit_connection is not None:
+                    commit_high_priority_alerts(connection=early_commit_connection, alert_objs=county_alert_objects)
+            feed_cache[statewide_cache_key] = {"etag": response.headers.get("ETag"),
+                                               "last_modified": response.headers.get("Last-Modified"),
+                                               "bytes": response.raw.tell(),
+                                               "alerts": []}
+    else:
+
+        # need to make requests to noaa urls to get xml for interrogation and data extraction. Requests are made
+        #   concurrently over one pooled session and each feed is read and parsed in its worker. Results are handled,
+        #   in this thread, as soon as they arrive.
+        executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+        future_to_fips_dict = {executor.submit(request_county_alerts,
+                                               session,
+                                               fips,
+                                               noaa_cap_alert_url,
+                                               feed_cache.get(fips)): fips
+                               for fips, noaa_cap_alert_url in noaa_cap_alerts_urls_dict.items()}
+        feed_request_count += len(future_to_fips_dict)
+        for future in as_completed(future_to_fips_dict):
+            fips = future_to_fips_dict[future]
+            try:
+                county_feed_result = future.result()
+            except Exception as e:
+                print(f"Exception during request for {noaa_cap_alerts_urls_dict[fips]}. {e}")
+                exit()
+            response = county_feed_result.response
+
+            # A 304 response means the feed is unchanged since it was cached so the cached alerts are reused.
+            cached_feed = feed_cache.get(fips)
+            if county_feed_result.alerts is None:
+                county_alert_objects = [CAPEntry(**values) for values in cached_feed["alerts"]]
+                print(f"{fips}: Not modified. Reusing {len(county_alert_objects)} cached entries")
+                alert_objects.extend(county_alert_objects)
+                feed_cache_bytes_saved += cached_feed.get("bytes", 0)
+                feed_cache_hit_count += 1
+                continue
+
+            county_alert_objects = county_feed_result.alerts
+            for cap_entry in county_alert_objects:
+                print(f"{fips}: {cap_entry.title}")
+            entry_extraction_count += county_feed_result.extraction_count
+            entry_extraction_seconds += county_feed_result.extraction_seconds
+            entry_reuse_count += county_feed_result.reuse_count
+            feed_parse_seconds += county_feed_result.parse_seconds
+            alert_objects.extend(county_alert_objects)
+            if early_commit_connection is not None:
+                commit_high_priority_alerts(connection=early_commit_connection, alert_objs=county_alert_objects)
+
+            # Only counties whose alerts differ from the cached alerts count as changed
+            county_alert_values = [asdict(alert_obj) for alert_obj in county_alert_objects]
+            if determine_alerts_changed(cached_feed=cached_feed, county_alert_values=county_alert_values):
+                changed_fips_list.append(fips)
+            feed_cache[fips] = {"etag": response.headers.get("ETag"),
+                                "last_modified": response.headers.get("Last-Modified"),
+                                "bytes": response.raw.tell(),
+                                "alerts": county_alert_values}
+        executor.shutdown()
+    session.close()
+    if early_commit_connection is not None:
+        early_commit_connection.close()
+    print(f"Requests, data capture, and processing completed using {feed_request_count} {INGESTION_MODE} requests. "
+          f"Time elapsed {time_elapsed(start=start)}")
+    print(f"Extracted {entry_extraction_count} entries, {entry_reuse_count} reused from another county. Average "
+          f"extraction time per entry {(entry_extraction_seconds / max(entry_extraction_count, 1)) * 1000:.3f} ms")
+    print(f"Feeds parsed {'streaming' if STREAMING_XML_PARSE else 'as trees'} in {feed_parse_seconds:.3f} seconds")
+    print(f"Polygon conversions {convert_polygon_text_to_wkt.cache_info()}")
+    if REPORT_PARSE_MEMORY:
+        print(f"Peak memory during requests and parsing {tracemalloc.get_traced_memory()[1] / 1024 ** 2:.2f} MB")
+        tracemalloc.stop()
+    print(f"Feed cache hits {feed_cache_hit_count} of {feed_request_count} "
+          f"({feed_cache_hit_count / max(feed_request_count, 1):.0%}). Bytes saved {feed_cache_bytes_saved}. "
+          f"Counties with changed alerts {len(changed_fips_list)}")
+    if high_priority_commit_delays:
+        print(f"High priority alerts committed early {len(high_priority_commit_delays)}. Time to database first "
+              f"{min(high_priority_commit_delays)}, last {max(high_priority_commit_delays)}")
+
+    # Need to determine which rows differ from the previous run. Without a snapshot every row is inserted. Rows
+    #   cannot be compared by key when a key repeats, so a full load is used instead.
+    current_rows_dict, duplicate_row_keys = create_rows_dict(alert_objs=alert_objects)
+    if duplicate_row_keys and previous_rows_dict is not None:
+        print(f"Row keys repeated this run {duplicate_row_keys}. Falling back to a full load")
+        previous_rows_dict = None
+    if previous_rows_dict is None:
+        insert_alert_objects, update_keys, delete_keys = alert_objects, [], []
+    else:
+        insert_keys, update_keys, delete_keys = determine_row_changes(previous_rows=previous_rows_dict,
+                                                                      current_rows=current_rows_dict)
+
+        # Rows committed early this run are already in the table
+        insert_alert_objects = [current_rows_dict[key] for key in insert_keys if key not in early_committed_keys]
+        update_keys = [key for key in update_keys if key not in early_committed_keys]
+
+    # Need to build the values string statements for use later on with SQL INSERT statement.
+    for alert_obj in insert_alert_objects:
+        sql_values_statements_list.append(create_sql_values_string(alert_obj=alert_obj))
+
+    # Database Transactions
+    print(f"\nDatabase operations initiated. Time elapsed {time_elapsed(start=start)}")
+    sql_delete_string = sql_delete_template.format(table=database_table_name)
+
+    # need each header paired with its value placeholder for use in the SET clause of the UPDATE statement
+    sql_update_set_template = ", ".join([f"{header} = {value}" for header, value in
+                                         zip(realtime_noaacapalerts_headers, sql_values_string_template.split(", "))])
+    sql_row_changes_list = [sql_delete_row_template.format(table=database_table_name, link=link, fips=fips)
+                            for link, fips in delete_keys]
+    for key in update_keys:
+        format_values = create_sql_format_values(alert_obj=current_rows_dict[key])
+        sql_row_changes_list.append(sql_update_row_template.format(
+            table=database_table_name,
+            set_values=sql_update_set_template.format(**format_values),
+            link=key[0],
+            fips=key[1]))
 
     # Need the insert statement generator to be ready for database insertion rounds
     sql_insert_gen = sql_insert_generator(sql_values_list=sql_values_statements_list,
@@ -470,31 +1106,64 @@ def main():
     with pyodbc.connect(full_connection_string) as connection:
         cursor = connection.cursor()
 
-        # Due to 1000 record insert limit, delete records first and then do insertion rounds for alerts.
-        # The quantity of alerts can vary in size, assuming this is why the old CGIS process accounted for potential
-        #   insert quantity in excess of 1000 record sql limit. Generally seems to be very few records but doesn't hurt.
-        try:
-            cursor.execute(sql_delete_string)
-        except Exception as e:
-            print(f"Error deleting records from {database_table_name}. {e}")
-            exit()
+        # When no county's alerts changed since the last run the table already holds these alerts, unless it is
+        #   time for the periodic full reload.
+        if not changed_fips_list and not full_reload_is_due:
+            print(f"No county alerts changed. Delete and insert skipped. Time elapsed {time_elapsed(start=start)}")
+        elif previous_rows_dict is not None:
+
+            # Only rows that differ from the previous run are deleted or updated before new rows are inserted.
+            for sql_statement in sql_row_changes_list:
+                try:
+                    cursor.execute(sql_statement)
+                except pyodbc.DataError:
+                    print(f"A value in the sql exceeds the field length allowed in database table.\n{sql_statement}\n")
+                    exit()
+                except pyodbc.Error:
+                    print(f"pyodbc.Error raised while changing records.\n{sql_statement}\n")
+                    exit()
+            for batch in sql_insert_gen:
+                try:
+                    cursor.execute(batch)
+                except pyodbc.DataError:
+                    print(f"A value in the sql exceeds the field length allowed in database table.\n{batch}\n")
+                    exit()
+                except pyodbc.Error:
+                    print(f"pyodbc.Error raised while inserting records.\n{batch}\n")
+                    exit()
+            print(f"Differential load executed. Rows inserted {len(insert_alert_objects)}, updated {len(update_keys)}, "
+                  f"deleted {len(delete_keys)}. Time elapsed {time_elapsed(start=start)}")
         else:
-            print(f"Delete statement executed. Time elapsed {time_elapsed(start=start)}")
 
-        # Need insert statement in rounds of 1000 records or less to avoid sql limit
-        insert_round_count = 1
-        for batch in sql_insert_gen:
+            # Due to 1000 record insert limit, delete records first and then do insertion rounds for alerts.
+            # The quantity of alerts can vary in size, assuming this is why the old CGIS process accounted for
+            #   potential insert quantity in excess of 1000 record sql limit. Generally seems to be very few records
+            #   but doesn't hurt.
             try:
-                cursor.execute(batch)
-            except pyodbc.DataError:
-                print(f"A value in the sql exceeds the field length allowed in database table.\n{batch}\n")
-                exit()
-            except pyodbc.Error:
-                print(f"pyodbc.Error raised while inserting records.\n{batch}\n")
+                cursor.execute(sql_delete_string)
+            except Exception as e:
+                print(f"Error deleting records from {database_table_name}. {e}")
                 exit()
             else:
-                print(f"Executing insert batch {insert_round_count}. Time elapsed {time_elapsed(start=start)}")
-                insert_round_count += 1
+                print(f"Delete statement executed. Time elapsed {time_elapsed(start=start)}")
+
+            # Need insert statement in rounds of 1000 records or less to avoid sql limit
+            insert_round_count = 1
+            for batch in sql_insert_gen:
+                try:
+                    cursor.execute(batch)
+                except pyodbc.DataError:
+                    print(f"A value in the sql exceeds the field length allowed in database table.\n{batch}\n")
+                    exit()
+                except pyodbc.Error:
+                    print(f"pyodbc.Error raised while inserting records.\n{batch}\n")
+                    exit()
+                else:
+                    print(f"Executing insert batch {insert_round_count}. Time elapsed {time_elapsed(start=start)}")
+                    insert_round_count += 1
+            print(f"Full load executed. Rows inserted {len(insert_alert_objects)}. "
+                  f"Time elapsed {time_elapsed(start=start)}")
+            feed_cache[full_reload_cache_key] = start_date_time
 
         # Need to update the task tracker table to record last run time
         try:
@@ -505,6 +1174,10 @@ def main():
         connection.commit()
         print(f"Commit successful. Time elapsed {time_elapsed(start=start)}")
 
+    # Cache is only saved once the alerts it holds are committed to the database
+    if USE_FEED_CACHE:
+        save_feed_cache(cache_file=feed_cache_file_path, cache=feed_cache)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,215 @@
+"""
+Tests for the statewide response handling and polygon conversion of doit_NOAACapAlerts.
+The functions are nested in main() so they cannot be imported. The ones under test are compiled on their own from the
+script source, with the few names they use from main() supplied in their namespace. Responses come from a stand-in
+server on the local machine.
+"""
+import ast
+from dataclasses import dataclass, replace
+from dateutil import parser as date_parser
+from functools import lru_cache
+import http.server
+import json
+import numpy as np
+import os
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import unittest
+
+script_file_path = os.path.join(os.path.dirname(__file__), "doit_NOAACapAlerts.py")
+fips_values = ["24001", "24003", "24005"]
+statewide_error_json = {"title": "Service Unavailable",
+                        "type": "https://api.weather.gov/problems/ServiceUnavailable",
+                        "status": 503}
+statewide_json = {"type": "FeatureCollection",
+                  "updated": "2026-10-16T14:00:00+00:00",
+                  "features": [{"id": "https://api.weather.gov/alerts/urn-1",
+                                "geometry": {"type": "Polygon",
+                                             "coordinates": [[[-78.9, 39.5], [-78.9, 39.7], [-78.5, 39.7],
+                                                              [-78.9, 39.5]]]},
+                                "properties": {"@id": "https://api.weather.gov/alerts/urn-1",
+                                               "areaDesc": "Allegany; Anne Arundel",
+                                               "certainty": "Likely",
+                                               "description": "Flooding is expected.",
+                                               "effective": "2026-10-16T10:00:00-04:00",
+                                               "event": "Flood Warning",
+                                               "expires": "2026-10-16T20:00:00-04:00",
+                                               "geocode": {"SAME": ["024001"], "UGC": ["MDC003", "MDZ001"]},
+                                               "headline": "Flood Warning issued October 16",
+                                               "messageType": "Alert",
+                                               "sent": "2026-10-16T10:00:00-04:00",
+                                               "severity": "Moderate",
+                                               "status": "Actual",
+                                               "urgency": "Expected"}}]}
+
+
+class StatewideHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the NWS alerts api. /alerts answers with the GeoJSON payload and /error with problem+json"""
+    def do_GET(self):
+        if self.path.startswith("/alerts"):
+            status, content_type, body = 200, "application/geo+json", statewide_json
+        else:
+            status, content_type, body = 503, "application/problem+json", statewide_error_json
+        body_bytes = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body_bytes)))
+        self.end_headers()
+        self.wfile.write(body_bytes)
+
+    def log_message(self, *args):
+        pass
+
+
+def convert_polygon_text_to_wkt_previous(poly_values: str) -> str:
+    """
+    Convert CAP polygon text to the geometry sql the way the script did before the columns were switched by slicing.
+    Kept as the reference the current conversion must match.
+    :param poly_values: polygon text from the CAP polygon element
+    :return: string for entry in database
+    """
+    coord_pairs_list = poly_values.split(" ")
+    coord_pairs_list_switched = [f"""{value.split(',')[1]} {value.split(',')[0]}""" for value in coord_pairs_list]
+    coords_for_database_use = ",".join(coord_pairs_list_switched)
+    return """geometry::STGeomFromText('POLYGON(({coords_joined}))', 4326)""".format(
+        coords_joined=coords_for_database_use)
+
+
+def create_polygon_text(vertex_count: int) -> str:
+    """
+    Create closed CAP polygon text of latitude,longitude pairs with values of mixed precision.
+    :param vertex_count: number of distinct vertices in the ring
+    :return: polygon text
+    """
+    generator = random.Random(vertex_count)
+    coord_pairs = [f"{round(generator.uniform(37.8, 39.8), generator.randint(0, 6))},"
+                   f"{round(generator.uniform(-79.5, -75.0), generator.randint(0, 6))}" for _ in range(vertex_count)]
+    return " ".join(coord_pairs + coord_pairs[:1])
+
+
+def load_nested_definitions(names: set) -> dict:
+    """
+    Compile the named functions and classes nested in main() of the script and return the namespace holding them.
+    :param names: names of the nested functions and classes to compile
+    :return: dictionary namespace of the compiled definitions and the names they use
+    """
+    with open(script_file_path, 'r') as handler:
+        tree = ast.parse(handler.read())
+    main_node = next(node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == "main")
+    namespace = {"HTTPAdapter": HTTPAdapter,
+                 "dataclass": dataclass,
+                 "date_parser": date_parser,
+                 "lru_cache": lru_cache,
+                 "no_active_alerts_title": "There are no active watches, warnings or advisories",
+                 "np": np,
+                 "polygon_wkt_cache_size": 512,
+                 "replace": replace,
+                 "request_timeout_seconds": 30,
+                 "requests": requests,
+                 "summary_max_length": 250}
+    for node in main_node.body:
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef)) and node.name in names:
+            exec(compile(ast.Module(body=[node], type_ignores=[]), script_file_path, "exec"), namespace)
+    return namespace
+
+
+class TestStatewideResponse(unittest.TestCase):
+    """"""
+    def setUp(self):
+        self.functions = load_nested_definitions(names={"CAPEntry",
+                                                        "create_cap_entry_from_feature",
+                                                        "create_county_alerts_from_geojson",
+                                                        "create_pooled_session",
+                                                        "determine_feature_fips_values",
+                                                        "make_feed_request",
+                                                        "process_date_string",
+                                                        "process_geojson_polygon",
+                                                        "process_statewide_response",
+                                                        "replace_problematic_chars_w_underscore",
+                                                        "truncate_summary"})
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StatewideHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.session = self.functions["create_pooled_session"](pool_size=1)
+        self.url_template = f"http://127.0.0.1:{self.server.server_address[1]}/{{path}}"
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request_statewide(self, path: str) -> requests.Response:
+        """
+        Request a path from the stand-in server the way the script requests the statewide alerts.
+        :param path: path on the stand-in server
+        :return: requests Response
+        """
+        return self.functions["make_feed_request"](session=self.session,
+                                                   url=self.url_template.format(path=path),
+                                                   headers={"Accept": "application/geo+json"},
+                                                   stream=False)
+
+    def test_alerts_payload(self):
+        """
+        A 200 GeoJSON response gives the alert to each county named by its SAME and UGC county codes and the
+        placeholder entry to the others.
+        :return:
+        """
+        county_alerts_dict = self.functions["process_statewide_response"](
+            response=self.request_statewide(path="alerts/active?area=MD"),
+            fips_values=fips_values)
+        self.assertEqual(list(county_alerts_dict), fips_values)
+        for fips in ("24001", "24003"):
+            alert_obj, = county_alerts_dict[fips]
+            self.assertEqual(alert_obj.fips, fips)
+            self.assertEqual(alert_obj.cap_event, "Flood Warning")
+            self.assertEqual(alert_obj.title, "Flood Warning issued October 16")
+            self.assertEqual(alert_obj.cap_polygon,
+                             "geometry::STGeomFromText('POLYGON((-78.9 39.5,-78.9 39.7,-78.5 39.7,-78.9 39.5))', 4326)")
+        placeholder_obj, = county_alerts_dict["24005"]
+        self.assertEqual(placeholder_obj.title, "There are no active watches, warnings or advisories")
+        self.assertEqual(placeholder_obj.data_gen, "2026-10-16 14:00:00")
+
+    def test_error_payload(self):
+        """
+        A 503 problem+json response has no features. The process ends rather than giving every county the
+        placeholder entry, which would clear the table and the cache.
+        :return:
+        """
+        with self.assertRaises(SystemExit):
+            self.functions["process_statewide_response"](response=self.request_statewide(path="error"),
+                                                         fips_values=fips_values)
+
+
+
+class TestPolygonConversion(unittest.TestCase):
+    """"""
+    def setUp(self):
+        self.functions = load_nested_definitions(names={"convert_polygon_text_to_wkt"})
+
+    def test_matches_previous_conversion(self):
+        """
+        The sliced conversion gives exactly the text the previous per pair conversion gave, for small and very
+        detailed polygons.
+        :return:
+        """
+        for vertex_count in (10, 1000, 20000):
+            poly_values = create_polygon_text(vertex_count=vertex_count)
+            with self.subTest(vertex_count=vertex_count):
+                self.assertEqual(self.functions["convert_polygon_text_to_wkt"](poly_values=poly_values),
+                                 convert_polygon_text_to_wkt_previous(poly_values=poly_values))
+
+    def test_cached_conversion(self):
+        """
+        A repeated polygon is answered from the bounded cache with the same text.
+        :return:
+        """
+        poly_values = create_polygon_text(vertex_count=10)
+        first_result = self.functions["convert_polygon_text_to_wkt"](poly_values=poly_values)
+        self.assertEqual(self.functions["convert_polygon_text_to_wkt"](poly_values=poly_values), first_result)
+        cache_info = self.functions["convert_polygon_text_to_wkt"].cache_info()
+        self.assertEqual((cache_info.hits, cache_info.maxsize), (1, 512))
+
+if __name__ == "__main__":
+    unittest.main()
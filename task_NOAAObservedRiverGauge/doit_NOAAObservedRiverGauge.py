@@ -9,45 +9,178 @@ generate the values in the insert sql statement. Once the insert statement is co
 is established, all existing records are deleted, and the new records are inserted.
 Redesigned from the original CGIS version when MEMA server environments were being migrated to new versions.
 Author: CJuice, 20190327
-Revisions:
-
+Revisions: 20261016, Gauges are joined to the active NOAA CAP alert polygons in process rather than by a spatial join
+    in the database on every dashboard refresh. Polygons written by the NOAA CAP Alerts process are selected as WKT,
+    gauge points are indexed by sorted longitude so each polygon bounding box selects its candidate gauges, and the
+    candidates are tested with a vectorized ray casting point in polygon test. The gauge to alert mapping is written
+    to its own table in the same transaction as the gauges.
+20261016, Replaced the single pretty printed query, which the server silently truncated at its maximum record count,
+    with a paging query client. The layer's maxRecordCount is read, the object ids are requested first to learn the
+    feature count, and pages ordered by object id are requested concurrently over a pooled keep-alive session as
+    compact gzip json. A page the server cuts short with exceededTransferLimit is continued from where it stopped.
+    Layers without pagination support are paged by chunks of object ids instead. Each page's features become Gauge
+    objects as the page arrives and a count that does not match the object ids is reported.
+20261016, Added a protocol buffer response format. When RESPONSE_FORMAT is "pbf" the pages are requested as the
+    esri FeatureCollectionPBuffer and decoded from the protobuf wire format directly, without a protobuf dependency.
+    Attributes come from the typed values in field order and the point coordinates from the quantized geometry using
+    the result's transform. The json format is used when the layer does not list PBF among its query formats.
+20261016, Added an incremental fetch. The latest observation time and every gauge's last values are kept in a local
+    json cache. Runs add an obstime greater than the cached watermark predicate to the where clause and upsert only the
+    returned gauges whose values changed, deleting and reinserting their rows by GaugeID. A full reconciliation sweep,
+    with the original delete and insert of every row, is run when there is no cache, when
+    FULL_REFRESH_INTERVAL_HOURS have passed since the last one, or when INCREMENTAL_FETCH is False. The alert polygon
+    join uses every cached gauge. Payload bytes received and rows written are printed for both modes.
+20261016, The observed stage and the flood, moderate, and major stage thresholds are kept on the Gauge instead of being
+    discarded. The flood category and the observed stage as a percent of flood stage are computed for the rows to be
+    written in one vectorized pass and written to the FloodCategory and PercentFloodStage columns, so they are no
+    longer computed in sql on every dashboard query. Both are NULL when a stage is unknown.
+20261016, Added linking of gauges to the nearest USGS stream gauge site. Active USGS stream sites and their locations
+    are requested from the NWIS site service for the surrounding states and cached in a local json file that is
+    refreshed after USGS_SITES_REFRESH_DAYS. The sites are indexed in a grid of cells as wide as the distance limit so
+    every gauge's candidate sites, those in its cell and the eight around it, are found in one vectorized pass and
+    the nearest by haversine distance within USGS_LINK_MAX_DISTANCE_KM is kept. The links are written to their own
+    table in the same transaction as the gauges, replacing the nearest neighbor query in sql.
+20261016, Date quality control is done for all gauges at once. The obstime values are converted in one vectorized
+    call using the known format and only values that do not match are parsed individually with dateutil. Invalid values
+    are reported as a single count instead of a line per gauge. The converted times also give the watermark.
+20261016, The gauge to alert polygon join is written in its own transaction after the gauges are committed and is
+    rolled back alone on a database error. JOIN_GAUGES_TO_ALERT_POLYGONS is False by default since its table must be
+    created before it is enabled.
+20261016, The incremental fetch watermark is kept in the known date format rather than as the raw obstime value, since
+    the server compares obstime as text and a value in another form, such as ISO 8601 with a T, compared out of order.
+20261016, The FloodCategory and PercentFloodStage columns are written only when WRITE_FLOOD_CATEGORIES is True, which
+    is False until the columns are added to the gauges table.
+20261016, The gauge links to USGS sites are written in their own transaction after the gauges are committed and are
+    rolled back alone on a database error. LINK_GAUGES_TO_USGS_SITES is False by default since its table must be
+    created before it is enabled.
+20261016, Observation times parsed with a UTC offset, like a trailing Z, are converted to UTC instead of having the
+    offset dropped, so they order correctly among the values without one and give the right watermark.
+20261016, Empty alert geometries are no longer selected for the gauge to alert polygon join, and geometries that are
+    not polygons are skipped. Malformed polygon text now rolls back the join alone instead of ending the process.
+20261016, Rows are inserted in rounds of 1000 records or less, the sql limit for a single INSERT, for the gauges and
+    for the alert join and USGS links. A DataError or ProgrammingError in any round rolls back the whole gauge
+    transaction so earlier rounds are not committed when the connection closes. A full refresh with no gauges only
+    deletes.
 """
 
 
 def main():
 
     # IMPORTS
-    from dataclasses import dataclass
-    from datetime import datetime
+    from concurrent.futures import ThreadPoolExecutor
+    from dataclasses import asdict, astuple, dataclass
+    from datetime import datetime, timedelta, timezone
     import configparser
+    import json
+    import numpy as np
     import os
+    import pandas as pd
     import pyodbc
     import requests
     from dateutil import parser as date_parser
+    from requests.adapters import HTTPAdapter
+    import struct
 
     # VARIABLES
+    FULL_REFRESH_INTERVAL_HOURS = 24  # OPTION
+    INCREMENTAL_FETCH = True  # OPTION
+    JOIN_GAUGES_TO_ALERT_POLYGONS = False  # OPTION, requires the RealTime_NOAAObservedRiverGaugeAlerts table
+    LINK_GAUGES_TO_USGS_SITES = False  # OPTION, requires the RealTime_NOAAUSGSGaugeLinks table
+    MAX_CONCURRENT_REQUESTS = 4  # OPTION
+    RESPONSE_FORMAT = "json"  # OPTION
+    USGS_LINK_MAX_DISTANCE_KM = 2.0  # OPTION
+    USGS_SITES_REFRESH_DAYS = 7  # OPTION
+    WRITE_FLOOD_CATEGORIES = False  # OPTION, requires the FloodCategory and PercentFloodStage columns
+
     _root_file_path = os.path.dirname(__file__)
+    alert_polygons_list = []
+    changed_gauges_list = []
     config_file = r"doit_config_NOAAObservedRiverGauge.cfg"
     config_file_path = os.path.join(_root_file_path, config_file)
     database_connection_string = "DSN={database_name};UID={database_user};PWD={database_password}"
+    date_time_format = '%Y-%m-%d %H:%M:%S'
+    earth_radius_km = 6371.0088
+    gauge_cache_file = r"doit_cache_NOAAObservedRiverGauge.json"
+    gauge_cache_file_path = os.path.join(_root_file_path, gauge_cache_file)
     gauge_objects_list = []
+    invalid_date_time_value = "1970-01-01 00:00:00"
+    noaa_layer_url = r"https://idpgis.ncep.noaa.gov/arcgis/rest/services/NWS_Observations/ahps_riv_gauges/MapServer/0"
     noaa_query_payload = {"where": "state = 'MD'",
                           "outFields": "gaugelid,state,location,observed,obstime,status,flood,moderate,major",
                           "returnGeometry": "true",
-                          "f": "pjson"}
-    noaa_url = r"https://idpgis.ncep.noaa.gov/arcgis/rest/services/NWS_Observations/ahps_riv_gauges/MapServer/0/query?"
-    realtime_noaaobservedrivergauge_headers = ("GaugeID", "Location", "Status", "X", "Y", "DataGenerated")
+                          "f": "json"}
+    noaa_request_headers = {"Accept-Encoding": "gzip"}
+    noaa_url = f"{noaa_layer_url}/query"
+    payload_bytes_total = 0
+    pbf_value_decoders_dict = {1: lambda value: bytes(value).decode("utf-8"),
+                               2: lambda value: struct.unpack("<f", value)[0],
+                               3: lambda value: struct.unpack("<d", value)[0],
+                               4: lambda value: (value >> 1) ^ -(value & 1),
+                               5: lambda value: value,
+                               6: lambda value: value - (1 << 64) if value >= (1 << 63) else value,
+                               7: lambda value: value,
+                               8: lambda value: (value >> 1) ^ -(value & 1),
+                               9: lambda value: bool(value)}
+    realtime_noaacapalerts_tbl = "[{database_name}].[dbo].[RealTime_NOAACapALerts]"
+    flood_categories = ("Major", "Moderate", "Minor", "Normal")
+    realtime_noaaobservedrivergauge_headers = ("GaugeID", "Location", "Status", "X", "Y", "DataGenerated") + (
+        ("FloodCategory", "PercentFloodStage") if WRITE_FLOOD_CATEGORIES else ())
     realtime_noaaobservedrivergauge_tbl = "[{database_name}].[dbo].[RealTime_NOAAObservedRiverGauges]"
-    sql_delete_insert_template = """DELETE FROM {table}; INSERT INTO {table} ({headers_joined}) VALUES """
+    realtime_noaaobservedrivergaugealerts_headers = ("GaugeID", "URL", "Event", "DataGenerated")
+    realtime_noaaobservedrivergaugealerts_tbl = "[{database_name}].[dbo].[RealTime_NOAAObservedRiverGaugeAlerts]"
+    realtime_noaausgsgaugelinks_headers = ("GaugeID", "SiteNumber", "DistanceKm", "DataGenerated")
+    realtime_noaausgsgaugelinks_tbl = "[{database_name}].[dbo].[RealTime_NOAAUSGSGaugeLinks]"
+    sql_delete_gauges_template = """DELETE FROM {table} WHERE GaugeID IN ({gauge_ids}); """
+    sql_delete_template = """DELETE FROM {table};"""
+    sql_insert_template = """INSERT INTO {table} ({headers_joined}) VALUES """
+    sql_insertion_step_increment = 1000
+    sql_select_alert_polygons_template = """SELECT DISTINCT URL, Event, geometry.STAsText() FROM {table}
+    WHERE geometry IS NOT NULL AND geometry.STIsEmpty() = 0;"""
     sql_values_statement = """({values})"""
     sql_values_statements_list = []
-    sql_values_string_template = """'{gaugelid}', '{location}', '{status}', {longitude}, {latitude}, '{data_gen}'"""
+    sql_values_string_template = """'{gaugelid}', '{location}', '{status}', {longitude}, {latitude}, '{data_gen}'""" + (
+        """, {flood_category}, {percent_flood_stage}""" if WRITE_FLOOD_CATEGORIES else "")
+    sql_gauge_alert_values_string_template = """'{gaugelid}', '{link}', '{event}', '{data_gen}'"""
+    sql_gauge_link_values_string_template = """'{gaugelid}', '{site_number}', {distance_km:.3f}, '{data_gen}'"""
+    request_timeout_seconds = 120
     task_name = "NOAAStreamGauges"
+    usgs_site_query_payload = {"format": "rdb",
+                               "stateCd": None,
+                               "siteType": "ST",
+                               "siteStatus": "active",
+                               "hasDataTypeCd": "iv"}
+    usgs_site_state_abbreviations_list = ["md", "dc", "de", "pa", "wv", "va"]
+    usgs_site_url = r"https://waterservices.usgs.gov/nwis/site/"
+    usgs_sites_cache_file = r"doit_usgs_sites_NOAAObservedRiverGauge.json"
+    usgs_sites_cache_file_path = os.path.join(_root_file_path, usgs_sites_cache_file)
 
     # ASSERTS
     assert os.path.exists(config_file_path)
+    assert len(realtime_noaaobservedrivergauge_headers) == len(sql_values_string_template.split(", "))
 
     # CLASSES
+    @dataclass
+    class AlertPolygon:
+        """Data class for holding an active alert's polygon edges and bounding box for point in polygon tests"""
+        link: str
+        event: str
+        edges: np.ndarray
+        min_x: float
+        min_y: float
+        max_x: float
+        max_y: float
+
+    @dataclass
+    class SiteGridIndex:
+        """Data class for holding USGS site locations indexed by grid cell for nearest site queries"""
+        site_numbers: np.ndarray
+        latitudes: np.ndarray
+        longitudes: np.ndarray
+        cell_height: float
+        cell_width: float
+        sorted_cell_keys: np.ndarray
+        sorted_site_indexes: np.ndarray
+
     @dataclass
     class Gauge:
         """Data class for holding essential values about a Gauge; most values inserted into SQL database"""
@@ -57,8 +190,42 @@ def main():
         latitude: float
         longitude: float
         data_gen: str
+        observed: float = np.NaN
+        flood: float = np.NaN
+        moderate: float = np.NaN
+        major: float = np.NaN
 
     # FUNCTIONS
+    def create_alert_polygon_from_wkt(link: str, event: str, wkt: str) -> AlertPolygon:
+        """
+        Create an AlertPolygon from the WKT of an alert geometry and return, or return None when it has no area.
+        Every ring of a POLYGON or MULTIPOLYGON is converted to edges, as rows of x1, y1, x2, y2, and all rings are
+        kept together. Under the even-odd rule used by the point in polygon test this handles holes and multiple parts.
+        Other geometry types, empty geometries, and rings without an edge cannot contain a gauge so None is returned.
+        :param link: alert url value
+        :param event: alert event value
+        :param wkt: well known text of the alert geometry, like 'POLYGON ((-78.9 39.5, -78.9 39.7, ...))'
+        :return: AlertPolygon dataclass object, or None
+        """
+        if not wkt.lstrip().upper().startswith(("POLYGON", "MULTIPOLYGON")) or "(" not in wkt:
+            return None
+        edges_list = []
+        for ring_text in wkt[wkt.index("("):].replace("(", " ").split(")"):
+            if not ring_text.strip(" ,"):
+                continue
+            ring = np.array(ring_text.replace(",", " ").split(), dtype=float).reshape(-1, 2)
+            edges_list.append(np.hstack((ring[:-1], ring[1:])))
+        edges = np.vstack(edges_list) if edges_list else np.empty((0, 4))
+        if not len(edges):
+            return None
+        return AlertPolygon(link=link,
+                            event=event,
+                            edges=edges,
+                            min_x=float(edges[:, 0].min()),
+                            min_y=float(edges[:, 1].min()),
+                            max_x=float(edges[:, 0].max()),
+                            max_y=float(edges[:, 1].max()))
+
     def create_database_connection_string(db_name: str, db_user: str, db_password: str) -> str:
         """
         Create the connection string for accessing database and return.
@@ -75,18 +242,287 @@ def main():
         """
         return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    def datetime_quality_control(gauge_obj: Gauge) -> str:
+    def create_gauge_from_attributes(attributes: dict, geometry: dict) -> Gauge:
         """
-        Check the data generated value for the occasional N/A or any other unparsable value and set to new value
-        :param gauge_obj: value from NOAA query results
-        :return: string
+        Create a Gauge from the attributes and geometry of a query result feature and return.
+        :param attributes: feature attribute names and values
+        :param geometry: feature point geometry with x and y values
+        :return: Gauge dataclass object
         """
-        try:
-            converted = date_parser.parse(gauge_obj.data_gen)
-        except ValueError as ve:
-            converted = "1970-01-01 00:00:00"
-            print(f"Gauge {gauge_obj.gaugelid} {gauge_obj.location} date value was invalid {gauge_obj.data_gen} -> {converted}")
-        return str(converted)
+        return Gauge(location=attributes.get("location", None),
+                     status=attributes.get("status", None),
+                     gaugelid=attributes.get("gaugelid", None),
+                     latitude=float(geometry.get("y", None)),
+                     longitude=float(geometry.get("x", None)),
+                     data_gen=attributes.get("obstime", None),
+                     observed=determine_stage_value(value=attributes.get("observed", None)),
+                     flood=determine_stage_value(value=attributes.get("flood", None)),
+                     moderate=determine_stage_value(value=attributes.get("moderate", None)),
+                     major=determine_stage_value(value=attributes.get("major", None))
+                     )
+
+    def create_grid_cell_keys(latitudes: np.ndarray, longitudes: np.ndarray, cell_height: float,
+                              cell_width: float, row_offset: int = 0, column_offset: int = 0) -> np.ndarray:
+        """
+        Create the integer key of the grid cell holding each location, optionally offset by rows and columns, and
+        return. The row is kept in the upper 32 bits and the column in the lower so each cell has a single key.
+        :param latitudes: array of latitudes
+        :param longitudes: array of longitudes
+        :param cell_height: cell height in degrees of latitude
+        :param cell_width: cell width in degrees of longitude
+        :param row_offset: number of rows to offset the cells by
+        :param column_offset: number of columns to offset the cells by
+        :return: int64 array of cell keys
+        """
+        rows = np.floor(latitudes / cell_height).astype(np.int64) + row_offset
+        columns = np.floor(longitudes / cell_width).astype(np.int64) + column_offset
+        return (rows << 32) + columns
+
+    def create_incremental_where_clause(where: str, watermark: str) -> str:
+        """
+        Create the where clause that limits the query to gauges observed after the watermark and return.
+        The server compares obstime as text, so the watermark is in date_time_format, the form of the field's values,
+        and the comparison orders them by time.
+        :param where: where clause of a full query
+        :param watermark: latest observation time from the previous run, in date_time_format
+        :return: string where clause
+        """
+        return f"({where}) AND obstime > '{watermark}'"
+
+    def create_naive_utc_datetime(value: datetime) -> datetime:
+        """
+        Convert a parsed datetime to naive UTC and return it, so times that arrived with and without an offset
+        compare correctly. A value with an offset, like '2026-10-16T12:00:00Z', is converted to UTC before the offset
+        is dropped. A value without one is taken to be UTC already, as the obstime values in the known format are.
+        :param value: datetime from dateutil, aware or naive
+        :return: naive datetime in UTC
+        """
+        if value.tzinfo is None:
+            return value
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    def create_pooled_session(pool_size: int) -> requests.Session:
+        """
+        Create a requests Session with a connection pool large enough to hold a keep-alive connection per worker.
+        :param pool_size: number of connections the pool may keep open
+        :return: requests Session
+        """
+        session = requests.Session()
+        session.headers.update(noaa_request_headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def create_query_pages(object_ids: list, object_id_field: str, max_record_count: int,
+                           supports_pagination: bool, response_format: str, where: str) -> list:
+        """
+        Create the query parameters of every page needed to retrieve the object ids and return.
+        Pages are ordered by object id so that offsets select the same features on every request. When the layer does
+        not support pagination each page asks for a chunk of object ids instead of an offset.
+        :param object_ids: sorted list of the object ids matching the where clause
+        :param object_id_field: name of the object id field
+        :param max_record_count: maximum number of features the layer returns per request
+        :param supports_pagination: whether the layer accepts resultOffset and resultRecordCount
+        :param response_format: query format of the pages, json or pbf
+        :param where: where clause of the query
+        :return: list of query parameter dictionaries, one per page
+        """
+        pages = []
+        for offset in range(0, len(object_ids), max_record_count):
+            page_params = dict(noaa_query_payload, orderByFields=object_id_field, f=response_format, where=where)
+            if supports_pagination:
+                page_params.update(resultOffset=offset,
+                                   resultRecordCount=min(max_record_count, len(object_ids) - offset))
+            else:
+                page_params.update(objectIds=object_ids[offset: offset + max_record_count])
+            pages.append(page_params)
+        return pages
+
+    def create_site_grid_index(usgs_sites: list, max_distance_km: float) -> SiteGridIndex:
+        """
+        Create the grid index of the USGS site locations and return.
+        Cells are at least the distance limit tall and wide, so every site within the limit of a point is in the
+        point's cell or one of the eight around it. Cell width is set at the highest latitude, where a degree of
+        longitude is shortest, plus a cell of margin for points north of every site.
+        :param usgs_sites: list of site number, latitude, and longitude lists
+        :param max_distance_km: distance limit of a link
+        :return: SiteGridIndex dataclass object
+        """
+        site_numbers = np.array([site[0] for site in usgs_sites], dtype=str)
+        latitudes = np.array([site[1] for site in usgs_sites], dtype=float)
+        longitudes = np.array([site[2] for site in usgs_sites], dtype=float)
+        cell_height = np.degrees(max_distance_km / earth_radius_km)
+        highest_latitude = min(float(np.abs(latitudes).max(initial=0.0)) + cell_height, 89.0)
+        cell_width = cell_height / np.cos(np.radians(highest_latitude))
+        cell_keys = create_grid_cell_keys(latitudes=latitudes, longitudes=longitudes, cell_height=cell_height,
+                                          cell_width=cell_width)
+        sorted_site_indexes = np.argsort(cell_keys, kind="stable")
+        return SiteGridIndex(site_numbers=site_numbers,
+                             latitudes=latitudes,
+                             longitudes=longitudes,
+                             cell_height=cell_height,
+                             cell_width=cell_width,
+                             sorted_cell_keys=cell_keys[sorted_site_indexes],
+                             sorted_site_indexes=sorted_site_indexes)
+
+    def create_sql_nullable_value(value) -> str:
+        """
+        Create the sql literal for a computed value, with NULL for a missing value, and return.
+        :param value: category string, None, or float that may be NaN
+        :return: string sql literal
+        """
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return "NULL"
+        if isinstance(value, str):
+            return f"'{value}'"
+        return f"{value:.1f}"
+
+    def datetime_quality_control(gauge_objs: list) -> pd.Series:
+        """
+        Check the data generated values for the occasional N/A or any other unparsable value and set to new value.
+        All values are converted in one vectorized call using the known format. Only values that do not match it are
+        parsed individually, once per distinct value, and the invalid values are reported as one count rather than a
+        line per gauge. The observation times returned are naive UTC, so values parsed with an offset are converted
+        to UTC rather than having the offset dropped, and all of them compare with one another and the watermark.
+        :param gauge_objs: list of Gauge dataclass objects, whose data generated values are replaced
+        :return: Series of naive UTC observation times in gauge order, NaT where invalid
+        """
+        raw_values = pd.Series([gauge_obj.data_gen for gauge_obj in gauge_objs], dtype=object)
+        observation_times = pd.to_datetime(raw_values, format=date_time_format, errors="coerce")
+        converted_values = observation_times.dt.strftime(date_time_format).to_numpy(dtype=object)
+        fallback_values_dict = {}
+        invalid_count = 0
+        for index in np.flatnonzero(observation_times.isna().to_numpy()):
+            raw_value = raw_values[index]
+            if raw_value not in fallback_values_dict:
+                try:
+                    fallback_values_dict[raw_value] = date_parser.parse(raw_value)
+                except (TypeError, ValueError, OverflowError):
+                    fallback_values_dict[raw_value] = None
+            converted = fallback_values_dict[raw_value]
+            if converted is None:
+                converted_values[index] = invalid_date_time_value
+                invalid_count += 1
+            else:
+                converted_values[index] = str(converted)
+                observation_times[index] = pd.Timestamp(create_naive_utc_datetime(value=converted))
+        for gauge_obj, converted_value in zip(gauge_objs, converted_values):
+            gauge_obj.data_gen = converted_value
+        if invalid_count:
+            print(f"Gauge date values invalid {invalid_count} of {len(gauge_objs)} -> {invalid_date_time_value}")
+        return observation_times
+
+    def decode_feature_collection_pbf(payload: bytes) -> dict:
+        """
+        Decode an esri FeatureCollectionPBuffer query response and return it in the shape of the json response.
+        The FeatureResult is reached through the queryResult message. Its fields list gives the attribute names,
+        each feature's values are in field order, and a point's quantized coordinates are converted with the
+        transform's scale and translate. An upper left quantize origin counts y downward from the translate.
+        :param payload: protocol buffer response bytes
+        :return: dictionary with the features list, as attributes and geometry dictionaries, and exceededTransferLimit
+        """
+        payload = memoryview(payload)
+        feature_result = None
+        for field_number, wire_type, value in iterate_protobuf_fields(buffer=payload):
+            if field_number == 2:
+                for result_field_number, result_wire_type, result_value in iterate_protobuf_fields(buffer=value):
+                    if result_field_number == 1:
+                        feature_result = result_value
+        if feature_result is None:
+            return {"features": []}
+        exceeded_transfer_limit = False
+        feature_messages = []
+        field_names = []
+        scale = [1.0, 1.0]
+        translate = [0.0, 0.0]
+        upper_left_origin = True
+        for field_number, wire_type, value in iterate_protobuf_fields(buffer=feature_result):
+            if field_number == 9:
+                exceeded_transfer_limit = bool(value)
+            elif field_number == 12:
+                for transform_field_number, transform_wire_type, transform_value in iterate_protobuf_fields(value):
+                    if transform_field_number == 1:
+                        upper_left_origin = transform_value == 0
+                    elif transform_field_number in (2, 3):
+                        target = scale if transform_field_number == 2 else translate
+                        for axis_number, axis_wire_type, axis_value in iterate_protobuf_fields(transform_value):
+                            if axis_number in (1, 2):
+                                target[axis_number - 1] = struct.unpack("<d", axis_value)[0]
+            elif field_number == 13:
+                field_names.append(next((bytes(name).decode("utf-8")
+                                         for name_number, name_wire_type, name in iterate_protobuf_fields(value)
+                                         if name_number == 1), None))
+            elif field_number == 15:
+                feature_messages.append(value)
+        features = []
+        for feature_message in feature_messages:
+            attribute_values = []
+            geometry = {}
+            for field_number, wire_type, value in iterate_protobuf_fields(buffer=feature_message):
+                if field_number == 1:
+                    attribute_values.append(decode_pbf_value(buffer=value))
+                elif field_number == 2:
+                    coordinates = []
+                    for geometry_field_number, geometry_wire_type, geometry_value in iterate_protobuf_fields(value):
+                        if geometry_field_number == 3:
+                            coordinates.extend(decode_packed_varints(buffer=geometry_value)
+                                               if geometry_wire_type == 2 else [geometry_value])
+                    if len(coordinates) >= 2:
+                        x_value, y_value = ((coordinate >> 1) ^ -(coordinate & 1) for coordinate in coordinates[:2])
+                        geometry = {"x": translate[0] + x_value * scale[0],
+                                    "y": (translate[1] - y_value * scale[1] if upper_left_origin
+                                          else translate[1] + y_value * scale[1])}
+            features.append({"attributes": dict(zip(field_names, attribute_values)), "geometry": geometry})
+        return {"features": features, "exceededTransferLimit": exceeded_transfer_limit}
+
+    def decode_packed_varints(buffer: memoryview) -> list:
+        """
+        Decode a packed repeated varint field and return the values.
+        :param buffer: bytes of the packed field
+        :return: list of integers
+        """
+        values = []
+        position = 0
+        while position < len(buffer):
+            value, position = decode_varint(buffer=buffer, position=position)
+            values.append(value)
+        return values
+
+    def decode_pbf_value(buffer: memoryview):
+        """
+        Decode an esri Value message, whose oneof field number identifies the type, and return the python value.
+        A message with no field set is a null value. Most values are short strings, which are decoded directly.
+        :param buffer: bytes of the Value message
+        :return: string, float, integer, boolean, or None
+        """
+        if len(buffer) > 1 and buffer[0] == 0x0A and buffer[1] < 0x80:
+            return str(buffer[2:], "utf-8")
+        for field_number, wire_type, value in iterate_protobuf_fields(buffer=buffer):
+            decoder = pbf_value_decoders_dict.get(field_number)
+            if decoder is not None:
+                return decoder(value)
+        return None
+
+    def decode_varint(buffer: memoryview, position: int) -> tuple:
+        """
+        Decode a base 128 varint starting at a position and return the value and the position after it.
+        :param buffer: protocol buffer bytes
+        :param position: index of the first byte of the varint
+        :return: tuple of integer value and next position
+        """
+        result = buffer[position]
+        if result < 0x80:
+            return result, position + 1
+        result = 0
+        shift = 0
+        while True:
+            byte = buffer[position]
+            position += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result, position
+            shift += 7
 
     def determine_database_config_value_based_on_script_name() -> str:
         """
@@ -103,6 +539,417 @@ def main():
         else:
             return "DATABASE_DEV"
 
+    def determine_fetch_is_full_refresh(cache: dict, now: datetime) -> bool:
+        """
+        Determine if this run must request every gauge rather than only those observed since the last run.
+        :param cache: gauge cache from the previous run
+        :param now: datetime of this run
+        :return: True when a full reconciliation sweep is needed
+        """
+        if not INCREMENTAL_FETCH or not cache.get("watermark") or not cache.get("last_full_refresh"):
+            return True
+        last_full_refresh = datetime.strptime(cache["last_full_refresh"], date_time_format)
+        return now - last_full_refresh >= timedelta(hours=FULL_REFRESH_INTERVAL_HOURS)
+
+    def determine_flood_categories(gauge_objs: list) -> tuple:
+        """
+        Determine the flood category and percent of flood stage of every gauge in one vectorized pass and return.
+        The category is the highest threshold the observed stage has reached, flood stage being minor flooding.
+        A comparison with an unknown threshold is False so a missing moderate or major stage is passed over. The
+        category is None when the observed or flood stage is unknown, and the percent needs a positive flood stage.
+        :param gauge_objs: list of Gauge dataclass objects
+        :return: tuple of array of category strings or None, and array of percents of flood stage with NaN
+        """
+        stages = np.array([(gauge_obj.observed, gauge_obj.flood, gauge_obj.moderate, gauge_obj.major)
+                           for gauge_obj in gauge_objs], dtype=float).reshape(-1, 4)
+        observed, flood, moderate, major = stages.T
+        categories = np.select(condlist=[observed >= major,
+                                         observed >= moderate,
+                                         observed >= flood,
+                                         observed < flood],
+                               choicelist=flood_categories,
+                               default=None)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percents = np.where(flood > 0, observed / flood * 100, np.NaN)
+        return categories, percents
+
+    def determine_gauge_changed(previous_gauge: Gauge, gauge_obj: Gauge) -> bool:
+        """
+        Determine if a gauge's values differ from its values in the previous run's snapshot.
+        Unknown stages are NaN, which is not equal to itself, so two NaN values are treated as equal.
+        :param previous_gauge: Gauge from the snapshot, or None for a new gauge
+        :param gauge_obj: Gauge from this run
+        :return: True when the gauge is new or any value changed
+        """
+        if previous_gauge is None:
+            return True
+        for previous_value, value in zip(astuple(previous_gauge), astuple(gauge_obj)):
+            both_unknown = all(isinstance(item, float) and np.isnan(item) for item in (previous_value, value))
+            if previous_value != value and not both_unknown:
+                return True
+        return False
+
+    def determine_haversine_distances(latitudes_1: np.ndarray, longitudes_1: np.ndarray, latitudes_2: np.ndarray,
+                                      longitudes_2: np.ndarray) -> np.ndarray:
+        """
+        Determine the great circle distance between pairs of locations with the haversine formula.
+        :param latitudes_1: array of latitudes of the first locations
+        :param longitudes_1: array of longitudes of the first locations
+        :param latitudes_2: array of latitudes of the second locations
+        :param longitudes_2: array of longitudes of the second locations
+        :return: array of distances in kilometers
+        """
+        latitudes_1, longitudes_1, latitudes_2, longitudes_2 = (np.radians(values) for values in (
+            latitudes_1, longitudes_1, latitudes_2, longitudes_2))
+        half_chord = (np.sin((latitudes_2 - latitudes_1) / 2) ** 2
+                      + np.cos(latitudes_1) * np.cos(latitudes_2) * np.sin((longitudes_2 - longitudes_1) / 2) ** 2)
+        return 2 * earth_radius_km * np.arcsin(np.sqrt(np.minimum(half_chord, 1.0)))
+
+    def determine_nearest_sites(site_grid: SiteGridIndex, latitudes: np.ndarray, longitudes: np.ndarray,
+                                max_distance_km: float) -> tuple:
+        """
+        Determine the nearest indexed site within the distance limit of every location in one vectorized pass.
+        The sorted cell keys of the nine cells around each location give ranges of candidate sites. The ranges are
+        expanded into location and site index pairs, the pairs beyond the limit are dropped, and the closest pair of
+        each location is kept after sorting the pairs by location and distance.
+        :param site_grid: SiteGridIndex dataclass object
+        :param latitudes: array of location latitudes
+        :param longitudes: array of location longitudes
+        :param max_distance_km: distance limit of a link
+        :return: tuple of array of nearest site indexes, -1 where none, and array of distances in km, NaN where none
+        """
+        nearest_sites = np.full(latitudes.size, -1, dtype=np.int64)
+        nearest_distances = np.full(latitudes.size, np.NaN)
+        neighbor_keys = np.stack([create_grid_cell_keys(latitudes=latitudes, longitudes=longitudes,
+                                                        cell_height=site_grid.cell_height,
+                                                        cell_width=site_grid.cell_width,
+                                                        row_offset=row_offset,
+                                                        column_offset=column_offset)
+                                  for row_offset in (-1, 0, 1) for column_offset in (-1, 0, 1)], axis=1).ravel()
+        range_starts = np.searchsorted(site_grid.sorted_cell_keys, neighbor_keys, side="left")
+        range_counts = np.searchsorted(site_grid.sorted_cell_keys, neighbor_keys, side="right") - range_starts
+        total_candidates = int(range_counts.sum())
+        if total_candidates == 0:
+            return nearest_sites, nearest_distances
+        location_indexes = np.repeat(np.arange(neighbor_keys.size) // 9, range_counts)
+        positions_in_range = np.arange(total_candidates) - np.repeat(np.cumsum(range_counts) - range_counts,
+                                                                      range_counts)
+        site_indexes = site_grid.sorted_site_indexes[np.repeat(range_starts, range_counts) + positions_in_range]
+        distances = determine_haversine_distances(latitudes_1=latitudes[location_indexes],
+                                                  longitudes_1=longitudes[location_indexes],
+                                                  latitudes_2=site_grid.latitudes[site_indexes],
+                                                  longitudes_2=site_grid.longitudes[site_indexes])
+        within_limit = distances <= max_distance_km
+        location_indexes = location_indexes[within_limit]
+        site_indexes = site_indexes[within_limit]
+        distances = distances[within_limit]
+        order = np.lexsort((distances, location_indexes))
+        location_indexes = location_indexes[order]
+        is_nearest = np.ones(location_indexes.size, dtype=bool)
+        is_nearest[1:] = location_indexes[1:] != location_indexes[:-1]
+        nearest_sites[location_indexes[is_nearest]] = site_indexes[order][is_nearest]
+        nearest_distances[location_indexes[is_nearest]] = distances[order][is_nearest]
+        return nearest_sites, nearest_distances
+
+    def determine_observation_watermark(observation_times: pd.Series, watermark: str) -> str:
+        """
+        Determine the latest observation time of the gauges, or of the previous watermark, and return it formatted.
+        Values that could not be parsed, like N/A, are NaT and passed over. The watermark is kept in date_time_format
+        whatever form the latest value arrived in, so it always compares correctly with the field's values.
+        :param observation_times: Series of observation times in gauge order, from date quality control
+        :param watermark: latest observation time from the previous run in date_time_format, or None
+        :return: string latest observation time in date_time_format, or None
+        """
+        if observation_times.notna().any():
+            latest_time = observation_times.max()
+            if not watermark or latest_time > pd.Timestamp(watermark):
+                return latest_time.strftime(date_time_format)
+        return watermark
+
+    def determine_points_in_polygon(alert_polygon: AlertPolygon,
+                                    x_values: np.ndarray,
+                                    y_values: np.ndarray) -> np.ndarray:
+        """
+        Determine which points fall inside an alert polygon using a vectorized ray casting test and return the mask.
+        A ray cast to the east of each point crosses an edge when the edge spans the point's y value and the crossing
+        lies east of the point. An odd number of crossings means the point is inside.
+        :param alert_polygon: AlertPolygon dataclass object
+        :param x_values: array of point longitudes
+        :param y_values: array of point latitudes
+        :return: boolean array, True where the point is inside
+        """
+        x1, y1, x2, y2 = (alert_polygon.edges[:, i] for i in range(4))
+        px = x_values[:, np.newaxis]
+        py = y_values[:, np.newaxis]
+        spans = (y1 > py) != (y2 > py)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = np.count_nonzero(spans & (px < crossing_x), axis=1)
+        return crossings % 2 == 1
+
+    def determine_stage_value(value) -> float:
+        """
+        Determine the numeric value of a stage attribute. Empty and non numeric values are unknown.
+        :param value: stage value from the query results
+        :return: float stage, or NaN when unknown
+        """
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.NaN
+
+    def iterate_protobuf_fields(buffer: memoryview):
+        """
+        Iterate over the fields of a protocol buffer message and yield each field number, wire type, and value.
+        Varints are yielded as integers, length delimited fields as a memoryview of their bytes, and fixed width
+        fields as their raw little endian bytes, so nested messages are decoded without copying the payload.
+        :param buffer: bytes of the message
+        :return: generator of tuples of field number, wire type, and value
+        """
+        position = 0
+        end = len(buffer)
+        while position < end:
+            key, position = decode_varint(buffer=buffer, position=position)
+            wire_type = key & 0x07
+            if wire_type == 0:
+                value, position = decode_varint(buffer=buffer, position=position)
+            elif wire_type == 2:
+                length, position = decode_varint(buffer=buffer, position=position)
+                value = buffer[position: position + length]
+                position += length
+            elif wire_type == 1:
+                value = buffer[position: position + 8]
+                position += 8
+            elif wire_type == 5:
+                value = buffer[position: position + 4]
+                position += 4
+            else:
+                raise ValueError(f"Unsupported protocol buffer wire type {wire_type}")
+            yield key >> 3, wire_type, value
+
+    def join_gauges_to_alert_polygons(gauge_objs: list, alert_polygons: list) -> list:
+        """
+        Join gauges to the alert polygons they fall inside and return the pairs.
+        Gauge longitudes are sorted once. Each polygon's bounding box then selects its candidate gauges with a binary
+        search on longitude and a latitude filter, so only those candidates get the point in polygon test.
+        :param gauge_objs: list of Gauge dataclass objects
+        :param alert_polygons: list of AlertPolygon dataclass objects
+        :return: list of (Gauge, AlertPolygon) tuples
+        """
+        x_values = np.array([gauge_obj.longitude for gauge_obj in gauge_objs], dtype=float)
+        y_values = np.array([gauge_obj.latitude for gauge_obj in gauge_objs], dtype=float)
+        x_order = np.argsort(x_values)
+        x_sorted = x_values[x_order]
+        gauge_alert_pairs = []
+        for alert_polygon in alert_polygons:
+            low = int(np.searchsorted(x_sorted, alert_polygon.min_x, side="left"))
+            high = int(np.searchsorted(x_sorted, alert_polygon.max_x, side="right"))
+            candidates = x_order[low:high]
+            candidates = candidates[(y_values[candidates] >= alert_polygon.min_y)
+                                    & (y_values[candidates] <= alert_polygon.max_y)]
+            if candidates.size == 0:
+                continue
+            inside = determine_points_in_polygon(alert_polygon=alert_polygon,
+                                                 x_values=x_values[candidates],
+                                                 y_values=y_values[candidates])
+            gauge_alert_pairs.extend((gauge_objs[index], alert_polygon) for index in candidates[inside])
+        return gauge_alert_pairs
+
+    def load_gauge_cache(cache_file: str) -> dict:
+        """
+        Load the gauge cache from the previous run. A missing or unreadable cache is treated as empty.
+        :param cache_file: path to the json cache file
+        :return: dictionary holding the watermark, last full refresh, and gauge snapshot
+        """
+        if not os.path.exists(cache_file):
+            return {}
+        try:
+            with open(cache_file, 'r') as handler:
+                return json.load(handler)
+        except (OSError, ValueError) as e:
+            print(f"Unable to load gauge cache {cache_file}. Proceeding with full refresh. {e}")
+            return {}
+
+    def load_usgs_sites(session: requests.Session, cache_file: str, now: datetime) -> list:
+        """
+        Load the USGS site locations from the local cache, requesting them from the site service when the cache is
+        missing, unreadable, or older than the refresh interval. A failed request falls back to a stale cache.
+        :param session: pooled requests Session
+        :param cache_file: path to the json site cache file
+        :param now: datetime of this run
+        :return: list of site number, latitude, and longitude lists
+        """
+        sites_cache = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as handler:
+                    sites_cache = json.load(handler)
+            except (OSError, ValueError) as e:
+                print(f"Unable to load USGS site cache {cache_file}. {e}")
+        if sites_cache.get("retrieved") and now - datetime.strptime(
+                sites_cache["retrieved"], date_time_format) < timedelta(days=USGS_SITES_REFRESH_DAYS):
+            return sites_cache["sites"]
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+                usgs_sites = [site for state_sites in executor.map(lambda state_abbrev: request_usgs_sites(
+                    session=session, state_abbrev=state_abbrev), usgs_site_state_abbreviations_list)
+                              for site in state_sites]
+        except Exception as e:
+            print(f"Exception during request for USGS sites from {usgs_site_url}. Using cached sites. {e}")
+            return sites_cache.get("sites", [])
+        save_gauge_cache(cache_file=cache_file, cache={"retrieved": now.strftime(date_time_format),
+                                                       "sites": usgs_sites})
+        return usgs_sites
+
+    def process_watermark(watermark: str) -> str:
+        """
+        Convert a cached watermark to naive UTC in date_time_format and return it. Caches written before the watermark
+        was kept in that format hold the raw obstime value of the latest observation, which may be in another form.
+        :param watermark: watermark from the gauge cache, or None
+        :return: string watermark in date_time_format, or None when there is none or it cannot be parsed
+        """
+        if not watermark:
+            return None
+        try:
+            return create_naive_utc_datetime(value=date_parser.parse(watermark)).strftime(date_time_format)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def request_layer_info(session: requests.Session) -> tuple:
+        """
+        Request the layer description and return its maximum record count, whether it supports pagination, and its
+        supported query formats.
+        :param session: pooled requests Session
+        :return: tuple of maximum record count, pagination support, and list of lower case query formats
+        """
+        layer_json, payload_bytes = request_query_json(session=session, url=noaa_layer_url, params={"f": "json"})
+        supports_pagination = layer_json.get("advancedQueryCapabilities", {}).get("supportsPagination", False)
+        query_formats = [query_format.strip().lower()
+                         for query_format in layer_json.get("supportedQueryFormats", "JSON").split(",")]
+        return layer_json.get("maxRecordCount", 1000), supports_pagination, query_formats
+
+    def request_object_ids(session: requests.Session, where: str) -> tuple:
+        """
+        Request only the object ids of the features matching the where clause and return them sorted.
+        An id only request is not limited by the maximum record count so it gives the full feature count.
+        :param session: pooled requests Session
+        :param where: where clause of the query
+        :return: tuple of object id field name, sorted list of object ids, and payload bytes received
+        """
+        ids_json, payload_bytes = request_query_json(session=session,
+                                                     url=noaa_url,
+                                                     params={"where": where,
+                                                             "returnIdsOnly": "true",
+                                                             "f": "json"})
+        return ids_json.get("objectIdFieldName", "objectid"), sorted(ids_json.get("objectIds") or []), payload_bytes
+
+    def request_page_gauges(session: requests.Session, page_params: dict) -> tuple:
+        """
+        Request a page of features, create the Gauges, and return them. Runs in a worker thread.
+        A server may stop short of the requested count and set exceededTransferLimit, so the page is continued from
+        the first feature not returned until it is complete or the server returns nothing more.
+        :param session: pooled requests Session
+        :param page_params: query parameters of the page
+        :return: tuple of list of Gauge dataclass objects and payload bytes received
+        """
+        page_params = dict(page_params)
+        object_ids = page_params.pop("objectIds", None)
+        page_gauges = []
+        payload_bytes_received = 0
+        while True:
+            if object_ids is not None:
+                page_params["objectIds"] = ",".join(str(object_id) for object_id in object_ids[len(page_gauges):])
+            if page_params["f"] == "pbf":
+                page_json, payload_bytes = request_query_pbf(session=session, url=noaa_url, params=page_params)
+            else:
+                page_json, payload_bytes = request_query_json(session=session, url=noaa_url, params=page_params)
+            payload_bytes_received += payload_bytes
+            features = page_json.get("features", [])
+            for feature in features:
+                page_gauges.append(create_gauge_from_attributes(attributes=feature.get("attributes", {}),
+                                                                geometry=feature.get("geometry", {})))
+            requested_count = len(object_ids) if object_ids is not None else page_params["resultRecordCount"]
+            if not page_json.get("exceededTransferLimit", False) or not features or len(page_gauges) >= requested_count:
+                return page_gauges, payload_bytes_received
+            if object_ids is None:
+                page_params["resultOffset"] += len(features)
+                page_params["resultRecordCount"] -= len(features)
+
+    def request_query_json(session: requests.Session, url: str, params: dict) -> tuple:
+        """
+        Make a request to an ArcGIS REST endpoint and return the decoded json and payload bytes received.
+        ArcGIS reports most failures as a json error object with a 200 status code so those are raised too.
+        :param session: pooled requests Session
+        :param url: endpoint url
+        :param params: query parameters
+        :return: tuple of response json dictionary and payload bytes received
+        """
+        response = session.get(url=url, params=params, timeout=request_timeout_seconds)
+        response.raise_for_status()
+        response_json = response.json()
+        if "error" in response_json:
+            raise ValueError(f"ArcGIS error response {response_json['error']}")
+        return response_json, response.raw.tell()
+
+    def request_query_pbf(session: requests.Session, url: str, params: dict) -> tuple:
+        """
+        Make a protocol buffer request to an ArcGIS REST endpoint and return the decoded features and payload bytes.
+        Errors are returned as json even when pbf is requested so a json body is raised as an error.
+        :param session: pooled requests Session
+        :param url: endpoint url
+        :param params: query parameters
+        :return: tuple of decoded response dictionary and payload bytes received
+        """
+        response = session.get(url=url, params=params, timeout=request_timeout_seconds)
+        response.raise_for_status()
+        if "json" in response.headers.get("Content-Type", ""):
+            raise ValueError(f"ArcGIS error response {response.json().get('error', response.text)}")
+        return decode_feature_collection_pbf(payload=response.content), response.raw.tell()
+
+    def request_usgs_sites(session: requests.Session, state_abbrev: str) -> list:
+        """
+        Request the active USGS stream sites of a state from the site service as RDB and return their locations.
+        Comment lines start with #, the first line after them names the columns, and the next gives column formats.
+        :param session: pooled requests Session
+        :param state_abbrev: state abbreviation
+        :return: list of site number, latitude, and longitude lists
+        """
+        response = session.get(url=usgs_site_url,
+                               params=dict(usgs_site_query_payload, stateCd=state_abbrev),
+                               timeout=request_timeout_seconds)
+        response.raise_for_status()
+        data_lines = [line for line in response.text.splitlines() if line and not line.startswith("#")]
+        if not data_lines:
+            return []
+        column_names = data_lines[0].split("\t")
+        site_column = column_names.index("site_no")
+        latitude_column = column_names.index("dec_lat_va")
+        longitude_column = column_names.index("dec_long_va")
+        sites = []
+        for line in data_lines[2:]:
+            values = line.split("\t")
+            try:
+                sites.append([values[site_column], float(values[latitude_column]), float(values[longitude_column])])
+            except (IndexError, ValueError):
+                continue
+        return sites
+
+    def save_gauge_cache(cache_file: str, cache: dict) -> None:
+        """
+        Write the gauge cache for use by the next run. Written to a temporary file first so a failed write
+        does not leave a partial cache behind.
+        :param cache_file: path to the json cache file
+        :param cache: dictionary holding the watermark, last full refresh, and gauge snapshot
+        :return: None
+        """
+        temporary_file = f"{cache_file}.tmp"
+        try:
+            with open(temporary_file, 'w') as handler:
+                json.dump(cache, handler)
+            os.replace(temporary_file, cache_file)
+        except OSError as e:
+            print(f"Unable to save gauge cache {cache_file}. {e}")
+
     def setup_config(cfg_file: str) -> configparser.ConfigParser:
         """
         Instantiate the parser for accessing a config file.
@@ -113,6 +960,22 @@ def main():
         cfg_parser.read(filenames=cfg_file)
         return cfg_parser
 
+    def sql_insert_generator(sql_values_list: list, step_increment: int, sql_insert_string: str):
+        """
+        Generator for yielding batches of sql values for insertion
+        Purpose is to work with the 1000 record limit of SQL insertion.
+        :param sql_values_list: list of prebuilt record values ready for sql insertion
+        :param step_increment: the record count increment for insertion batches
+        :param sql_insert_string: sql statement string for use with values
+        :return: yield a string for use in insertion
+        """
+        for i in range(0, len(sql_values_list), step_increment):
+            values_in_range = sql_values_list[i: i + step_increment]
+
+            # Build the entire SQL statement to be executed
+            output = sql_insert_string + ",".join(values_in_range)
+            yield output
+
     def time_elapsed(start=datetime.now()):
         """
         Calculate the difference between datetime.now() value and a start datetime value
@@ -135,39 +998,91 @@ def main():
     # need parser to access credentials
     config_parser = setup_config(config_file_path)
 
-    # Make request to url
+    # Need the previous run's snapshot to decide between a full reconciliation sweep and an incremental fetch
+    gauge_cache = load_gauge_cache(cache_file=gauge_cache_file_path) if INCREMENTAL_FETCH else {}
+    gauge_cache["watermark"] = process_watermark(watermark=gauge_cache.get("watermark"))
+    full_refresh = determine_fetch_is_full_refresh(cache=gauge_cache, now=start)
+    query_where = noaa_query_payload["where"]
+    if not full_refresh:
+        query_where = create_incremental_where_clause(where=query_where, watermark=gauge_cache["watermark"])
+    print(f"Fetch mode: {'full refresh' if full_refresh else f'incremental, where {query_where}'}")
+
+    # Need the layer's record limit and the full list of object ids before the pages can be planned
+    session = create_pooled_session(pool_size=MAX_CONCURRENT_REQUESTS)
     try:
-        response = requests.get(url=noaa_url, params=noaa_query_payload)
+        max_record_count, supports_pagination, query_formats = request_layer_info(session=session)
+        object_id_field, object_ids_list, payload_bytes_total = request_object_ids(session=session, where=query_where)
     except Exception as e:
-        print(f"Exception during request for html page {noaa_url}. {e}")
+        print(f"Exception during request for layer information {noaa_layer_url}. {e}")
         exit()
+    response_format = RESPONSE_FORMAT if RESPONSE_FORMAT in query_formats else "json"
+    query_pages_list = create_query_pages(object_ids=object_ids_list,
+                                          object_id_field=object_id_field,
+                                          max_record_count=max_record_count,
+                                          supports_pagination=supports_pagination,
+                                          response_format=response_format,
+                                          where=query_where)
+    print(f"Features matching query {len(object_ids_list)}, max record count {max_record_count}, "
+          f"pages {len(query_pages_list)}{'' if supports_pagination else ' by object ids'}, "
+          f"format {response_format}")
+
+    # Make the page requests to url concurrently over the pooled session. Results are taken in page order so the
+    #   gauges come out in object id order regardless of which page arrived first.
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        page_futures_list = [executor.submit(request_page_gauges, session=session, page_params=page_params)
+                             for page_params in query_pages_list]
+        for page_number, future in enumerate(page_futures_list, start=1):
+            try:
+                page_gauges, payload_bytes = future.result()
+            except Exception as e:
+                print(f"Exception during request for page {page_number} from {noaa_url}. {e}")
+                exit()
+            else:
+                gauge_objects_list.extend(page_gauges)
+                payload_bytes_total += payload_bytes
+    if LINK_GAUGES_TO_USGS_SITES:
+        usgs_sites_list = load_usgs_sites(session=session, cache_file=usgs_sites_cache_file_path, now=start)
+        print(f"USGS sites loaded {len(usgs_sites_list)}. Time elapsed {time_elapsed(start=start)}")
+    session.close()
+    if len(gauge_objects_list) != len(object_ids_list):
+        print(f"Gauges received {len(gauge_objects_list)} do not match the {len(object_ids_list)} features matching "
+              f"the query")
+    print(f"Payload bytes received {payload_bytes_total}. Gauges {len(gauge_objects_list)}. "
+          f"Time elapsed {time_elapsed(start=start)}")
+
+    # The watermark is the latest of the observation times found by quality control
+    observation_times = datetime_quality_control(gauge_objs=gauge_objects_list)
+    observation_watermark = determine_observation_watermark(observation_times=observation_times,
+                                                            watermark=gauge_cache["watermark"])
+
+    # A full refresh replaces the snapshot and writes every row. An incremental fetch merges the returned gauges into
+    #   the snapshot and writes only those whose values changed.
+    if full_refresh:
+        gauge_snapshot_dict = {gauge_obj.gaugelid: gauge_obj for gauge_obj in gauge_objects_list}
+        changed_gauges_list = gauge_objects_list
     else:
-        response_json = response.json()
-        print(f"Response status code: {response.status_code}")
-        print(f"Time elapsed {time_elapsed(start=start)}")
-
-    features = response_json["features"]
-    for feature in features:
-        attributes = feature.get("attributes", {})
-        geometry = feature.get("geometry", {})
-
-        gauge_objects_list.append(Gauge(location=attributes.get("location", None),
-                                        status=attributes.get("status", None),
-                                        gaugelid=attributes.get("gaugelid", None),
-                                        latitude=float(geometry.get("y", None)),
-                                        longitude=float(geometry.get("x", None)),
-                                        data_gen=attributes.get("obstime", None)
-                                        )
-                                  )
-
-    for gauge_obj in gauge_objects_list:
-        gauge_obj.data_gen = datetime_quality_control(gauge_obj)
+        gauge_snapshot_dict = {gaugelid: Gauge(**values) for gaugelid, values in gauge_cache["gauges"].items()}
+        for gauge_obj in gauge_objects_list:
+            if determine_gauge_changed(previous_gauge=gauge_snapshot_dict.get(gauge_obj.gaugelid), gauge_obj=gauge_obj):
+                gauge_snapshot_dict[gauge_obj.gaugelid] = gauge_obj
+                changed_gauges_list.append(gauge_obj)
+    print(f"Rows to write {len(changed_gauges_list)}. Time elapsed {time_elapsed(start=start)}")
+
+    # Flood category and percent of flood stage are computed for all rows at once rather than per gauge. They are only
+    #   part of the values when WRITE_FLOOD_CATEGORIES is True.
+    flood_categories_array, percent_flood_stages_array = determine_flood_categories(gauge_objs=changed_gauges_list)
+    for gauge_obj, flood_category, percent_flood_stage in zip(changed_gauges_list,
+                                                              flood_categories_array,
+                                                              percent_flood_stages_array):
         values = sql_values_string_template.format(location=gauge_obj.location,
                                                    status=gauge_obj.status,
                                                    gaugelid=gauge_obj.gaugelid,
                                                    latitude=gauge_obj.latitude,
                                                    longitude=gauge_obj.longitude,
-                                                   data_gen=gauge_obj.data_gen)
+                                                   data_gen=gauge_obj.data_gen,
+                                                   flood_category=create_sql_nullable_value(value=flood_category),
+                                                   percent_flood_stage=create_sql_nullable_value(
+                                                       value=float(percent_flood_stage)))
         values_string = sql_values_statement.format(values=values)
         sql_values_statements_list.append(values_string)
 
@@ -181,14 +1096,25 @@ def main():
                                                                db_password=database_password)
     realtime_noaaobservedrivergauge_tbl_string = realtime_noaaobservedrivergauge_tbl.format(database_name=database_name)
 
-    # need the sql table headers as comma separated string values for use in the DELETE & INSERT statement
+    # need the sql table headers as comma separated string values for use in the INSERT statement
     headers_joined = ",".join([f"{val}" for val in realtime_noaaobservedrivergauge_headers])
-    sql_delete_insert_string = sql_delete_insert_template.format(
-        table=realtime_noaaobservedrivergauge_tbl_string,
-        headers_joined=headers_joined)
 
-    # Build the entire SQL statement to be executed
-    full_sql_string = sql_delete_insert_string + ",".join(sql_values_statements_list)
+    # A full refresh deletes every row. An incremental fetch upserts the changed gauges by deleting and reinserting
+    #   their rows, and has nothing to execute when no gauge changed. Inserts are made in rounds of 1000 records or
+    #   less to avoid the sql limit, and a full refresh with no gauges only deletes.
+    if full_refresh:
+        sql_delete_string = sql_delete_template.format(table=realtime_noaaobservedrivergauge_tbl_string)
+    elif changed_gauges_list:
+        gauge_ids = ",".join([f"'{gauge_obj.gaugelid}'" for gauge_obj in changed_gauges_list])
+        sql_delete_string = sql_delete_gauges_template.format(table=realtime_noaaobservedrivergauge_tbl_string,
+                                                              gauge_ids=gauge_ids)
+    else:
+        sql_delete_string = ""
+    sql_insert_gen = sql_insert_generator(sql_values_list=sql_values_statements_list,
+                                          step_increment=sql_insertion_step_increment,
+                                          sql_insert_string=sql_insert_template.format(
+                                              table=realtime_noaaobservedrivergauge_tbl_string,
+                                              headers_joined=headers_joined))
 
     # Build the sql for updating the task tracker table for this process.
     sql_task_tracker_update = f"UPDATE RealTime_TaskTracking SET lastRun = '{start_date_time}', DataGenerated = (SELECT max(DataGenerated) from {realtime_noaaobservedrivergauge_tbl_string}) WHERE taskName = '{task_name}'"
@@ -196,13 +1122,114 @@ def main():
     with pyodbc.connect(full_connection_string) as connection:
         cursor = connection.cursor()
         try:
-            cursor.execute(full_sql_string)
+            if sql_delete_string:
+                cursor.execute(sql_delete_string)
+            insert_round_count = 1
+            for batch in sql_insert_gen:
+                cursor.execute(batch)
+                print(f"Executing insert batch {insert_round_count}. Time elapsed {time_elapsed(start=start)}")
+                insert_round_count += 1
+
             cursor.execute(sql_task_tracker_update)
-        except pyodbc.DataError:
-            print(f"A value in the sql exceeds the field length allowed in database table: {full_sql_string}")
+        except (pyodbc.DataError, pyodbc.ProgrammingError) as e:
+
+            # Earlier rounds of the transaction are rolled back so a partial set of rows is never committed
+            connection.rollback()
+            print(f"Rows not written to {realtime_noaaobservedrivergauge_tbl_string}, the transaction is rolled "
+                  f"back. {e}")
         else:
             connection.commit()
-            print(f"Commit successful. Time elapsed {time_elapsed(start=start)}")
+            print(f"Commit successful. Rows written {len(sql_values_statements_list)}, payload bytes received "
+                  f"{payload_bytes_total}. Time elapsed {time_elapsed(start=start)}")
+
+            # The snapshot and watermark are saved only once the rows are committed so a failed run is fetched again
+            if INCREMENTAL_FETCH:
+                save_gauge_cache(cache_file=gauge_cache_file_path,
+                                 cache={"watermark": observation_watermark,
+                                        "last_full_refresh": (start.strftime(date_time_format) if full_refresh
+                                                              else gauge_cache["last_full_refresh"]),
+                                        "gauges": {gaugelid: asdict(gauge_obj)
+                                                   for gaugelid, gauge_obj in gauge_snapshot_dict.items()}})
+
+            # Join gauges to the active alert polygons and rewrite the mapping in its own transaction. The join is
+            #   optional so a failure, such as the table not existing, is rolled back without losing the gauges.
+            if JOIN_GAUGES_TO_ALERT_POLYGONS:
+                try:
+                    join_start = datetime.now()
+                    cursor.execute(sql_select_alert_polygons_template.format(
+                        table=realtime_noaacapalerts_tbl.format(database_name=database_name)))
+                    for link, event, wkt in cursor.fetchall():
+                        alert_polygon = create_alert_polygon_from_wkt(link=link, event=event, wkt=wkt)
+                        if alert_polygon is not None:
+                            alert_polygons_list.append(alert_polygon)
+                    snapshot_gauges_list = list(gauge_snapshot_dict.values())
+                    gauge_alert_pairs = join_gauges_to_alert_polygons(gauge_objs=snapshot_gauges_list,
+                                                                      alert_polygons=alert_polygons_list)
+                    print(f"Gauges joined to alert polygons. Gauges {len(snapshot_gauges_list)}, "
+                          f"polygons {len(alert_polygons_list)}, matches {len(gauge_alert_pairs)}. "
+                          f"Join time {time_elapsed(start=join_start)}")
+                    gauge_alerts_tbl_string = realtime_noaaobservedrivergaugealerts_tbl.format(
+                        database_name=database_name)
+                    gauge_alert_values_list = [sql_values_statement.format(
+                        values=sql_gauge_alert_values_string_template.format(gaugelid=gauge_obj.gaugelid,
+                                                                             link=alert_polygon.link,
+                                                                             event=alert_polygon.event,
+                                                                             data_gen=start_date_time))
+                        for gauge_obj, alert_polygon in gauge_alert_pairs]
+                    cursor.execute(sql_delete_template.format(table=gauge_alerts_tbl_string))
+                    for batch in sql_insert_generator(
+                            sql_values_list=gauge_alert_values_list,
+                            step_increment=sql_insertion_step_increment,
+                            sql_insert_string=sql_insert_template.format(
+                                table=gauge_alerts_tbl_string,
+                                headers_joined=",".join(realtime_noaaobservedrivergaugealerts_headers))):
+                        cursor.execute(batch)
+                except (pyodbc.DataError, pyodbc.ProgrammingError, ValueError) as e:
+                    connection.rollback()
+                    print(f"Gauge alert join not written, gauges are unaffected. {e}")
+                else:
+                    connection.commit()
+
+            # Link every gauge to its nearest USGS site and rewrite the links in its own transaction. The links are
+            #   optional so a failure, such as the table not existing, is rolled back without losing the gauges.
+            if LINK_GAUGES_TO_USGS_SITES and usgs_sites_list:
+                try:
+                    link_start = datetime.now()
+                    snapshot_gauges_list = list(gauge_snapshot_dict.values())
+                    site_grid_index = create_site_grid_index(usgs_sites=usgs_sites_list,
+                                                             max_distance_km=USGS_LINK_MAX_DISTANCE_KM)
+                    nearest_sites, nearest_distances = determine_nearest_sites(
+                        site_grid=site_grid_index,
+                        latitudes=np.array([gauge_obj.latitude for gauge_obj in snapshot_gauges_list], dtype=float),
+                        longitudes=np.array([gauge_obj.longitude for gauge_obj in snapshot_gauges_list],
+                                            dtype=float),
+                        max_distance_km=USGS_LINK_MAX_DISTANCE_KM)
+                    gauge_link_values_list = [sql_values_statement.format(
+                        values=sql_gauge_link_values_string_template.format(
+                            gaugelid=gauge_obj.gaugelid,
+                            site_number=site_grid_index.site_numbers[site_index],
+                            distance_km=distance_km,
+                            data_gen=start_date_time))
+                        for gauge_obj, site_index, distance_km in zip(snapshot_gauges_list, nearest_sites,
+                                                                      nearest_distances)
+                        if site_index >= 0]
+                    print(f"Gauges linked to USGS sites. Gauges {len(snapshot_gauges_list)}, "
+                          f"sites {len(usgs_sites_list)}, links {len(gauge_link_values_list)}. "
+                          f"Link time {time_elapsed(start=link_start)}")
+                    gauge_links_tbl_string = realtime_noaausgsgaugelinks_tbl.format(database_name=database_name)
+                    cursor.execute(sql_delete_template.format(table=gauge_links_tbl_string))
+                    for batch in sql_insert_generator(
+                            sql_values_list=gauge_link_values_list,
+                            step_increment=sql_insertion_step_increment,
+                            sql_insert_string=sql_insert_template.format(
+                                table=gauge_links_tbl_string,
+                                headers_joined=",".join(realtime_noaausgsgaugelinks_headers))):
+                        cursor.execute(batch)
+                except (pyodbc.DataError, pyodbc.ProgrammingError) as e:
+                    connection.rollback()
+                    print(f"Gauge links to USGS sites not written, gauges are unaffected. {e}")
+                else:
+                    connection.commit()
 
     print("\nProcess completed.")
     print(f"Time elapsed {time_elapsed(start=start)}")
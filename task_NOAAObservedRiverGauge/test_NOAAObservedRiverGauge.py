@@ -0,0 +1,128 @@
+"""
+Tests for the observation time and alert polygon handling of doit_NOAAObservedRiverGauge.
+The functions are nested in main() so they cannot be imported. The ones under test are compiled on their own from the
+script source, with the few names they use from main() supplied in their namespace.
+"""
+import ast
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from dateutil import parser as date_parser
+import numpy as np
+import os
+import pandas as pd
+from types import SimpleNamespace
+import unittest
+
+script_file_path = os.path.join(os.path.dirname(__file__), "doit_NOAAObservedRiverGauge.py")
+
+
+def load_nested_functions(function_names: set) -> dict:
+    """
+    Compile the named functions, and classes, nested in main() of the script and return the namespace holding them.
+    :param function_names: names of the nested functions and classes to compile
+    :return: dictionary namespace of the compiled functions and the names they use
+    """
+    with open(script_file_path, 'r') as handler:
+        tree = ast.parse(handler.read())
+    main_node = next(node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == "main")
+    namespace = {"dataclass": dataclass,
+                 "date_parser": date_parser,
+                 "date_time_format": '%Y-%m-%d %H:%M:%S',
+                 "datetime": datetime,
+                 "invalid_date_time_value": "1970-01-01 00:00:00",
+                 "np": np,
+                 "pd": pd,
+                 "timezone": timezone}
+    for node in main_node.body:
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef)) and node.name in function_names:
+            exec(compile(ast.Module(body=[node], type_ignores=[]), script_file_path, "exec"), namespace)
+    return namespace
+
+
+class TestObservationWatermark(unittest.TestCase):
+    """"""
+    def setUp(self):
+        self.functions = load_nested_functions(function_names={"create_naive_utc_datetime",
+                                                                "datetime_quality_control",
+                                                                "determine_observation_watermark",
+                                                                "process_watermark"})
+
+    def test_mixed_offset_and_plain_values(self):
+        """
+        A value with a trailing Z is converted to UTC and ordered among the plain values, and the watermark it gives
+        compares with the next run's values without raising a TypeError.
+        :return:
+        """
+        gauge_objs = [SimpleNamespace(data_gen=value) for value in ("2026-10-16 11:00:00",
+                                                                     "2026-10-16T12:00:00Z",
+                                                                     "2026-10-16T09:30:00-04:00",
+                                                                     "N/A")]
+        observation_times = self.functions["datetime_quality_control"](gauge_objs=gauge_objs)
+        self.assertEqual(list(observation_times[:3]), [pd.Timestamp("2026-10-16 11:00:00"),
+                                                       pd.Timestamp("2026-10-16 12:00:00"),
+                                                       pd.Timestamp("2026-10-16 13:30:00")])
+        self.assertTrue(pd.isna(observation_times[3]))
+        watermark = self.functions["determine_observation_watermark"](observation_times=observation_times,
+                                                                      watermark="2026-10-16 10:00:00")
+        self.assertEqual(watermark, "2026-10-16 13:30:00")
+
+        next_gauge_objs = [SimpleNamespace(data_gen=value) for value in ("2026-10-16 13:00:00",
+                                                                          "2026-10-16T14:00:00Z")]
+        next_observation_times = self.functions["datetime_quality_control"](gauge_objs=next_gauge_objs)
+        next_watermark = self.functions["determine_observation_watermark"](observation_times=next_observation_times,
+                                                                           watermark=watermark)
+        self.assertEqual(next_watermark, "2026-10-16 14:00:00")
+
+    def test_cached_raw_watermark_is_converted(self):
+        """
+        A watermark cached as a raw obstime value with an offset is converted to UTC in the known format.
+        :return:
+        """
+        self.assertEqual(self.functions["process_watermark"](watermark="2026-10-16T12:00:00Z"), "2026-10-16 12:00:00")
+        self.assertEqual(self.functions["process_watermark"](watermark="2026-10-16T08:00:00-04:00"),
+                         "2026-10-16 12:00:00")
+        self.assertEqual(self.functions["process_watermark"](watermark="2026-10-16 12:00:00"), "2026-10-16 12:00:00")
+        self.assertIsNone(self.functions["process_watermark"](watermark="N/A"))
+        self.assertIsNone(self.functions["process_watermark"](watermark=None))
+
+
+
+class TestAlertPolygon(unittest.TestCase):
+    """"""
+    def setUp(self):
+        self.functions = load_nested_functions(function_names={"AlertPolygon",
+                                                                "create_alert_polygon_from_wkt",
+                                                                "determine_points_in_polygon"})
+
+    def test_polygon_and_multipolygon(self):
+        """
+        Polygon and multipolygon text become edges that contain the points inside them.
+        :return:
+        """
+        alert_polygon = self.functions["create_alert_polygon_from_wkt"](
+            link="http://x/1", event="Flood Warning", wkt="POLYGON ((-79 39, -78 39, -78 40, -79 40, -79 39))")
+        self.assertEqual(alert_polygon.edges.shape, (4, 4))
+        self.assertEqual((alert_polygon.min_x, alert_polygon.min_y, alert_polygon.max_x, alert_polygon.max_y),
+                         (-79.0, 39.0, -78.0, 40.0))
+        multi_polygon = self.functions["create_alert_polygon_from_wkt"](
+            link="http://x/2", event="Flood Warning",
+            wkt="MULTIPOLYGON (((-79 39, -78 39, -78 40, -79 39)), ((-77 39, -76 39, -76 40, -77 39)))")
+        inside = self.functions["determine_points_in_polygon"](alert_polygon=multi_polygon,
+                                                               x_values=np.array([-78.2, -76.2, -77.5]),
+                                                               y_values=np.array([39.2, 39.2, 39.2]))
+        self.assertEqual(list(inside), [True, True, False])
+
+    def test_geometries_without_area_are_skipped(self):
+        """
+        Empty geometries, other geometry types, and rings without an edge give None instead of raising.
+        :return:
+        """
+        for wkt in ("POLYGON EMPTY", "MULTIPOLYGON EMPTY", "POINT (1 2)", "LINESTRING (1 2, 3 4)", "POLYGON ((1 2))"):
+            with self.subTest(wkt=wkt):
+                self.assertIsNone(self.functions["create_alert_polygon_from_wkt"](link="http://x/1",
+                                                                                  event="Flood Warning",
+                                                                                  wkt=wkt))
+
+
+if __name__ == "__main__":
+    unittest.main()
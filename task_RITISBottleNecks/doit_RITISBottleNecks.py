@@ -13,6 +13,15 @@ Author: CJuice, 20190513
 Revisions: 20190517, Added error handling for json.decoder.JSONDecoderError occurring and unhandled when the
     Response came back as None. The call to the requests modules .json() method on the response raised an exception
     when the response was None and couldn't be decoded. Added try/except to catch and exit with meaningful message.
+20261016, Added a parameterized insert path. When GEOMETRY_AS_WKB_PARAMETERS is True each line is encoded as well
+    known binary with struct and numpy and the rows are sent with a fast executemany of one short insert statement,
+    the geometry built by geometry::STGeomFromWKB from a binary parameter, instead of as STGeomFromText literals
+    embedded in the statement text. The description is now stored sliced and cleaned of apostrophes only when it is
+    put into statement text. Bytes sent and insert time are printed for either path.
+20261016, The geometry parameter of the parameterized insert is declared varbinary(max) with setinputsizes so fast
+    executemany does not size it from the first row, which truncated or rejected longer lines.
+20261016, GEOMETRY_AS_WKB_PARAMETERS is False until the parameterized insert has been run against the table. Its rows
+    are sent in rounds of sql_insertion_step_increment so a DataError loses only the rows of one round.
 """
 
 
@@ -28,8 +37,10 @@ def main():
     import os
     import pyodbc
     import requests
+    import struct
 
     # VARIABLES
+    GEOMETRY_AS_WKB_PARAMETERS = False  # OPTION, not yet run against the RealTime_RITISBottleNecks table
     TESTING = False  # OPTION
 
     _root_file_path = os.path.dirname(__file__)
@@ -45,11 +56,15 @@ def main():
                                  "stateID", "countyID", "geometry", "DataGenerated")
     sql_delete_template = """DELETE FROM {table};"""
     sql_insert_template = """INSERT INTO {table} ({headers_joined}) VALUES """
+    sql_insert_parameters_template = """INSERT INTO {table} ({headers_joined}) VALUES ({placeholders})"""
     sql_insertion_step_increment = 1000
+    sql_parameter_values_list = []
     sql_values_statement = """({values})"""
     sql_values_statements_list = []
     sql_values_string_template = """'{id}', '{start_time}', '{closed_time}', {length}, '{description}', '{city}', '{zip_code}', {state_id}, '{county_id}', {geometry}, '{data_gen}'"""
     task_name = "RITISBottleNecks"
+    wkb_geometry_types_dict = {"LINESTRING": 2}
+    wkb_little_endian_byte_order = 1
 
     print(f"Variables completed.")
 
@@ -67,6 +82,8 @@ def main():
         :param value:
         :return:
         """
+        if not isinstance(value, str):
+            return value
         return value.replace("'", "''")
 
     def create_database_connection_string(db_name: str, db_user: str, db_password: str) -> str:
@@ -96,6 +113,32 @@ def main():
         number_values = ", ".join([f"{lat} {lon}" for lat, lon in coordinate_pairs_list])
         return f"geometry::STGeomFromText('{geom_type.upper()}({number_values})', 4326)"
 
+    def create_geometry_wkb_value(coordinate_pairs_list: list, geom_type: str) -> bytes:
+        """
+        Create the well known binary of a line for use as a binary parameter to geometry::STGeomFromWKB.
+        The byte order, geometry type, and point count header is packed with struct and the coordinate pairs are
+        written as little endian doubles in one numpy call, in the same order as the text geometry.
+        :param coordinate_pairs_list: list of coordinate pairs for the feature of interest
+        :param geom_type: type value provided with the coordinate values in the RITIS response
+        :return: bytes of the well known binary
+        """
+        geometry_type_code = wkb_geometry_types_dict.get(geom_type.upper())
+        if geometry_type_code is None:
+            raise ValueError(f"Geometry type {geom_type} is not supported for well known binary")
+        coordinates = np.asarray(coordinate_pairs_list, dtype="<f8").reshape(-1, 2)
+        header = struct.pack("<BII", wkb_little_endian_byte_order, geometry_type_code, coordinates.shape[0])
+        return header + coordinates.tobytes()
+
+    def create_parameter_value(value):
+        """
+        Create the value of an insert parameter, with None for a missing value so it is inserted as NULL.
+        :param value: feature value
+        :return: the value, or None when it is NaN
+        """
+        if isinstance(value, float) and np.isnan(value):
+            return None
+        return value
+
     def determine_database_config_value_based_on_script_name() -> str:
         """
         Inspect the python script file name to see if it includes _PROD and return appropriate value.
@@ -111,6 +154,21 @@ def main():
         else:
             return "DATABASE_DEV"
 
+    def determine_parameter_bytes(value) -> int:
+        """
+        Determine the approximate number of bytes an insert parameter takes on the wire.
+        Strings are sent as UTF-16, numbers as eight bytes, binary as is, and NULL as nothing.
+        :param value: parameter value
+        :return: number of bytes
+        """
+        if value is None:
+            return 0
+        if isinstance(value, bytes):
+            return len(value)
+        if isinstance(value, str):
+            return len(value.encode("utf-16-le"))
+        return 8
+
     def process_date_time_strings(value, format_template):
         """
         Parse the date string using DateUtil parser and return string
@@ -166,6 +224,7 @@ def main():
         data_gen: str = np.NaN
         description: str = np.NaN
         geometry: str = np.NaN
+        geometry_wkb: bytes = None
         id: str = np.NaN
         length: float = np.NaN
         start_time: str = np.NaN
@@ -238,7 +297,13 @@ def main():
             geometry = feature.get("geometry", np.NaN)
             coordinates = geometry.get("coordinates", np.NaN)
             geometry_type = geometry.get("type", np.NaN)
-            geometry_string = create_geometry_string_value(coordinate_pairs_list=coordinates, geom_type=geometry_type)
+            if GEOMETRY_AS_WKB_PARAMETERS:
+                geometry_string = np.NaN
+                geometry_wkb = create_geometry_wkb_value(coordinate_pairs_list=coordinates, geom_type=geometry_type)
+            else:
+                geometry_string = create_geometry_string_value(coordinate_pairs_list=coordinates,
+                                                               geom_type=geometry_type)
+                geometry_wkb = None
             properties_dict = feature.get("properties", np.NaN)[0]  # List of length 1 at time of design
             length = float(properties_dict.get("length", np.NaN))
             start_time = properties_dict.get("startTimestamp", np.NaN)
@@ -247,14 +312,13 @@ def main():
             closed_time_parsed = process_date_time_strings(value=closed_time, format_template=date_time_format)
             location_dict = properties_dict.get("location", np.NaN)
             description = location_dict.get("description", np.NaN)
-            description_cleaned = clean_string_of_apostrophes_for_sql(value=description)  # see function for note
-            description_cleaned = description_cleaned[:50]  # FIXME: Due to database size limitation, have to slice this. To amend database requires more permission than I have so this is temp fix until DBA does so. Values were exceeding len == 50.
+            description_sliced = description[:50]  # FIXME: Due to database size limitation, have to slice this. To amend database requires more permission than I have so this is temp fix until DBA does so. Values were exceeding len == 50.
             city = location_dict.get("city", np.NaN)
             zip_code = location_dict.get("zipcode", np.NaN)
             # state_id = int(location_dict.get("state", np.NaN)[0].get("fips", np.NaN))  # MD fips is always 24
             county_dict = location_dict.get("county", np.NaN)[0]  # List of length 1 at time of design
             county_id = county_dict.get("fips", np.NaN)
-        except AttributeError as ae:
+        except (AttributeError, ValueError) as ae:
 
             """Protecting against an issue in all the extractison above. If can get an id, then proceed and try others.
                 As long as have an id then I can make a unique object for database entry and also will help identify
@@ -268,8 +332,9 @@ def main():
                                                 closed_time=closed_time_parsed,
                                                 county_id=county_id,
                                                 data_gen=data_gen_parsed,
-                                                description=description_cleaned,
+                                                description=description_sliced,
                                                 geometry=geometry_string,
+                                                geometry_wkb=geometry_wkb,
                                                 id=id,
                                                 length=length,
                                                 start_time=start_time_parsed,
@@ -278,21 +343,30 @@ def main():
                                                 )
                                         )
 
-    # Need to build the values string statements for use later on with sql insert statement.
-    for feature_obj in feature_objects_list:
-        values = sql_values_string_template.format(id=feature_obj.id,
-                                                   start_time=feature_obj.start_time,
-                                                   closed_time=feature_obj.closed_time,
-                                                   length=feature_obj.length,
-                                                   description=feature_obj.description,
-                                                   city=feature_obj.city,
-                                                   zip_code=feature_obj.zip_code,
-                                                   state_id=feature_obj.state_id,
-                                                   county_id=feature_obj.county_id,
-                                                   geometry=feature_obj.geometry,
-                                                   data_gen=feature_obj.data_gen)
-        values_string = sql_values_statement.format(values=values)
-        sql_values_statements_list.append(values_string)
+    if GEOMETRY_AS_WKB_PARAMETERS:
+        # Need to build the parameter values for the parameterized insert, in the order of the table headers
+        for feature_obj in feature_objects_list:
+            sql_parameter_values_list.append(tuple(create_parameter_value(value=value) for value in (
+                feature_obj.id, feature_obj.start_time, feature_obj.closed_time, feature_obj.length,
+                feature_obj.description, feature_obj.city, feature_obj.zip_code, feature_obj.state_id,
+                feature_obj.county_id, feature_obj.geometry_wkb, feature_obj.data_gen)))
+    else:
+        # Need to build the values string statements for use later on with sql insert statement.
+        for feature_obj in feature_objects_list:
+            values = sql_values_string_template.format(id=feature_obj.id,
+                                                       start_time=feature_obj.start_time,
+                                                       closed_time=feature_obj.closed_time,
+                                                       length=feature_obj.length,
+                                                       description=clean_string_of_apostrophes_for_sql(
+                                                           value=feature_obj.description),  # see function for note
+                                                       city=feature_obj.city,
+                                                       zip_code=feature_obj.zip_code,
+                                                       state_id=feature_obj.state_id,
+                                                       county_id=feature_obj.county_id,
+                                                       geometry=feature_obj.geometry,
+                                                       data_gen=feature_obj.data_gen)
+            values_string = sql_values_statement.format(values=values)
+            sql_values_statements_list.append(values_string)
 
     # Database Transactions
     print(f"\nDatabase operations initiated. Time elapsed {time_elapsed(start=start)}")
@@ -311,6 +385,18 @@ def main():
         table=database_table_name,
         headers_joined=headers_joined)
 
+    # The parameterized insert has a placeholder per column, with the geometry built from its binary parameter
+    sql_insert_parameters_string = sql_insert_parameters_template.format(
+        table=database_table_name,
+        headers_joined=headers_joined,
+        placeholders=", ".join(["geometry::STGeomFromWKB(?, 4326)" if header == "geometry" else "?"
+                                for header in ritis_bottlenecks_headers]))
+
+    # Fast executemany sizes each parameter from the first row's value. Well known binary lines can exceed 8000 bytes
+    #   and the first row's may be short or None, so the geometry is declared varbinary(max) to avoid truncation.
+    sql_parameter_input_sizes = [(pyodbc.SQL_VARBINARY, 0, 0) if header == "geometry" else None
+                                 for header in ritis_bottlenecks_headers]
+
     # Need the insert statement generator to be ready for database insertion rounds
     sql_insert_gen = sql_insert_generator(sql_values_list=sql_values_statements_list,
                                           step_increment=sql_insertion_step_increment,
@@ -331,17 +417,43 @@ def main():
         else:
             print(f"Delete statement executed. Time elapsed {time_elapsed(start=start)}")
 
-        # Need insert statement in rounds of 1000 records or less to avoid sql limit
-        insert_round_count = 1
-        for batch in sql_insert_gen:
-            try:
-                cursor.execute(batch)
-            except pyodbc.DataError:
-                print(f"A value in the sql exceeds the field length allowed in database table: {batch}")
-                # print(f"A value in the sql exceeds the field length allowed in database table")
-            else:
-                print(f"Executing insert batch {insert_round_count}. Time elapsed {time_elapsed(start=start)}")
-                insert_round_count += 1
+        # Need insert statement in rounds of 1000 records or less to avoid sql limit. The parameterized insert has
+        #   no such limit but is also sent in rounds, each a fast executemany call, since a value that does not fit
+        #   fails the whole call. A DataError then loses only the rows of its round, as with the text statements.
+        insert_start = datetime.now()
+        if GEOMETRY_AS_WKB_PARAMETERS:
+            bytes_sent = len(sql_insert_parameters_string.encode("utf-16-le")) + sum(
+                determine_parameter_bytes(value=value)
+                for parameter_values in sql_parameter_values_list for value in parameter_values)
+            cursor.fast_executemany = True
+            insert_round_count = 1
+            for i in range(0, len(sql_parameter_values_list), sql_insertion_step_increment):
+                parameter_values_in_range = sql_parameter_values_list[i: i + sql_insertion_step_increment]
+                try:
+                    cursor.setinputsizes(sql_parameter_input_sizes)
+                    cursor.executemany(sql_insert_parameters_string, parameter_values_in_range)
+                except pyodbc.DataError:
+                    print(f"A value in the sql exceeds the field length allowed in database table: "
+                          f"{database_table_name}. Rows {i + 1} to {i + len(parameter_values_in_range)} not inserted")
+                else:
+                    print(f"Executing insert batch {insert_round_count}. Time elapsed {time_elapsed(start=start)}")
+                    insert_round_count += 1
+        else:
+            bytes_sent = 0
+            insert_round_count = 1
+            for batch in sql_insert_gen:
+                bytes_sent += len(batch.encode("utf-16-le"))
+                try:
+                    cursor.execute(batch)
+                except pyodbc.DataError:
+                    print(f"A value in the sql exceeds the field length allowed in database table: {batch}")
+                    # print(f"A value in the sql exceeds the field length allowed in database table")
+                else:
+                    print(f"Executing insert batch {insert_round_count}. Time elapsed {time_elapsed(start=start)}")
+                    insert_round_count += 1
+        print(f"Inserted {len(feature_objects_list)} features "
+              f"{'with well known binary parameters' if GEOMETRY_AS_WKB_PARAMETERS else 'with text statements'}. "
+              f"Bytes sent {bytes_sent}. Insert time {time_elapsed(start=insert_start)}")
 
         # Need to update the task tracker table to record last run time
         try:
@@ -10,48 +10,155 @@ to be inserted exceeds the 1000 record sql limit so insert statements happen in
 of design there were over 2400 gauges.
 Redesigned from the original CGIS version when MEMA server environments were being migrated to new versions.
 Author: CJuice, 20190404
-Revisions:
-
+Revisions: 20261016, The state requests, and the decoding of their JSON, are made concurrently over a single pooled
+    keep-alive session that asks for gzip responses, instead of one state after another. The number of simultaneous
+    requests is set by the MAX_CONCURRENT_REQUESTS option. Gauges are merged in state list order so the inserted
+    rows come out in the same order as before.
+20261016, Added an incremental fetch. The previous run's watermark and the latest reading of every site and
+    parameter are kept in a local json cache. Runs request only the series modified since the watermark, using the
+    NWIS modifiedSince parameter, and merge them into the cached snapshot. Only the rows of sites whose readings
+    changed are deleted and reinserted. A full refresh, with the original delete and insert of every row, is run when
+    there is no cache, when FULL_REFRESH_INTERVAL_HOURS have passed since the last one, or when INCREMENTAL_FETCH is
+    False. Payload bytes and rows written are printed for both modes.
+20261016, Added a streaming json option. When STREAMING_JSON_PARSE is True the response is decoded from the byte
+    stream as it downloads. The queryInfo object is decoded, then each item of the timeSeries array is decoded, turned
+    into a Gauge, and discarded, so the whole document is never held in memory. Peak memory is printed when
+    REPORT_PARSE_MEMORY is True.
+20261016, Added a one row per site layout. A site reporting both discharge and gauge height produced two rows, each
+    with a -9999 placeholder for the other parameter. The rows to be written are now pivoted by site code into a
+    single row carrying both values and the later of the two collected dates. LEGACY_TWO_ROW_LAYOUT keeps the two row
+    layout, and is True until the RealTime_UpdateUSGSStreamGagesStatus procedure is migrated to the new layout.
+20261016, Added a tab-delimited ingestion engine. When RESPONSE_FORMAT is "rdb" the compact RDB format is requested
+    instead of json and read line by line as it streams. Site names and the retrieved date come from the comment
+    lines and each reading from the latest row with a value in its parameter column. The same Gauge objects result.
+20261016, Added a query planner. QUERY_SCOPE selects the original whole state requests, a region polygon, or a list
+    of watched sites. A region is tiled into bBox requests within the NWIS limit of 25 square degrees and series
+    outside the polygon are dropped before Gauge objects are built. RDB responses carry no site locations so with that
+    format only the tiles limit the sites. Watched sites are requested in chunks of sites. Series received from more
+    than one request are kept once. Sites received are printed with the payload bytes.
+20261016, Added trend detection. Each run appends one reading per site to a local fixed width ring buffer file that
+    is memory mapped and holds about a week of 15 minute readings. The buffer is then read and, with vectorized numpy
+    grouping by site, the gauge height rate of rise and discharge percent change over the trend window are computed.
+    The trends are written to the RealTime_USGSStreamGageTrends table in the same transaction as the gauges.
+20261016, Moved the status update into the same connection and transaction as the load, in place of a second
+    connection after the commit. When STATUS_CHANGED_SITES_ONLY is True an incremental run passes the changed site
+    numbers as a table-valued parameter to RealTime_UpdateUSGSStreamGagesStatusForSites, which updates only those
+    sites, and skips the status update when no site changed. A full refresh still runs the whole table procedure.
+    The time spent updating status is printed.
+20261016, The incremental fetch watermark is kept in UTC so the modifiedSince duration is not an hour short across
+    the fall daylight saving change. A cache holding the previous local time watermark triggers a full refresh.
+20261016, Trend readings of an incremental run come from the snapshot rows of the changed sites so both parameters
+    are recorded, and only the records inside the trend window are read back from the buffer. The trends are written
+    in their own transaction after the gauges are committed, and RECORD_TRENDS is False until their table exists.
+20261016, STATUS_CHANGED_SITES_ONLY is False until RealTime_UpdateUSGSStreamGagesStatusForSites exists. When that
+    procedure is missing the whole table procedure is run instead. The status update follows a savepoint so an error
+    in it is rolled back alone and reported, rather than exiting and losing the rows.
+20261016, When an error in the status update dooms the transaction the rollback to the status savepoint fails too.
+    The whole transaction is then rolled back and reported, and the commit, trends, and cache save are skipped so the
+    next run fetches the rows again.
 """
 
 
 def main():
 
     # IMPORTS
-    from dataclasses import dataclass
-    from datetime import datetime
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from dataclasses import asdict, dataclass, replace
+    from datetime import datetime, timedelta, timezone
     from dateutil import parser as date_parser
+    import codecs
     import configparser
+    import json
+    import math
     import numpy as np
     import os
     import pandas as pd
     import pyodbc
+    import re
     import requests
+    import tracemalloc
+    from requests.adapters import HTTPAdapter
 
     # VARIABLES
+    FULL_REFRESH_INTERVAL_HOURS = 24  # OPTION
+    INCREMENTAL_FETCH = True  # OPTION
+    LEGACY_TWO_ROW_LAYOUT = True  # OPTION
+    MAX_CONCURRENT_REQUESTS = 4  # OPTION
+    QUERY_SCOPE = "state"  # OPTION
+    RECORD_TRENDS = False  # OPTION, requires the RealTime_USGSStreamGageTrends table
+    REPORT_PARSE_MEMORY = False  # OPTION
+    RESPONSE_FORMAT = "json"  # OPTION
+    STATUS_CHANGED_SITES_ONLY = False  # OPTION, requires the RealTime_UpdateUSGSStreamGagesStatusForSites procedure
+    STREAMING_JSON_PARSE = True  # OPTION
+
     _root_file_path = os.path.dirname(__file__)
+    changed_site_codes_dict = {}
     config_file = r"doit_config_USGSStreamGauge.cfg"
     config_file_path = os.path.join(_root_file_path, config_file)
     database_connection_string = "DSN={database_name};UID={database_user};PWD={database_password}"
+    date_time_format = '%Y-%m-%d %H:%M:%S'
+    gauge_cache_file = r"doit_cache_USGSStreamGauge.json"
+    gauge_cache_file_path = os.path.join(_root_file_path, gauge_cache_file)
     gauge_objects_list = []
+    gauge_rows_to_write_list = []
+    json_array_separator_pattern = re.compile(r"[\s,]*")
+    json_key_patterns_dict = {key: re.compile(rf'"{key}"\s*:\s*') for key in ("queryInfo", "timeSeries")}
+    modified_since_overlap_minutes = 5
+    payload_bytes_total = 0
+    query_gauges_dict = {}
+    request_timeout_seconds = 120
+    rdb_retrieved_pattern = re.compile(r"#\s*retrieved:\s*([^\t(]+)")
+    rdb_site_name_pattern = re.compile(r"#\s+USGS\s+(\d+)\s+(.+)")
+    rdb_value_column_pattern = re.compile(r"\d+_(\d{5})")
+    region_max_tile_square_degrees = 25
+    region_polygon_coordinates = [(-80.0, 39.0), (-79.5, 40.2), (-75.0, 40.2), (-74.8, 38.3), (-75.6, 37.6),
+                                  (-77.5, 37.8), (-79.0, 38.3), (-80.0, 39.0)]
+    region_polygon_array = np.array(region_polygon_coordinates, dtype=float)
     realtime_usgsstreamgauge_tbl = "[{database_name}].[dbo].[RealTime_USGSStreamGages]"
+    realtime_usgsstreamgaugetrends_tbl = "[{database_name}].[dbo].[RealTime_USGSStreamGageTrends]"
+    sql_delete_sites_template = """DELETE FROM {table} WHERE SiteNumber IN ({site_numbers});"""
     sql_delete_template = """DELETE FROM {table};"""
     sql_insert_template = """INSERT INTO {table} ({headers_joined}) VALUES """
     sql_insertion_step_increment = 1000
+    sql_trend_values_string_template = """'{site_number}', {rate_of_rise}, {percent_change}, '{window_start}', '{window_end}', '{data_gen}'"""
+    sql_trend_values_statements_list = []
     sql_values_statement = """({values})"""
     sql_values_statements_list = []
     sql_values_string_template = """'{site_number}', '{discharge}', '{gauge_height}','{status}', '{collected_date}', '{data_gen}'"""
+    site_request_chunk_size = 100
+    sql_status_procedure = "exec RealTime_UpdateUSGSStreamGagesStatus"
+    sql_status_savepoint = "SAVE TRANSACTION StatusUpdate"
+    sql_status_savepoint_rollback = "ROLLBACK TRANSACTION StatusUpdate"
+    sql_status_sites_procedure = "exec RealTime_UpdateUSGSStreamGagesStatusForSites @SiteNumbers = ?"
     state_abbreviations_list = ["md", "dc", "de", "pa", "wv", "va", "nc", "sc"]
+    stream_chunk_size = 64 * 1024
     task_name = "USGSStreamGages"
+    trend_buffer_capacity = 3000 * 7 * 96
+    trend_buffer_file = r"doit_trends_USGSStreamGauge.dat"
+    trend_buffer_file_path = os.path.join(_root_file_path, trend_buffer_file)
+    trend_buffer_header_length = 2
+    trend_buffer_read_chunk_length = 3000 * 4
+    trend_record_dtype = np.dtype([("site_code", "S15"),
+                                   ("timestamp", np.int64),
+                                   ("discharge", np.float64),
+                                   ("gauge_height", np.float64)])
+    trend_window_hours = 6
+    usgs_request_headers = {"Accept-Encoding": "gzip"}
     usgs_query_payload = {"format": "json",
                           "stateCd": None,
                           "parameterCd": "00060,00065",
                           "siteStatus": "active"}
     usgs_streamgauge_headers = ("SiteNumber", "Discharge", "GageHeight", "Status", "collectedDate", "DataGenerated")
+    usgs_streamgaugetrends_headers = ("SiteNumber", "GageHeightRateOfRise", "DischargePercentChange", "WindowStart",
+                                      "WindowEnd", "DataGenerated")
     usgs_url = r"http://waterservices.usgs.gov/nwis/iv/"
+    watched_sites_file = r"doit_watched_sites_USGSStreamGauge.txt"
+    watched_sites_file_path = os.path.join(_root_file_path, watched_sites_file)
 
     # ASSERTS
     assert os.path.exists(config_file_path)
+    assert RESPONSE_FORMAT in ("json", "rdb")
+    assert QUERY_SCOPE in ("state", "region", "sites")
 
     # CLASSES
     @dataclass
@@ -62,12 +169,103 @@ def main():
         state_abbrev: str
         site_name: str
         site_code: str
+        variable_code: str
         discharge: float
         gauge_height: float
         data_gen: str
         collect_date: str
 
     # FUNCTIONS
+    def append_trend_records(header: np.memmap, records: np.memmap, gauge_objs: list) -> None:
+        """
+        Append one reading per site to the ring buffer, overwriting the oldest readings once the buffer is full.
+        The header holds the count of records ever written, so the next write position is that count modulo capacity.
+        The -9999 placeholder of a parameter a site does not report is stored as NaN.
+        :param header: memory mapped int64 header of the buffer file
+        :param records: memory mapped fixed width records of the buffer file
+        :param gauge_objs: list of Gauge dataclass objects, one per site
+        :return: None
+        """
+        new_records = np.zeros(len(gauge_objs), dtype=trend_record_dtype)
+        new_records["site_code"] = [gauge_obj.site_code for gauge_obj in gauge_objs]
+        new_records["timestamp"] = np.array([gauge_obj.collect_date for gauge_obj in gauge_objs],
+                                            dtype="datetime64[s]").astype(np.int64)
+        for field_name in ("discharge", "gauge_height"):
+            values = np.array([getattr(gauge_obj, field_name) for gauge_obj in gauge_objs], dtype=np.float64)
+            new_records[field_name] = np.where(values == -9999, np.NaN, values)
+        positions = (header[0] + np.arange(len(new_records))) % len(records)
+        records[positions] = new_records
+        header[0] += len(new_records)
+        records.flush()
+        header.flush()
+
+    def compute_site_trends(records: np.ndarray, window_seconds: int) -> dict:
+        """
+        Compute each site's gauge height rate of rise, in feet per hour, and discharge percent change over the window
+        ending at the site's latest reading, and return them.
+        Records are sorted by site and timestamp and repeated readings are dropped. The first reading inside each
+        site's window is found with a minimum reduction over the site groups, so no python loop runs per site.
+        A trend is NaN when the window holds a single reading or a value is missing.
+        :param records: array of trend records
+        :param window_seconds: length of the trend window in seconds
+        :return: dictionary of site codes, window start and end timestamps, rates of rise, and percent changes
+        """
+        order = np.lexsort((records["timestamp"], records["site_code"]))
+        records = records[order]
+        is_repeat = np.zeros(len(records), dtype=bool)
+        is_repeat[1:] = ((records["site_code"][1:] == records["site_code"][:-1])
+                         & (records["timestamp"][1:] == records["timestamp"][:-1]))
+        records = records[~is_repeat]
+
+        # Records are already sorted by site so each site group starts where the site code changes
+        is_group_start = np.ones(len(records), dtype=bool)
+        is_group_start[1:] = records["site_code"][1:] != records["site_code"][:-1]
+        group_starts = np.flatnonzero(is_group_start)
+        group_counts = np.diff(np.append(group_starts, len(records)))
+        site_codes = records["site_code"][group_starts]
+        latest_index = group_starts + group_counts - 1
+        window_start_threshold = np.repeat(records["timestamp"][latest_index] - window_seconds, group_counts)
+        record_index = np.arange(len(records))
+        in_window_index = np.where(records["timestamp"] >= window_start_threshold, record_index, len(records))
+        first_index = np.minimum.reduceat(in_window_index, group_starts)
+        elapsed_hours = (records["timestamp"][latest_index] - records["timestamp"][first_index]) / 3600
+        first_discharge = records["discharge"][first_index]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate_of_rise = np.where(elapsed_hours > 0,
+                                    (records["gauge_height"][latest_index] - records["gauge_height"][first_index])
+                                    / elapsed_hours,
+                                    np.NaN)
+            percent_change = np.where((elapsed_hours > 0) & (first_discharge > 0),
+                                      (records["discharge"][latest_index] - first_discharge) / first_discharge * 100,
+                                      np.NaN)
+        return {"site_code": site_codes.astype(str),
+                "window_start": records["timestamp"][first_index],
+                "window_end": records["timestamp"][latest_index],
+                "rate_of_rise": rate_of_rise,
+                "percent_change": percent_change}
+
+    def create_bounding_box_tiles(min_x: float, min_y: float, max_x: float, max_y: float) -> list:
+        """
+        Split a bounding box into equal tiles that each stay within the NWIS bBox area limit and return their values.
+        :param min_x: western longitude
+        :param min_y: southern latitude
+        :param max_x: eastern longitude
+        :param max_y: northern latitude
+        :return: list of bBox parameter strings like '-80.000000,37.600000,-74.800000,40.200000'
+        """
+        tile_side = math.sqrt(region_max_tile_square_degrees)
+        column_count = max(1, math.ceil((max_x - min_x) / tile_side))
+        row_count = max(1, math.ceil((max_y - min_y) / tile_side))
+        tile_width = (max_x - min_x) / column_count
+        tile_height = (max_y - min_y) / row_count
+        tiles = []
+        for row in range(row_count):
+            for column in range(column_count):
+                west = min_x + column * tile_width
+                south = min_y + row * tile_height
+                tiles.append(f"{west:.6f},{south:.6f},{west + tile_width:.6f},{south + tile_height:.6f}")
+        return tiles
+
     def create_database_connection_string(db_name: str, db_user: str, db_password: str) -> str:
         """
         Create the connection string for accessing database and return.
@@ -84,6 +282,210 @@ def main():
         """
         return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
+    def create_gauge_from_time_series_item(gauge_json: dict, state_abbrev: str, data_gen: str) -> Gauge:
+        """
+        Create a Gauge object from an item of the time series json and return it.
+        :param gauge_json: gauge json object from the time series json
+        :param state_abbrev: state abbreviation the request was made for
+        :param data_gen: processed data generated value from the query info
+        :return: Gauge dataclass object
+        """
+        source_info_json = extract_source_info(gauge_json=gauge_json)
+        second_level_values_json = extract_second_level_values(gauge_json=gauge_json)
+        site_name = extract_site_name(source_info_json=source_info_json)
+        site_code = extract_site_code(source_info_json=source_info_json)
+        variable_code = extract_variable_code(gauge_json=gauge_json)
+        variable_value = extract_variable_value(second_level_json=second_level_values_json)
+        collected_date = extract_collected_date(second_level_json=second_level_values_json)
+        collected_date_processed = process_date_string(date_string=collected_date)
+        discharge = determine_discharge_value(variable_code=variable_code, variable_value=variable_value)
+        gauge_height = determine_gauge_height_value(variable_code=variable_code, variable_value=variable_value)
+        site_code_processed = process_site_code(site_code=site_code)
+
+        # Need to build the Gauge objects and store for use in sql inseration
+        return Gauge(state_abbrev=state_abbrev,
+                     site_name=site_name,
+                     site_code=site_code_processed,
+                     variable_code=variable_code,
+                     discharge=discharge,
+                     gauge_height=gauge_height,
+                     data_gen=data_gen,
+                     collect_date=collected_date_processed)
+
+    def create_gauge_key(gauge_obj: Gauge) -> str:
+        """
+        Create the key that identifies a gauge reading in the snapshot. A site has a reading for each parameter.
+        :param gauge_obj: Gauge dataclass object
+        :return: string of site code and variable code
+        """
+        return f"{gauge_obj.site_code}|{gauge_obj.variable_code}"
+
+    def create_gauges_from_rdb_lines(rdb_lines, state_abbrev: str) -> list:
+        """
+        Create Gauge objects from the lines of a state's tab-delimited (RDB) response as they are read and return them.
+        Comment lines carry the site names and the retrieved date. Each site's block has a line of column names, then
+        a line of column formats, then data rows. Parameter value columns are named like '69928_00060', a time series
+        id and parameter code. A site's reading for a parameter is taken from the latest row with a value.
+        :param rdb_lines: iterable of byte lines from the response
+        :param state_abbrev: state abbreviation the request was made for
+        :return: list of Gauge dataclass objects
+        """
+        site_names_dict = {}
+        site_readings_dict = {}
+        data_gen_processed = None
+        value_columns = []
+        skip_format_line = False
+        for raw_line in rdb_lines:
+            line = raw_line.decode("utf-8", errors="replace")
+            if not line:
+                continue
+            if line.startswith("#"):
+                site_name_match = rdb_site_name_pattern.match(line)
+                retrieved_match = rdb_retrieved_pattern.match(line)
+                if site_name_match:
+                    site_names_dict[site_name_match.group(1)] = site_name_match.group(2).strip()
+                elif retrieved_match and data_gen_processed is None:
+                    data_gen_processed = process_retrieved_date_string(date_string=retrieved_match.group(1).strip())
+                continue
+            fields = line.split("\t")
+            if fields[0] == "agency_cd":
+                value_columns = [(index, column[-5:]) for index, column in enumerate(fields)
+                                 if rdb_value_column_pattern.fullmatch(column)]
+                skip_format_line = True
+                continue
+            if skip_format_line:
+                skip_format_line = False
+                continue
+            for index, variable_code in value_columns:
+                if index < len(fields) and fields[index] != "":
+                    site_readings_dict[(fields[1], variable_code)] = (fields[index], fields[2])
+
+        state_gauges = []
+        for (site_code, variable_code), (variable_value, collected_date) in site_readings_dict.items():
+            state_gauges.append(Gauge(state_abbrev=state_abbrev,
+                                      site_name=site_names_dict.get(site_code, np.NaN),
+                                      site_code=process_site_code(site_code=site_code),
+                                      variable_code=variable_code,
+                                      discharge=determine_discharge_value(variable_code=variable_code,
+                                                                          variable_value=variable_value),
+                                      gauge_height=determine_gauge_height_value(variable_code=variable_code,
+                                                                                variable_value=variable_value),
+                                      data_gen=data_gen_processed,
+                                      collect_date=process_date_string(date_string=collected_date)))
+        return state_gauges
+
+    def create_gauges_from_response_json(response_json: dict, state_abbrev: str) -> list:
+        """
+        Create Gauge objects from the time series in a state's response json and return them.
+        :param response_json: decoded json from the USGS response for a state
+        :param state_abbrev: state abbreviation the request was made for
+        :return: list of Gauge dataclass objects
+        """
+        # extract values from response json for gauge json object interrogation and Gauge object creation
+        state_gauges = []
+        value_json = response_json.get("value", {})
+        time_series_json = value_json.get("timeSeries", {})
+
+        data_gen = extract_data_generated_value(value_json=value_json)
+        data_gen_processed = process_date_string(date_string=data_gen)
+
+        # Need to iterate over gauge objects in time series json and extract/process data for values of interest
+        for gauge_json in time_series_json:
+            if not determine_gauge_json_in_region(gauge_json=gauge_json):
+                continue
+            state_gauges.append(create_gauge_from_time_series_item(gauge_json=gauge_json,
+                                                                   state_abbrev=state_abbrev,
+                                                                   data_gen=data_gen_processed))
+        return state_gauges
+
+    def create_gauges_from_streamed_response(response: requests.Response, state_abbrev: str) -> list:
+        """
+        Create Gauge objects from a state's response as the json is streamed and return them.
+        :param response: requests Response made with stream=True
+        :param state_abbrev: state abbreviation the request was made for
+        :return: list of Gauge dataclass objects
+        """
+        state_gauges = []
+        data_gen_processed = None
+        for key, json_value in iterate_streamed_time_series(response=response):
+            if key == "queryInfo":
+                data_gen = extract_data_generated_value(value_json={key: json_value})
+                data_gen_processed = process_date_string(date_string=data_gen)
+            elif determine_gauge_json_in_region(gauge_json=json_value):
+                state_gauges.append(create_gauge_from_time_series_item(gauge_json=json_value,
+                                                                       state_abbrev=state_abbrev,
+                                                                       data_gen=data_gen_processed))
+        return state_gauges
+
+    def create_modified_since_duration(watermark: datetime, now: datetime) -> str:
+        """
+        Create the ISO 8601 duration for the NWIS modifiedSince parameter covering the time since the watermark.
+        A few minutes of overlap are added so series modified while the previous run was in progress are not missed.
+        Both datetimes are in UTC. Local times would make the duration an hour short across the fall daylight saving
+        change, and series modified in that hour would be missed.
+        :param watermark: UTC datetime the previous run started requesting
+        :param now: UTC datetime of this run
+        :return: string duration like 'PT20M'
+        """
+        minutes = math.ceil((now - watermark).total_seconds() / 60) + modified_since_overlap_minutes
+        return f"PT{minutes}M"
+
+    def create_pooled_session(pool_size: int) -> requests.Session:
+        """
+        Create a requests Session with a connection pool large enough to hold a keep-alive connection per worker.
+        All states are requested from the same USGS host so reusing connections avoids a new handshake per request.
+        :param pool_size: number of connections the pool may keep open
+        :return: requests Session
+        """
+        session = requests.Session()
+        session.headers.update(usgs_request_headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def create_query_plan() -> dict:
+        """
+        Create the requests to be made for the configured query scope and return them.
+        The state scope is one request per state. The region scope is one bBox request per tile of the region's
+        bounding box. The sites scope is one request per chunk of watched sites, kept short enough for the url.
+        :return: dictionary of query labels and their query parameters, in request order
+        """
+        if QUERY_SCOPE == "region":
+            tiles = create_bounding_box_tiles(min_x=float(region_polygon_array[:, 0].min()),
+                                              min_y=float(region_polygon_array[:, 1].min()),
+                                              max_x=float(region_polygon_array[:, 0].max()),
+                                              max_y=float(region_polygon_array[:, 1].max()))
+            return {f"TILE {index + 1}": {"bBox": tile} for index, tile in enumerate(tiles)}
+        if QUERY_SCOPE == "sites":
+            watched_sites = load_watched_sites(sites_file=watched_sites_file_path)
+            return {f"SITES {index // site_request_chunk_size + 1}":
+                    {"sites": ",".join(watched_sites[index: index + site_request_chunk_size])}
+                    for index in range(0, len(watched_sites), site_request_chunk_size)}
+        return {state_abbrev.upper(): {"stateCd": state_abbrev} for state_abbrev in state_abbreviations_list}
+
+    def create_sql_trend_value(value: float) -> str:
+        """
+        Create the sql for a trend value, NULL when the trend could not be computed.
+        :param value: float trend value
+        :return: string for use in the sql values statement
+        """
+        return "NULL" if np.isnan(value) else f"{value:.4f}"
+
+    def create_sql_values_string(gauge_obj: Gauge) -> str:
+        """
+        Create the sql values statement for a gauge row and return.
+        :param gauge_obj: Gauge dataclass object
+        :return: string values statement
+        """
+        values = sql_values_string_template.format(site_number=gauge_obj.site_code,
+                                                   discharge=gauge_obj.discharge,
+                                                   gauge_height=gauge_obj.gauge_height,
+                                                   status=np.NaN,
+                                                   collected_date=gauge_obj.collect_date,
+                                                   data_gen=gauge_obj.data_gen)
+        return sql_values_statement.format(values=values)
+
     def determine_database_config_value_based_on_script_name() -> str:
         """
         Inspect the python script file name to see if it includes _PROD and return appropriate value.
@@ -114,6 +516,31 @@ def main():
             return -9999
         return float(variable_value)
 
+    def determine_fetch_is_full_refresh(cache: dict, now: datetime) -> bool:
+        """
+        Determine if this run must request every series rather than only those modified since the last run.
+        :param cache: gauge cache from the previous run
+        :param now: datetime of this run
+        :return: True when a full refresh is needed
+        """
+        if not INCREMENTAL_FETCH or not cache.get("watermark_utc") or not cache.get("last_full_refresh"):
+            return True
+        last_full_refresh = datetime.strptime(cache["last_full_refresh"], date_time_format)
+        return now - last_full_refresh >= timedelta(hours=FULL_REFRESH_INTERVAL_HOURS)
+
+    def determine_gauge_changed(previous_gauge: Gauge, gauge_obj: Gauge) -> bool:
+        """
+        Determine if a gauge reading differs from the reading in the snapshot. The data generated value changes on
+        every request so it is not compared.
+        :param previous_gauge: Gauge dataclass object from the snapshot, or None when the reading is new
+        :param gauge_obj: Gauge dataclass object from this run
+        :return: True when the reading is new or changed
+        """
+        if previous_gauge is None:
+            return True
+        return ((previous_gauge.discharge, previous_gauge.gauge_height, previous_gauge.collect_date)
+                != (gauge_obj.discharge, gauge_obj.gauge_height, gauge_obj.collect_date))
+
     def determine_gauge_height_value(variable_code, variable_value) -> float:
         """
         Determine the gauge height value based on the variable code and value values.
@@ -129,6 +556,28 @@ def main():
             return -9999
         return float(variable_value)
 
+    def determine_gauge_json_in_region(gauge_json: dict) -> bool:
+        """
+        Determine if a time series item's site lies inside the region polygon using a ray casting test.
+        Always True unless the query scope is the region. A site without a location is treated as outside.
+        :param gauge_json: gauge json object from the time series json
+        :return: True when the site should be kept
+        """
+        if QUERY_SCOPE != "region":
+            return True
+        try:
+            geog_location_json = extract_source_info(gauge_json=gauge_json)["geoLocation"]["geogLocation"]
+            longitude = float(geog_location_json["longitude"])
+            latitude = float(geog_location_json["latitude"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        x1, y1 = region_polygon_array[:-1, 0], region_polygon_array[:-1, 1]
+        x2, y2 = region_polygon_array[1:, 0], region_polygon_array[1:, 1]
+        spans = (y1 > latitude) != (y2 > latitude)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = x1 + (latitude - y1) * (x2 - x1) / (y2 - y1)
+        return np.count_nonzero(spans & (longitude < crossing_x)) % 2 == 1
+
     def extract_collected_date(second_level_json):
         """
         Extract the value associated with the 'dateTime' key in the json
@@ -236,6 +685,159 @@ def main():
             print(f"extract_variable_value(): {e}")
             return np.NaN
 
+    def iterate_streamed_time_series(response: requests.Response):
+        """
+        Decode a USGS json response incrementally from the byte stream and yield the values of interest.
+        The queryInfo object is yielded first, then every item of the timeSeries array one at a time. Each value is
+        decoded with json.JSONDecoder.raw_decode once enough text has arrived, and the text before it is dropped.
+        Relies on the NWIS layout where queryInfo precedes timeSeries within the value object.
+        :param response: requests Response made with stream=True
+        :return: yield tuple of key, 'queryInfo' or 'timeSeries', and the decoded json value
+        """
+        json_decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder("utf-8")()
+        keys_remaining = ["queryInfo", "timeSeries"]
+        in_time_series = False
+        buffer = ""
+        for chunk in response.iter_content(chunk_size=stream_chunk_size):
+            buffer += text_decoder.decode(chunk)
+            position = 0
+            while True:
+                if in_time_series:
+                    position = json_array_separator_pattern.match(buffer, position).end()
+                    if position == len(buffer):
+                        break
+                    if buffer[position] == "]":
+                        return
+                    try:
+                        json_value, position_end = json_decoder.raw_decode(buffer, position)
+                    except json.JSONDecodeError:
+                        break
+                    position = position_end
+                    yield "timeSeries", json_value
+                else:
+                    key = keys_remaining[0]
+                    key_match = json_key_patterns_dict[key].search(buffer, position)
+                    if key_match is None or key_match.end() == len(buffer):
+                        position = max(position, len(buffer) - len(key) - 8)
+                        break
+                    if key == "timeSeries":
+                        in_time_series = True
+                        position = key_match.end() + 1
+                        continue
+                    try:
+                        json_value, position = json_decoder.raw_decode(buffer, key_match.end())
+                    except json.JSONDecodeError:
+                        position = key_match.start()
+                        break
+                    keys_remaining.pop(0)
+                    yield key, json_value
+            buffer = buffer[position:]
+        raise ValueError("Response ended before the timeSeries array was complete")
+
+    def execute_status_procedure(cursor: pyodbc.Cursor, site_codes: list) -> str:
+        """
+        Execute the stored procedure that updates gauge status and return the count of sites updated, for reporting.
+        Without site codes the whole table procedure is run. With site codes they are passed as a table-valued
+        parameter, a single parameter holding one row tuple per site, to the procedure for those sites alone. When that
+        procedure does not exist in the database the work is rolled back to the status savepoint and the whole table
+        procedure is run instead. If the savepoint cannot be rolled back to, the error is raised to the caller.
+        Nothing is run when the list of site codes is empty.
+        :param cursor: pyodbc cursor within the load transaction, after the status savepoint
+        :param site_codes: list of site codes whose status is to be updated, or None for every site
+        :return: string count of sites updated
+        """
+        if site_codes is None:
+            cursor.execute(sql_status_procedure)
+            return "all"
+        if not site_codes:
+            return "0"
+        try:
+            cursor.execute(sql_status_sites_procedure, [[(site_code,) for site_code in site_codes]])
+        except pyodbc.ProgrammingError as e:
+            print(f"Changed sites status procedure unavailable, updating the whole table instead. {e}")
+            if not rollback_to_status_savepoint(cursor=cursor):
+                raise
+            cursor.execute(sql_status_procedure)
+            return "all"
+        return str(len(site_codes))
+
+    def load_gauge_cache(cache_file: str) -> dict:
+        """
+        Load the gauge cache from the previous run. A missing or unreadable cache is treated as empty.
+        :param cache_file: path to the json cache file
+        :return: dictionary holding the watermark, last full refresh, and gauge snapshot
+        """
+        if not os.path.exists(cache_file):
+            return {}
+        try:
+            with open(cache_file, 'r') as handler:
+                return json.load(handler)
+        except (OSError, ValueError) as e:
+            print(f"Unable to load gauge cache {cache_file}. Proceeding with full refresh. {e}")
+            return {}
+
+    def load_watched_sites(sites_file: str) -> list:
+        """
+        Load the watched site numbers, one per line, and return them. Blank lines and lines starting with # are skipped.
+        :param sites_file: path to the watched sites text file
+        :return: list of site number strings
+        """
+        try:
+            with open(sites_file, 'r') as handler:
+                return [line.strip() for line in handler if line.strip() and not line.startswith("#")]
+        except OSError as e:
+            print(f"Unable to load watched sites {sites_file} for the sites query scope. Exiting process... {e}")
+            exit()
+
+    def open_trend_buffer(buffer_file: str, capacity: int) -> tuple:
+        """
+        Open the ring buffer file as memory maps of its int64 header and fixed width records and return them.
+        The header at offset 0 holds the count of records ever written and the capacity. The file is created, or
+        recreated when its capacity does not match, with the records starting immediately after the header.
+        :param buffer_file: path to the ring buffer file
+        :param capacity: number of records the buffer holds
+        :return: tuple of header memmap and records memmap
+        """
+        header_bytes = trend_buffer_header_length * np.dtype(np.int64).itemsize
+        expected_size = header_bytes + capacity * trend_record_dtype.itemsize
+        if os.path.exists(buffer_file) and os.path.getsize(buffer_file) == expected_size:
+            header = np.memmap(buffer_file, dtype=np.int64, mode="r+", shape=(trend_buffer_header_length,))
+            if header[1] == capacity:
+                records = np.memmap(buffer_file, dtype=trend_record_dtype, mode="r+", offset=header_bytes,
+                                    shape=(capacity,))
+                return header, records
+            del header
+        print(f"Creating trend buffer {buffer_file} for {capacity} records")
+        records = np.memmap(buffer_file, dtype=trend_record_dtype, mode="w+", offset=header_bytes, shape=(capacity,))
+        header = np.memmap(buffer_file, dtype=np.int64, mode="r+", shape=(trend_buffer_header_length,))
+        header[:] = (0, capacity)
+        header.flush()
+        return header, records
+
+    def pivot_gauges_by_site(gauge_objs: list) -> list:
+        """
+        Combine the discharge and gauge height readings of each site into a single Gauge and return them in the order
+        the sites were first seen. The collected date kept is the later of the readings' collected dates, which sort
+        chronologically as formatted strings. Gauges without a site code are kept as they are.
+        :param gauge_objs: list of Gauge dataclass objects, one per site and parameter
+        :return: list of Gauge dataclass objects, one per site
+        """
+        site_gauges_dict = {}
+        for gauge_obj in gauge_objs:
+            site_key = gauge_obj.site_code if pd.notnull(gauge_obj.site_code) else id(gauge_obj)
+            site_gauge = site_gauges_dict.get(site_key)
+            if site_gauge is None:
+                site_gauges_dict[site_key] = replace(gauge_obj)
+                continue
+            if gauge_obj.variable_code == "00060":
+                site_gauge.discharge = gauge_obj.discharge
+            elif gauge_obj.variable_code == "00065":
+                site_gauge.gauge_height = gauge_obj.gauge_height
+            site_gauge.variable_code = ",".join(sorted({*site_gauge.variable_code.split(","), gauge_obj.variable_code}))
+            site_gauge.collect_date = max(site_gauge.collect_date, gauge_obj.collect_date)
+        return list(site_gauges_dict.values())
+
     def process_date_string(date_string):
         """
         Parse the date string to datetime format using the dateutil parser and return string formatted
@@ -245,6 +847,15 @@ def main():
         """
         return date_parser.parse(date_string).strftime('%Y-%m-%d %H:%M:%S')
 
+    def process_retrieved_date_string(date_string: str) -> str:
+        """
+        Parse the retrieved date from an RDB response, like '2026-10-16 10:00:00 -04:00', and return it as UTC string
+        formatted. The json data generated value is the request date in UTC so the RDB value is converted to match.
+        :param date_string: string extracted from the retrieved comment line
+        :return: date/time string formatted as indicated
+        """
+        return date_parser.parse(date_string).astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
     def process_site_code(site_code):
         """
         Determine if the site code value is null or not null
@@ -256,6 +867,98 @@ def main():
         else:
             return np.NaN
 
+    def read_trend_records(header: np.memmap, records: np.memmap, window_seconds: int) -> np.ndarray:
+        """
+        Read the records inside the trend window ending at the latest reading into memory and return them.
+        Records are appended in time order, so the buffer is read back from the write position in chunks and reading
+        stops at the first chunk with no reading inside the window. Only the last few hours of the buffer are read
+        rather than the whole week it holds. Until the buffer has wrapped the unwritten records at its end are left out.
+        A site whose latest reading is older than the window has no records returned and so no trend.
+        :param header: memory mapped int64 header of the buffer file
+        :param records: memory mapped fixed width records of the buffer file
+        :param window_seconds: length of the trend window in seconds
+        :return: array of trend records
+        """
+        written_count = int(header[0])
+        available_count = min(written_count, len(records))
+        chunks_list = []
+        latest_timestamp = np.iinfo(np.int64).min
+        read_count = 0
+        while read_count < available_count:
+            chunk_length = min(trend_buffer_read_chunk_length, available_count - read_count)
+            chunk_end = written_count - read_count
+            chunk = records[np.arange(chunk_end - chunk_length, chunk_end) % len(records)]
+            read_count += chunk_length
+            chunks_list.append(chunk)
+            latest_timestamp = max(latest_timestamp, int(chunk["timestamp"].max()))
+            if chunk["timestamp"].max() < latest_timestamp - window_seconds:
+                break
+        if not chunks_list:
+            return np.zeros(0, dtype=trend_record_dtype)
+        window_records = np.concatenate(chunks_list[::-1])
+        return window_records[window_records["timestamp"] >= latest_timestamp - window_seconds]
+
+    def request_query_gauges(session: requests.Session, query_params: dict, modified_since: str) -> tuple:
+        """
+        Make a planned request for gauges using the shared session, decode the response, and create the Gauges.
+        Runs in a worker thread. The query payload is copied so concurrent requests do not alter each other's values.
+        :param session: pooled requests Session
+        :param query_params: the stateCd, bBox, or sites parameter of the planned request
+        :param modified_since: ISO 8601 duration for the modifiedSince parameter, or None for every series
+        :return: tuple of list of Gauge dataclass objects and payload bytes received
+        """
+        state_abbrev = query_params.get("stateCd", np.NaN)
+        # requests leaves out parameters with a None value, so stateCd is sent only by the state scope
+        query_payload = dict(usgs_query_payload, format=RESPONSE_FORMAT, **query_params)
+        if modified_since is not None:
+            query_payload["modifiedSince"] = modified_since
+        response = session.get(url=usgs_url,
+                               params=query_payload,
+                               stream=STREAMING_JSON_PARSE or RESPONSE_FORMAT == "rdb",
+                               timeout=request_timeout_seconds)
+        response.raise_for_status()
+        if RESPONSE_FORMAT == "rdb":
+            state_gauges = create_gauges_from_rdb_lines(rdb_lines=response.iter_lines(chunk_size=stream_chunk_size),
+                                                        state_abbrev=state_abbrev)
+        elif STREAMING_JSON_PARSE:
+            state_gauges = create_gauges_from_streamed_response(response=response, state_abbrev=state_abbrev)
+        else:
+            state_gauges = create_gauges_from_response_json(response_json=response.json(), state_abbrev=state_abbrev)
+        payload_bytes = response.raw.tell()
+        response.close()
+        return state_gauges, payload_bytes
+
+    def rollback_to_status_savepoint(cursor: pyodbc.Cursor) -> bool:
+        """
+        Roll the load transaction back to the status savepoint and return whether it could be.
+        An error that dooms the transaction also makes the savepoint rollback fail. The caller must then roll back the
+        whole transaction since it can no longer be committed.
+        :param cursor: pyodbc cursor within the load transaction, after the status savepoint
+        :return: True when rolled back to the savepoint, False when the savepoint rollback failed
+        """
+        try:
+            cursor.execute(sql_status_savepoint_rollback)
+        except pyodbc.Error as e:
+            print(f"Unable to roll back to the status savepoint. {e}")
+            return False
+        return True
+
+    def save_gauge_cache(cache_file: str, cache: dict) -> None:
+        """
+        Write the gauge cache for use by the next run. Written to a temporary file first so a failed write
+        does not leave a partial cache behind.
+        :param cache_file: path to the json cache file
+        :param cache: dictionary holding the watermark, last full refresh, and gauge snapshot
+        :return: None
+        """
+        temporary_file = f"{cache_file}.tmp"
+        try:
+            with open(temporary_file, 'w') as handler:
+                json.dump(cache, handler)
+            os.replace(temporary_file, cache_file)
+        except OSError as e:
+            print(f"Unable to save gauge cache {cache_file}. {e}")
+
     def setup_config(cfg_file: str) -> configparser.ConfigParser:
         """
         Instantiate the parser for accessing a config file.
@@ -292,6 +995,7 @@ def main():
 
     # FUNCTIONALITY
     start = datetime.now()
+    start_utc = datetime.now(timezone.utc)
     print(f"Process started: {start}")
 
     # When using a DEV & PROD file during the redesign, avoid issues in using wrong database by inspecting script name.
@@ -303,61 +1007,123 @@ def main():
     # need parser to access credentials
     config_parser = setup_config(config_file_path)
 
-    # Make request to url and alter the US state being requested
-    for state_abbrev in state_abbreviations_list:
-        usgs_query_payload["stateCd"] = state_abbrev
-        print(f"\nProcessing {state_abbrev.upper()}. Time elapsed {time_elapsed(start=start)}")
+    # Need the previous run's snapshot to decide between a full refresh and an incremental fetch
+    gauge_cache = load_gauge_cache(cache_file=gauge_cache_file_path) if INCREMENTAL_FETCH else {}
+    full_refresh = determine_fetch_is_full_refresh(cache=gauge_cache, now=start)
+    modified_since = None
+    if not full_refresh:
+        modified_since = create_modified_since_duration(
+            watermark=datetime.strptime(gauge_cache["watermark_utc"], date_time_format).replace(tzinfo=timezone.utc),
+            now=start_utc)
+    print(f"Fetch mode: {'full refresh' if full_refresh else f'incremental, modifiedSince {modified_since}'}")
 
-        try:
-            response = requests.get(url=usgs_url, params=usgs_query_payload)
-        except Exception as e:
-            print(f"Exception during request for html page {usgs_url}. {e}")
-            print(f"Response status code: {response.status_code}")
-            print(response.url)
-            print(f"Time elapsed {time_elapsed(start=start)}")
-            exit()
-        else:
-            # extract values from response json for gauge json object interrogation and Gauge object creation
-            response_json = response.json()
-            value_json = response_json.get("value", {})
-            time_series_json = value_json.get("timeSeries", {})
-
-            data_gen = extract_data_generated_value(value_json=value_json)
-            data_gen_processed = process_date_string(date_string=data_gen)
-
-            # Need to iterate over gauge objects in time series json and extract/process data for values of interest
-            for gauge_json in time_series_json:
-                source_info_json = extract_source_info(gauge_json=gauge_json)
-                second_level_values_json = extract_second_level_values(gauge_json=gauge_json)
-                site_name = extract_site_name(source_info_json=source_info_json)
-                site_code = extract_site_code(source_info_json=source_info_json)
-                variable_code = extract_variable_code(gauge_json=gauge_json)
-                variable_value = extract_variable_value(second_level_json=second_level_values_json)
-                collected_date = extract_collected_date(second_level_json=second_level_values_json)
-                collected_date_processed = process_date_string(date_string=collected_date)
-                discharge = determine_discharge_value(variable_code=variable_code, variable_value=variable_value)
-                gauge_height = determine_gauge_height_value(variable_code=variable_code, variable_value=variable_value)
-                site_code_processed = process_site_code(site_code=site_code)
-
-                # Need to build the Gauge objects and store for use in sql inseration
-                gauge_objects_list.append(Gauge(state_abbrev=state_abbrev,
-                                                site_name=site_name,
-                                                site_code=site_code_processed,
-                                                discharge=discharge,
-                                                gauge_height=gauge_height,
-                                                data_gen=data_gen_processed,
-                                                collect_date=collected_date_processed))
+    if REPORT_PARSE_MEMORY:
+        tracemalloc.start()
+
+    # Need the planned requests for the query scope
+    query_plan_dict = create_query_plan()
+    print(f"Query scope: {QUERY_SCOPE}, {len(query_plan_dict)} requests")
+
+    # Make the planned requests to url concurrently over one pooled session. The response is decoded and the
+    #   Gauge objects are created in the worker threads.
+    session = create_pooled_session(pool_size=MAX_CONCURRENT_REQUESTS)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        future_to_query_dict = {executor.submit(request_query_gauges,
+                                                session=session,
+                                                query_params=query_params,
+                                                modified_since=modified_since): query_label
+                                for query_label, query_params in query_plan_dict.items()}
+        for future in as_completed(future_to_query_dict):
+            query_label = future_to_query_dict[future]
+            try:
+                query_gauges, payload_bytes = future.result()
+            except Exception as e:
+                print(f"Exception during request for {query_label} from {usgs_url}. {e}")
+                print(f"Time elapsed {time_elapsed(start=start)}")
+                exit()
+            else:
+                payload_bytes_total += payload_bytes
+                query_gauges_dict[query_label] = query_gauges
+                print(f"Processed {query_label}, {len(query_gauges)} series. Time elapsed {time_elapsed(start=start)}")
+    session.close()
+    if REPORT_PARSE_MEMORY:
+        memory_current, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Peak memory during requests and parsing {memory_peak / 1024 / 1024:.1f} MB")
+
+    # Merge in plan order so rows are built in the same order regardless of which response arrived first. A site on
+    #   the shared edge of two region tiles is returned by both so series already merged are skipped.
+    merged_gauge_keys = set()
+    for query_label in query_plan_dict:
+        for gauge_obj in query_gauges_dict[query_label]:
+            key = create_gauge_key(gauge_obj=gauge_obj)
+            if key not in merged_gauge_keys:
+                merged_gauge_keys.add(key)
+                gauge_objects_list.append(gauge_obj)
+
+    # A full refresh replaces the snapshot and writes every row. An incremental fetch merges the modified series into
+    #   the snapshot and writes every row of each site with a changed reading, since its rows are deleted together.
+    if full_refresh:
+        gauge_snapshot_dict = {create_gauge_key(gauge_obj=gauge_obj): gauge_obj for gauge_obj in gauge_objects_list}
+        gauge_rows_to_write_list = gauge_objects_list
+    else:
+        gauge_snapshot_dict = {key: Gauge(**values) for key, values in gauge_cache["gauges"].items()}
+        for gauge_obj in gauge_objects_list:
+            key = create_gauge_key(gauge_obj=gauge_obj)
+            if determine_gauge_changed(previous_gauge=gauge_snapshot_dict.get(key), gauge_obj=gauge_obj):
+                changed_site_codes_dict[gauge_obj.site_code] = None
+                gauge_snapshot_dict[key] = gauge_obj
+        gauge_rows_to_write_list = [gauge_obj for gauge_obj in gauge_snapshot_dict.values()
+                                    if gauge_obj.site_code in changed_site_codes_dict]
+    if not LEGACY_TWO_ROW_LAYOUT:
+        gauge_rows_to_write_list = pivot_gauges_by_site(gauge_objs=gauge_rows_to_write_list)
+    print(f"Payload bytes received {payload_bytes_total}. Series received {len(gauge_objects_list)}, "
+          f"sites {len({gauge_obj.site_code for gauge_obj in gauge_objects_list})}. "
+          f"Rows to write {len(gauge_rows_to_write_list)}. Time elapsed {time_elapsed(start=start)}")
 
     # Need to build the values string statements for use later on with sql insert statement.
-    for gauge_obj in gauge_objects_list:
-        values = sql_values_string_template.format(site_number=gauge_obj.site_code,
-                                                   discharge=gauge_obj.discharge,
-                                                   gauge_height=gauge_obj.gauge_height,
-                                                   status=np.NaN,
-                                                   collected_date=gauge_obj.collect_date,
-                                                   data_gen=gauge_obj.data_gen)
-        values_string = sql_values_statement.format(values=values)
-        sql_values_statements_list.append(values_string)
+    for gauge_obj in gauge_rows_to_write_list:
+        sql_values_statements_list.append(create_sql_values_string(gauge_obj=gauge_obj))
+
+    # Record this run's reading of each site in the local ring buffer and compute each site's trends over the window.
+    #   An incremental fetch returns only the modified series, so the readings of its changed sites are taken from
+    #   the snapshot, which holds both of their parameters. Trends are kept for the sites in the snapshot so sites no
+    #   longer reporting are not written.
+    if RECORD_TRENDS:
+        trend_start = datetime.now()
+        if full_refresh:
+            site_series_list = gauge_objects_list
+        else:
+            site_series_list = [gauge_obj for gauge_obj in gauge_snapshot_dict.values()
+                                if gauge_obj.site_code in changed_site_codes_dict]
+        site_readings_list = [gauge_obj for gauge_obj in pivot_gauges_by_site(gauge_objs=site_series_list)
+                              if pd.notnull(gauge_obj.site_code)]
+        trend_header, trend_records = open_trend_buffer(buffer_file=trend_buffer_file_path,
+                                                        capacity=trend_buffer_capacity)
+        append_trend_records(header=trend_header, records=trend_records, gauge_objs=site_readings_list)
+        trend_window_records = read_trend_records(header=trend_header,
+                                                  records=trend_records,
+                                                  window_seconds=trend_window_hours * 3600)
+        site_trends_dict = compute_site_trends(records=trend_window_records,
+                                               window_seconds=trend_window_hours * 3600)
+        snapshot_site_codes = {gauge_obj.site_code for gauge_obj in gauge_snapshot_dict.values()}
+        window_start_strings = np.datetime_as_string(site_trends_dict["window_start"].astype("datetime64[s]"))
+        window_end_strings = np.datetime_as_string(site_trends_dict["window_end"].astype("datetime64[s]"))
+        for index, site_code in enumerate(site_trends_dict["site_code"]):
+            if site_code not in snapshot_site_codes:
+                continue
+            values = sql_trend_values_string_template.format(
+                site_number=site_code,
+                rate_of_rise=create_sql_trend_value(value=site_trends_dict["rate_of_rise"][index]),
+                percent_change=create_sql_trend_value(value=site_trends_dict["percent_change"][index]),
+                window_start=window_start_strings[index].replace("T", " "),
+                window_end=window_end_strings[index].replace("T", " "),
+                data_gen=start_date_time)
+            sql_trend_values_statements_list.append(sql_values_statement.format(values=values))
+        print(f"Trend buffer appended {len(site_readings_list)} readings and holds "
+              f"{min(int(trend_header[0]), trend_buffer_capacity)}, {len(trend_window_records)} read in the window. "
+              f"Trends computed for {len(sql_trend_values_statements_list)} sites in {time_elapsed(start=trend_start)}")
+        del trend_header, trend_records
 
     # Database Transactions
     print(f"\nDatabase operations initiated. Time elapsed {time_elapsed(start=start)}")
@@ -372,6 +1138,15 @@ def main():
     # need the sql table headers as comma separated string values for use in the DELETE & INSERT statement
     headers_joined = ",".join([f"{val}" for val in usgs_streamgauge_headers])
     sql_delete_string = sql_delete_template.format(table=database_table_name)
+
+    # An incremental fetch deletes only the rows of changed sites, in rounds to keep the statements a manageable size
+    changed_site_codes_list = list(changed_site_codes_dict)
+    sql_delete_sites_list = []
+    for i in range(0, len(changed_site_codes_list), sql_insertion_step_increment):
+        site_codes_in_range = changed_site_codes_list[i: i + sql_insertion_step_increment]
+        site_numbers = ",".join([f"'{site_code}'" for site_code in site_codes_in_range])
+        sql_delete_sites_list.append(sql_delete_sites_template.format(table=database_table_name,
+                                                                      site_numbers=site_numbers))
     sql_insert_string = sql_insert_template.format(
         table=database_table_name,
         headers_joined=headers_joined)
@@ -381,6 +1156,14 @@ def main():
                                           step_increment=sql_insertion_step_increment,
                                           sql_insert_string=sql_insert_string)
 
+    # The trends table is rewritten in full, in rounds like the gauges
+    trends_table_name = realtime_usgsstreamgaugetrends_tbl.format(database_name=database_name)
+    sql_trend_insert_gen = sql_insert_generator(sql_values_list=sql_trend_values_statements_list,
+                                                step_increment=sql_insertion_step_increment,
+                                                sql_insert_string=sql_insert_template.format(
+                                                    table=trends_table_name,
+                                                    headers_joined=",".join(usgs_streamgaugetrends_headers)))
+
     # Build the sql for updating the task tracker table for this process.
     sql_task_tracker_update = f"UPDATE RealTime_TaskTracking SET lastRun = '{start_date_time}', DataGenerated = (SELECT max(DataGenerated) from {database_table_name}) WHERE taskName = '{task_name}'"
 
@@ -389,7 +1172,11 @@ def main():
 
         # Due to 1000 record insert limit, delete records first and then do insertion rounds for 2400+ gauges
         try:
-            cursor.execute(sql_delete_string)
+            if full_refresh:
+                cursor.execute(sql_delete_string)
+            else:
+                for sql_delete_sites_string in sql_delete_sites_list:
+                    cursor.execute(sql_delete_sites_string)
         except Exception as e:
             print(f"Error deleting records from {database_table_name}. {e}")
             exit()
@@ -407,28 +1194,66 @@ def main():
                 print(f"Executing insert batch {insert_round_count}. Time elapsed {time_elapsed(start=start)}")
                 insert_round_count += 1
 
-        # Need to update the task tracker table to record last run time
+        # Need to update the task tracker table to record last run time. It is updated before the status so a
+        #   transaction is always open when the status savepoint is set.
         try:
             cursor.execute(sql_task_tracker_update)
         except pyodbc.DataError:
             print(f"A value in the sql exceeds the field length allowed in database table: {sql_task_tracker_update}")
 
-        connection.commit()
-        print(f"Commit successful. Time elapsed {time_elapsed(start=start)}")
-
-    # Old process executed a stored procedure for updating the Gauge locations table with status information based
-    #   on business logic in the stored procedure.
-    with pyodbc.connect(full_connection_string) as connection:
-        cursor = connection.cursor()
-
+        # Status is updated in the same transaction as the rows so the two are never out of step. The original
+        #   procedure recomputes status over the whole table. When only changed sites are written their site numbers
+        #   can be passed to a set-based procedure that updates just those sites. The status work follows a savepoint
+        #   so that if it fails it alone is rolled back and the rows are still committed.
+        status_start = datetime.now()
+        transaction_doomed = False
         try:
-            cursor.execute("exec RealTime_UpdateUSGSStreamGagesStatus")
-        except Exception as e:
-            print(f"Error executing stored procedure RealTime_UpdateUSGSStreamGagesStatus. {e}")
-            exit()
+            cursor.execute(sql_status_savepoint)
+            if full_refresh or not STATUS_CHANGED_SITES_ONLY:
+                status_site_count = execute_status_procedure(cursor=cursor, site_codes=None)
+            else:
+                status_site_count = execute_status_procedure(cursor=cursor, site_codes=changed_site_codes_list)
+        except pyodbc.Error as e:
+            if rollback_to_status_savepoint(cursor=cursor):
+                print(f"Error executing status procedure. Status is left as it was and the rows are still committed. "
+                      f"{e}")
+            else:
+                connection.rollback()
+                transaction_doomed = True
+                print(f"Error executing status procedure. The whole transaction was rolled back and no rows were "
+                      f"written. {e}")
         else:
+            print(f"Status updated for {status_site_count} sites in {time_elapsed(start=status_start)}. "
+                  f"Time elapsed {time_elapsed(start=start)}")
+
+        if not transaction_doomed:
             connection.commit()
-            print(f"Stored procedure executed. Time elapsed {time_elapsed(start=start)}")
+            print(f"Commit successful. Rows written {len(sql_values_statements_list)}"
+                  f"{'' if full_refresh else f' for {len(changed_site_codes_list)} changed sites'}. "
+                  f"Time elapsed {time_elapsed(start=start)}")
+
+        # Trends are written in their own transaction after the gauges are committed. They are optional so a
+        #   failure, such as the table not existing, is rolled back without losing the gauges.
+        if RECORD_TRENDS and not transaction_doomed:
+            try:
+                cursor.execute(sql_delete_template.format(table=trends_table_name))
+                for batch in sql_trend_insert_gen:
+                    cursor.execute(batch)
+            except (pyodbc.DataError, pyodbc.ProgrammingError) as e:
+                connection.rollback()
+                print(f"Trends not written to {trends_table_name}, gauges are unaffected. {e}")
+            else:
+                connection.commit()
+                print(f"Trends written {len(sql_trend_values_statements_list)}. "
+                      f"Time elapsed {time_elapsed(start=start)}")
+
+    # The snapshot and watermark are saved only once the rows are committed so a failed run is fetched again
+    if INCREMENTAL_FETCH and not transaction_doomed:
+        save_gauge_cache(cache_file=gauge_cache_file_path,
+                         cache={"watermark_utc": start_utc.strftime(date_time_format),
+                                "last_full_refresh": (start.strftime(date_time_format) if full_refresh
+                                                      else gauge_cache["last_full_refresh"]),
+                                "gauges": {key: asdict(gauge_obj) for key, gauge_obj in gauge_snapshot_dict.items()}})
 
     print("\nProcess completed.")
     print(f"Time elapsed {time_elapsed(start=start)}")